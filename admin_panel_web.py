@@ -1,15 +1,19 @@
 import os
 import json
+import asyncio
 from typing import List, Dict
 import aiofiles
 
 from fastapi import FastAPI, Request, HTTPException, Depends
-from fastapi.responses import RedirectResponse
+from fastapi.responses import RedirectResponse, StreamingResponse, PlainTextResponse
 from fastapi.staticfiles import StaticFiles
 from fastapi.templating import Jinja2Templates
 
+from utils.metrics import metrics, LiveSampler
+
 DATA_DIR = os.getenv("DATA_DIR", "data")
 ADMIN_TOKEN = os.getenv("ADMIN_PANEL_TOKEN", "changeme")
+METRICS_STREAM_INTERVAL = 1.0
 
 app = FastAPI(title="Mahiro Admin Panel")
 app.mount("/static", StaticFiles(directory="static"), name="static")
@@ -75,6 +79,26 @@ async def view_balances(_=Depends(verify_admin)):
     return balances
 
 
+@app.get("/metrics")
+async def metrics_prometheus(_=Depends(verify_admin)):
+    """Метрики в формате Prometheus"""
+    return PlainTextResponse(metrics.render_prometheus(), media_type="text/plain; version=0.0.4")
+
+
+@app.get("/metrics/stream")
+async def metrics_stream(request: Request, _=Depends(verify_admin)):
+    """SSE-поток живых метрик (раз в секунду)"""
+    async def event_source():
+        sampler = LiveSampler(metrics)
+        while not await request.is_disconnected():
+            await asyncio.sleep(METRICS_STREAM_INTERVAL)
+            snapshot = json.dumps(sampler.sample(), ensure_ascii=False, separators=(",", ":"))
+            yield f"event: metrics\ndata: {snapshot}\n\n"
+
+    headers = {"Cache-Control": "no-cache", "X-Accel-Buffering": "no"}
+    return StreamingResponse(event_source(), media_type="text/event-stream", headers=headers)
+
+
 @app.post("/refund/{transaction_id}")
 async def refund(transaction_id: str, _=Depends(verify_admin)):
     donations_path = f"{DATA_DIR}/donations.json"
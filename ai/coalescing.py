@@ -0,0 +1,98 @@
+"""
+Склейка одинаковых одновременных запросов к Mistral (single-flight)
+
+Во время рассылок многие пишут одно и то же почти одновременно, и
+при одинаковых настроении, времени суток и уровне доверия системный
+промпт у них совпадает. Такие запросы отличает только ключ: хэш
+системного промпта, всей истории, которая уходит в модель, и самого
+сообщения. Склеиваются только запросы с одинаковым контекстом целиком,
+поэтому ответ не может быть построен на чужом разговоре.
+Первый запрос с ключом идёт в Mistral, остальные ждут его ответ.
+Ответ для присоединившихся слегка варьируется (vary_reply), чтобы
+разные пользователи не получали слово в слово одно и то же.
+"""
+import asyncio
+import hashlib
+import json
+import random
+import re
+from typing import Awaitable, Callable, Dict, List, Optional, Tuple
+
+from utils.metrics import metrics
+
+_coalesced = metrics.counter("mahiro_llm_coalesced_total", "Запросы к Mistral, присоединённые к уже идущему")
+_inflight_keys = metrics.gauge("mahiro_llm_singleflight_keys", "Уникальные запросы к Mistral в процессе")
+
+# Эмодзи, которые можно заменять друг на друга без смены тона
+_EMOJI_GROUPS = [
+    ("😊", "☺️", "🙂"),
+    ("😳", "😅", "🙈"),
+    ("😤", "💢", "😠"),
+    ("😖", "😣", "😫"),
+    ("🥺", "😢", "😔"),
+]
+_EMOJI_ALTERNATIVES = {emoji: group for group in _EMOJI_GROUPS for emoji in group}
+_EMOJI_RE = re.compile("|".join(re.escape(emoji) for emoji in _EMOJI_ALTERNATIVES))
+
+_INTERJECTIONS = ("Хм… ", "Эм… ", "Ну… ", "О… ")
+
+
+def coalesce_key(system_prompt: str, history: List[Dict[str, str]], user_message: str,
+                 temperature: float, model: str, max_tokens: int) -> str:
+    """Ключ запроса: одинаковый у запросов, на которые годится один ответ (история - вся)"""
+    payload = json.dumps(
+        [system_prompt, history, user_message.strip().lower(), temperature, model, max_tokens],
+        ensure_ascii=False,
+    )
+    return hashlib.blake2b(payload.encode("utf-8"), digest_size=16).hexdigest()
+
+
+def vary_reply(text: str, rng: Optional[random.Random] = None) -> str:
+    """
+    Лёгкая вариация ответа для присоединившегося запроса
+
+    Меняет эмодзи на близкие по смыслу и иногда добавляет междометие
+    в начало. Смысл ответа не меняется.
+    """
+    rng = rng or random.Random()
+
+    varied = _EMOJI_RE.sub(lambda m: rng.choice(_EMOJI_ALTERNATIVES[m.group(0)]), text)
+
+    if rng.random() < 0.5 and not varied.startswith(_INTERJECTIONS):
+        varied = rng.choice(_INTERJECTIONS) + varied
+
+    return varied
+
+
+class SingleFlight:
+    """Одновременные вызовы с одинаковым ключом выполняются один раз"""
+
+    def __init__(self):
+        self._calls: Dict[str, asyncio.Future] = {}
+
+    async def do(self, key: str, func: Callable[[], Awaitable]) -> Tuple[object, bool]:
+        """
+        Returns:
+            (результат, shared) - shared=True, если результат взят у
+            уже идущего вызова
+        """
+        leader = self._calls.get(key)
+        if leader is not None:
+            _coalesced.inc()
+            # shield: отмена одного ожидающего не должна отменять общий вызов
+            return await asyncio.shield(leader), True
+
+        future = asyncio.get_running_loop().create_future()
+        self._calls[key] = future
+        _inflight_keys.set(len(self._calls))
+        try:
+            result = await func()
+            future.set_result(result)
+            return result, False
+        except BaseException:
+            # Ждущие получают None и сами решают, что ответить
+            future.set_result(None)
+            raise
+        finally:
+            del self._calls[key]
+            _inflight_keys.set(len(self._calls))
@@ -0,0 +1,133 @@
+"""
+Разгрузка бота при перегрузке Mistral
+
+Когда очередь к Mistral растёт, каждый пользователь всё равно ждёт
+полный ответ, и ждут все. Контроллер смотрит на глубину очереди
+LLMScheduler и на время ответа (очередь + генерация) за последнюю
+минуту и выбирает режим:
+    normal - как обычно
+    short  - обычным пользователям короткий ответ быстрой модели
+    shed   - обычным пользователям ответ из кэша или заготовка, без Mistral
+Триггеры работают во всех режимах, админы и донатеры всегда получают
+полный ответ.
+
+Режим ужесточается сразу, а смягчается на одну ступень и только
+когда показатели опустились ниже SHED_RECOVERY_RATIO от порога и
+прошло SHED_MIN_DWELL секунд (гистерезис - чтобы режим не мигал).
+О каждом переключении узнают подписчики (уведомление админам в main.py).
+"""
+import logging
+import time
+from collections import deque
+from typing import Callable, List
+
+from ai.scheduler import LLMScheduler
+from config import (
+    ENABLE_LOAD_SHEDDING, SHED_QUEUE_SHORT, SHED_QUEUE_SHED, SHED_LATENCY_SHORT, SHED_LATENCY_SHED,
+    SHED_RECOVERY_RATIO, SHED_MIN_DWELL,
+)
+from utils.metrics import metrics
+
+logger = logging.getLogger(__name__)
+
+NORMAL = "normal"
+SHORT = "short"
+SHED = "shed"
+MODES = (NORMAL, SHORT, SHED)
+
+# Классы очереди, которые разгружаются
+LOW_PRIORITY = ("regular", "background")
+
+_mode_gauge = metrics.gauge("mahiro_degradation_mode", "Режим разгрузки: 0 - normal, 1 - short, 2 - shed")
+_transitions = metrics.counter(
+    "mahiro_degradation_transitions_total", "Переключения режима разгрузки", labels=("mode",)
+)
+_shed_messages = metrics.counter(
+    "mahiro_degradation_messages_total", "Сообщения, обработанные облегчённо", labels=("mode",)
+)
+_mode_transitions = {mode: _transitions.labels(mode) for mode in MODES}
+_mode_messages = {mode: _shed_messages.labels(mode) for mode in (SHORT, SHED)}
+
+
+class DegradationController:
+    """Выбирает режим разгрузки по очереди и латентности Mistral"""
+
+    # За сколько секунд учитываются ответы
+    LATENCY_WINDOW = 60
+
+    def __init__(self, scheduler: LLMScheduler, enabled: bool = ENABLE_LOAD_SHEDDING):
+        self.scheduler = scheduler
+        self.enabled = enabled
+        self.level = 0
+        self._changed_at = 0.0
+        self._latencies: deque = deque(maxlen=500)
+        self._subscribers: List[Callable[[str, str], None]] = []
+        _mode_gauge.set(0)
+
+    @property
+    def mode(self) -> str:
+        return MODES[self.level]
+
+    def subscribe(self, callback: Callable[[str, str], None]):
+        """callback(режим, причина) вызывается при каждом переключении"""
+        self._subscribers.append(callback)
+
+    def observe(self, latency: float):
+        """Время ответа Mistral для сообщения пользователя (с ожиданием в очереди)"""
+        self._latencies.append((time.monotonic(), latency))
+
+    def _recent_latency(self, now: float) -> float:
+        while self._latencies and now - self._latencies[0][0] > self.LATENCY_WINDOW:
+            self._latencies.popleft()
+        if not self._latencies:
+            return 0.0
+        return sum(latency for _, latency in self._latencies) / len(self._latencies)
+
+    @staticmethod
+    def _target(queue: float, latency: float, ratio: float = 1.0) -> int:
+        if queue >= SHED_QUEUE_SHED * ratio or latency >= SHED_LATENCY_SHED * ratio:
+            return 2
+        if queue >= SHED_QUEUE_SHORT * ratio or latency >= SHED_LATENCY_SHORT * ratio:
+            return 1
+        return 0
+
+    def evaluate(self) -> str:
+        """Пересчитывает режим по текущим показателям"""
+        if not self.enabled:
+            return NORMAL
+
+        now = time.monotonic()
+        queue = self.scheduler.waiting()
+        latency = self._recent_latency(now)
+
+        target = self._target(queue, latency)
+        if target > self.level:
+            self._switch(target, now, f"очередь {queue}, ответ {latency:.1f} с")
+        elif (self.level > 0 and now - self._changed_at >= SHED_MIN_DWELL
+              and self._target(queue, latency, SHED_RECOVERY_RATIO) < self.level):
+            self._switch(self.level - 1, now, f"очередь {queue}, ответ {latency:.1f} с")
+        return self.mode
+
+    def mode_for(self, priority: str) -> str:
+        """Режим для нового сообщения класса priority"""
+        mode = self.evaluate()
+        if priority not in LOW_PRIORITY or mode == NORMAL:
+            return NORMAL
+        _mode_messages[mode].inc()
+        return mode
+
+    def _switch(self, level: int, now: float, reason: str):
+        previous = self.mode
+        self.level = level
+        self._changed_at = now
+        _mode_gauge.set(level)
+        _mode_transitions[self.mode].inc()
+        logger.warning(
+            f"Load shedding mode {previous} -> {self.mode}: {reason}",
+            extra={"stage": "degradation"}
+        )
+        for callback in self._subscribers:
+            try:
+                callback(self.mode, reason)
+            except Exception as e:
+                logger.error(f"Degradation subscriber failed: {e}")
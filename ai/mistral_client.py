@@ -1,36 +1,249 @@
 from mistralai import Mistral
-from typing import List, Dict, Optional
+from typing import Any, List, Dict, NamedTuple, Optional, Tuple
 import logging
 import asyncio
+import time
 
-from config import MISTRAL_API_KEY, MISTRAL_MODEL, TEMPERATURE, MAX_TOKENS
+from ai.coalescing import SingleFlight, coalesce_key, vary_reply
+from ai.resilience import AdaptiveLimiter, CircuitBreaker, HedgePolicy, is_throttled
+from ai.scheduler import LLMScheduler
+from config import (
+    MISTRAL_API_KEY, MISTRAL_MODEL, MISTRAL_SERVER_URL, TEMPERATURE, MAX_TOKENS, LLM_QUEUE_TIMEOUT,
+    LLM_HEDGING_ENABLED,
+)
+from utils.metrics import metrics, llm_latency, llm_requests, llm_tokens, queue_depth, errors_total
 
 logger = logging.getLogger(__name__)
 
+_llm_queue = queue_depth.labels("llm")
+_llm_errors = errors_total.labels("llm")
+_requests_ok = llm_requests.labels("ok")
+_requests_empty = llm_requests.labels("empty")
+_requests_error = llm_requests.labels("error")
+_requests_throttled = llm_requests.labels("throttled")
+_requests_rejected = llm_requests.labels("rejected")
+_prompt_tokens = llm_tokens.labels("prompt")
+_completion_tokens = llm_tokens.labels("completion")
+
+_ttft = metrics.histogram("mahiro_llm_ttft_seconds", "Время до первого токена Mistral (потоковые запросы)")
+_hedges = metrics.counter("mahiro_llm_hedges_total", "Дублирующие запросы к Mistral", labels=("outcome",))
+_hedge_fired = _hedges.labels("fired")
+_hedge_won = _hedges.labels("won")
+_hedge_no_budget = _hedges.labels("no_budget")
+
+
+class GenerationResult(NamedTuple):
+    """Ответ Mistral вместе с тем, чего он стоил"""
+    text: str
+    model: str
+    prompt_tokens: int
+    completion_tokens: int
+    latency_ms: int
+    # Ответ взят у одновременного одинакового запроса (токены потрачены не на этот)
+    shared: bool = False
+
+    @property
+    def total_tokens(self) -> int:
+        return self.prompt_tokens + self.completion_tokens
+
 
 class MistralClient:
     def __init__(self):
-        self.client = Mistral(api_key=MISTRAL_API_KEY)
+        self.client = Mistral(api_key=MISTRAL_API_KEY, server_url=MISTRAL_SERVER_URL)
         self.model = MISTRAL_MODEL
+        self.limiter = AdaptiveLimiter()
+        self.scheduler = LLMScheduler(self.limiter)
+        self.breaker = CircuitBreaker()
+        self.hedging = LLM_HEDGING_ENABLED
+        self.hedge_policy = HedgePolicy()
+        self.single_flight = SingleFlight()
 
-    async def generate_response(
+    @property
+    def degraded(self) -> bool:
+        """Mistral сейчас считается недоступным (предохранитель не закрыт)"""
+        return self.breaker.degraded
+
+    async def _complete(self, messages: List[Dict[str, str]], temperature: float,
+                        model: str, max_tokens: int) -> Tuple[Optional[str], Any]:
+        """Обычный запрос: (текст или None, usage)"""
+        response = await asyncio.to_thread(
+            self.client.chat.complete,
+            model=model,
+            messages=messages,
+            temperature=temperature,
+            max_tokens=max_tokens
+        )
+
+        usage = getattr(response, "usage", None)
+        if response.choices and len(response.choices) > 0:
+            return response.choices[0].message.content, usage
+        return None, usage
+
+    async def _stream(self, messages: List[Dict[str, str]], temperature: float, model: str, max_tokens: int,
+                      first_token: asyncio.Event) -> Tuple[Optional[str], Any]:
+        """Потоковый запрос: first_token выставляется с приходом первого куска текста"""
+        started = time.perf_counter()
+        stream = await self.client.chat.stream_async(
+            model=model,
+            messages=messages,
+            temperature=temperature,
+            max_tokens=max_tokens
+        )
+
+        parts = []
+        usage = None
+        async for event in stream:
+            chunk = event.data
+            if chunk.usage:
+                usage = chunk.usage
+            if not chunk.choices or not chunk.choices[0].delta.content:
+                continue
+            if not first_token.is_set():
+                first_token.set()
+                ttft = time.perf_counter() - started
+                _ttft.observe(ttft)
+                self.hedge_policy.observe_ttft(ttft)
+            parts.append(chunk.choices[0].delta.content)
+
+        return ("".join(parts) or None), usage
+
+    async def _complete_hedged(self, messages: List[Dict[str, str]], temperature: float,
+                               model: str, max_tokens: int) -> Tuple[Optional[str], Any]:
+        """
+        Запрос с хеджированием
+
+        Если первый токен не пришёл за порог HedgePolicy, отправляется
+        дубль (если позволяет бюджет). Ответом становится тот, кто
+        закончит первым, второй отменяется. Дубль не занимает слот
+        AdaptiveLimiter: дополнительную нагрузку ограничивает бюджет.
+        """
+        self.hedge_policy.on_request()
+        primary_first = asyncio.Event()
+        primary = asyncio.create_task(self._stream(messages, temperature, model, max_tokens, primary_first))
+        waiter = asyncio.create_task(primary_first.wait())
+        pending = {primary}
+
+        try:
+            await asyncio.wait({primary, waiter}, timeout=self.hedge_policy.threshold(),
+                               return_when=asyncio.FIRST_COMPLETED)
+            waiter.cancel()
+
+            if primary.done() or primary_first.is_set():
+                return await primary
+
+            if not self.hedge_policy.try_spend():
+                _hedge_no_budget.inc()
+                return await primary
+
+            _hedge_fired.inc()
+            hedge = asyncio.create_task(self._stream(messages, temperature, model, max_tokens, asyncio.Event()))
+            pending = {primary, hedge}
+            while True:
+                done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+                # Упавший запрос не побеждает, пока жив второй
+                for task in done:
+                    if task.exception() is None:
+                        if task is hedge:
+                            _hedge_won.inc()
+                        return task.result()
+                if not pending:
+                    return done.pop().result()
+        finally:
+            waiter.cancel()
+            for task in pending:
+                task.cancel()
+
+    async def generate(
             self,
             system_prompt: str,
             history: List[Dict[str, str]],
-            user_message: str
-    ) -> Optional[str]:
+            user_message: str,
+            temperature: float = TEMPERATURE,
+            model: Optional[str] = None,
+            max_tokens: int = MAX_TOKENS,
+            user_id: int = 0,
+            priority: str = "regular"
+    ) -> Optional[GenerationResult]:
         """
-        Генерирует ответ Махиро
+        Генерирует ответ и возвращает его вместе с моделью, токенами и латентностью
 
         Args:
             system_prompt: системный промпт с контекстом
             history: история диалога
             user_message: новое сообщение пользователя
+            temperature: температура (для служебных запросов - ниже)
+            model: модель (по умолчанию MISTRAL_MODEL)
+            max_tokens: предел длины ответа
+            user_id: чей запрос (для честной очереди между пользователями)
+            priority: класс очереди из LLM_PRIORITY_CLASSES
+
+        Returns:
+            Результат или None при ошибке (и сразу None, если
+            предохранитель открыт или не дождались слота)
+        """
+        model = model or self.model
+        key = coalesce_key(system_prompt, history, user_message, temperature, model, max_tokens)
+        result, shared = await self.single_flight.do(
+            key, lambda: self._generate(
+                system_prompt, history, user_message, temperature, model, max_tokens, user_id, priority
+            )
+        )
+        if shared and result:
+            return result._replace(text=vary_reply(result.text), shared=True)
+        return result
+
+    async def generate_response(
+            self,
+            system_prompt: str,
+            history: List[Dict[str, str]],
+            user_message: str,
+            temperature: float = TEMPERATURE,
+            priority: str = "regular",
+            max_tokens: int = MAX_TOKENS
+    ) -> Optional[str]:
+        """
+        Генерирует ответ Махиро
 
         Returns:
             Ответ Махиро или None при ошибке
         """
+        result = await self.generate(
+            system_prompt, history, user_message, temperature, max_tokens=max_tokens, priority=priority
+        )
+        return result.text if result else None
+
+    async def _generate(
+            self,
+            system_prompt: str,
+            history: List[Dict[str, str]],
+            user_message: str,
+            temperature: float,
+            model: str,
+            max_tokens: int,
+            user_id: int,
+            priority: str
+    ) -> Optional[GenerationResult]:
+        """Один запрос к Mistral (через предохранитель и очередь с приоритетами)"""
+        if not self.breaker.allow():
+            _requests_rejected.inc()
+            return None
+
+        _llm_queue.inc()
+        started = time.perf_counter()
+        call_started = started
+        acquired = False
+        latency = None
+        throttled = False
         try:
+            acquired = await self.scheduler.acquire(user_id, priority, max_tokens, LLM_QUEUE_TIMEOUT)
+            if not acquired:
+                # Очередь переполнена у нас, а не у Mistral - предохранитель не трогаем,
+                # только отпускаем пробный запрос, если он был этим
+                self.breaker.release_probe()
+                _requests_rejected.inc()
+                return None
+
+            call_started = time.perf_counter()
             # Формируем сообщения для API
             messages = [
                 {"role": "system", "content": system_prompt}
@@ -43,21 +256,46 @@ class MistralClient:
             messages.append({"role": "user", "content": user_message})
 
             # Вызываем API асинхронно
-            response = await asyncio.to_thread(
-                self.client.chat.complete,
-                model=self.model,
-                messages=messages,
-                temperature=TEMPERATURE,
-                max_tokens=MAX_TOKENS
-            )
+            if self.hedging:
+                text, usage = await self._complete_hedged(messages, temperature, model, max_tokens)
+            else:
+                text, usage = await self._complete(messages, temperature, model, max_tokens)
+
+            latency = time.perf_counter() - call_started
+            llm_latency.observe(latency)
+            self.breaker.record_success()
+
+            prompt_tokens = (usage.prompt_tokens or 0) if usage else 0
+            completion_tokens = (usage.completion_tokens or 0) if usage else 0
+            _prompt_tokens.inc(prompt_tokens)
+            _completion_tokens.inc(completion_tokens)
 
             # Извлекаем ответ
-            if response.choices and len(response.choices) > 0:
-                return response.choices[0].message.content
+            if text:
+                _requests_ok.inc()
+                return GenerationResult(text, model, prompt_tokens, completion_tokens, round(latency * 1000))
 
-            logger.error("Пустой ответ от Mistral API")
+            logger.error(
+                "Пустой ответ от Mistral API",
+                extra={"stage": "llm", "model": model, "latency_ms": round((time.perf_counter() - started) * 1000)}
+            )
+            _requests_empty.inc()
+            _llm_errors.inc()
             return None
 
         except Exception as e:
-            logger.error(f"Ошибка при обращении к Mistral API: {e}")
-            return None
\ No newline at end of file
+            throttled = is_throttled(e)
+            if throttled:
+                latency = time.perf_counter() - call_started
+            logger.error(
+                f"Ошибка при обращении к Mistral API: {e}",
+                extra={"stage": "llm", "model": model, "latency_ms": round((time.perf_counter() - started) * 1000)}
+            )
+            self.breaker.record_failure()
+            (_requests_throttled if throttled else _requests_error).inc()
+            _llm_errors.inc()
+            return None
+        finally:
+            if acquired:
+                self.limiter.release(latency, throttled)
+            _llm_queue.dec()
@@ -0,0 +1,276 @@
+"""
+Защита от перегрузки и сбоев Mistral
+
+AdaptiveLimiter задаёт число одновременных запросов. Лимит
+растёт на единицу за «окно» быстрых ответов и уменьшается, когда
+запросы идут дольше LLM_TARGET_LATENCY или приходит 429 (AIMD).
+HedgePolicy решает, когда отправить дубль медленного запроса.
+CircuitBreaker после серии сбоев перестаёт пропускать запросы: они
+сразу получают отказ вместо ожидания таймаута. Через
+BREAKER_OPEN_SECONDS пропускается один пробный запрос - если он
+успешен, всё возвращается в норму. Пока Mistral недоступен, ответы
+берутся из DegradedReplies.
+"""
+import logging
+import random
+import re
+import time
+from collections import OrderedDict, deque
+from typing import Callable, Optional, Tuple
+
+from config import (
+    LLM_MIN_CONCURRENCY, LLM_MAX_CONCURRENCY, LLM_INITIAL_CONCURRENCY, LLM_TARGET_LATENCY,
+    BREAKER_FAILURE_THRESHOLD, BREAKER_OPEN_SECONDS, DEGRADED_CACHE_SIZE,
+    LLM_HEDGE_PERCENTILE, LLM_HEDGE_MIN_DELAY, LLM_HEDGE_BUDGET,
+)
+from utils.metrics import metrics
+
+logger = logging.getLogger(__name__)
+
+_concurrency_limit = metrics.gauge("mahiro_llm_concurrency_limit", "Текущий лимит одновременных запросов к Mistral")
+_inflight = metrics.gauge("mahiro_llm_inflight", "Запросы к Mistral в процессе")
+rejected_requests = metrics.counter("mahiro_llm_rejected_total", "Запросы к Mistral, не отправленные", labels=("reason",))
+_breaker_state = metrics.gauge("mahiro_llm_breaker_state", "Предохранитель Mistral: 0 - закрыт, 1 - пробный, 2 - открыт")
+_breaker_transitions = metrics.counter(
+    "mahiro_llm_breaker_transitions_total", "Переключения предохранителя Mistral", labels=("state",)
+)
+_hedge_threshold = metrics.gauge("mahiro_llm_hedge_threshold_seconds", "Порог ожидания первого токена до дубля")
+_degraded_replies = metrics.counter("mahiro_degraded_replies_total", "Ответы без Mistral", labels=("source",))
+_degraded_cache = _degraded_replies.labels("cache")
+_degraded_canned = _degraded_replies.labels("canned")
+_rejected_breaker_open = rejected_requests.labels("breaker_open")
+
+
+class AdaptiveLimiter:
+    """
+    Подстраиваемый лимит одновременных запросов (additive increase / multiplicative decrease)
+
+    Сам лимитер только считает слоты; очередь ожидающих и порядок
+    выдачи слотов - в LLMScheduler (ai/scheduler.py), который
+    подписывается на освобождение слотов через on_release.
+    """
+
+    # Во сколько раз уменьшается лимит: при 429 и при медленном ответе
+    THROTTLE_BACKOFF = 0.5
+    SLOW_BACKOFF = 0.9
+
+    def __init__(self, min_limit: int = LLM_MIN_CONCURRENCY, max_limit: int = LLM_MAX_CONCURRENCY,
+                 initial: int = LLM_INITIAL_CONCURRENCY, target_latency: float = LLM_TARGET_LATENCY):
+        self.min_limit = min_limit
+        self.max_limit = max_limit
+        self.target_latency = target_latency
+        self.limit = float(initial)
+        self.inflight = 0
+        self.on_release: Optional[Callable[[], None]] = None
+        self._last_decrease = 0.0
+        _concurrency_limit.set(initial)
+
+    def has_capacity(self) -> bool:
+        return self.inflight < int(self.limit)
+
+    def take(self):
+        """Занимает слот (вызывающий уже проверил has_capacity)"""
+        self.inflight += 1
+        _inflight.set(self.inflight)
+
+    def release(self, latency: Optional[float], throttled: bool = False):
+        """
+        Освобождает слот и подстраивает лимит
+
+        Args:
+            latency: время ответа (None - запрос упал не из-за нагрузки, лимит не меняется)
+            throttled: Mistral ответил 429
+        """
+        self.inflight -= 1
+        _inflight.set(self.inflight)
+
+        # Лимит снижается не чаще раза за «окно»: ответы на запросы,
+        # отправленные до прошлого снижения, его уже учли
+        now = time.monotonic()
+        fresh = latency is not None and now - latency >= self._last_decrease
+        if throttled and fresh:
+            self.limit *= self.THROTTLE_BACKOFF
+            self._last_decrease = now
+        elif latency is not None and latency > self.target_latency:
+            if fresh:
+                self.limit *= self.SLOW_BACKOFF
+                self._last_decrease = now
+        elif latency is not None:
+            self.limit += 1 / self.limit
+
+        self.limit = min(self.max_limit, max(self.min_limit, self.limit))
+        _concurrency_limit.set(int(self.limit))
+
+        if self.on_release:
+            self.on_release()
+
+
+class HedgePolicy:
+    """
+    Порог и бюджет хеджирования
+
+    Порог - перцентиль времени до первого токена (TTFT) по последним
+    запросам, но не меньше min_delay. Бюджет - ведро токенов: каждый
+    обычный запрос добавляет budget токена, дубль тратит целый, поэтому
+    дублей не больше budget от всех запросов (с небольшим запасом на всплеск).
+    """
+
+    # Сколько последних TTFT учитывается и сколько нужно, чтобы им доверять
+    WINDOW = 500
+    MIN_SAMPLES = 20
+    MAX_TOKENS = 10.0
+
+    def __init__(self, percentile: float = LLM_HEDGE_PERCENTILE, min_delay: float = LLM_HEDGE_MIN_DELAY,
+                 budget: float = LLM_HEDGE_BUDGET):
+        self.percentile = percentile
+        self.min_delay = min_delay
+        self.budget = budget
+        self._ttft = deque(maxlen=self.WINDOW)
+        self._tokens = 0.0
+        self._threshold = min_delay
+
+    def observe_ttft(self, seconds: float):
+        self._ttft.append(seconds)
+        if len(self._ttft) >= self.MIN_SAMPLES:
+            ordered = sorted(self._ttft)
+            index = min(len(ordered) - 1, int(len(ordered) * self.percentile))
+            self._threshold = max(self.min_delay, ordered[index])
+            _hedge_threshold.set(self._threshold)
+
+    def threshold(self) -> float:
+        """Сколько ждать первого токена, прежде чем отправлять дубль"""
+        return self._threshold
+
+    def on_request(self):
+        self._tokens = min(self.MAX_TOKENS, self._tokens + self.budget)
+
+    def try_spend(self) -> bool:
+        """Можно ли отправить дубль (и списать его из бюджета)"""
+        if self._tokens < 1.0:
+            return False
+        self._tokens -= 1.0
+        return True
+
+
+class CircuitBreaker:
+    """Предохранитель: closed -> open после серии сбоев -> half_open -> closed"""
+
+    CLOSED = "closed"
+    HALF_OPEN = "half_open"
+    OPEN = "open"
+    _STATE_VALUES = {CLOSED: 0, HALF_OPEN: 1, OPEN: 2}
+
+    def __init__(self, failure_threshold: int = BREAKER_FAILURE_THRESHOLD,
+                 open_seconds: float = BREAKER_OPEN_SECONDS):
+        self.failure_threshold = failure_threshold
+        self.open_seconds = open_seconds
+        self.state = self.CLOSED
+        self.failures = 0
+        self._opened_at = 0.0
+        self._probe_in_flight = False
+        self._probe_started = 0.0
+        _breaker_state.set(0)
+
+    def _transition(self, state: str):
+        if state == self.state:
+            return
+        logger.warning(f"Предохранитель Mistral: {self.state} -> {state}", extra={"stage": "llm"})
+        self.state = state
+        _breaker_state.set(self._STATE_VALUES[state])
+        _breaker_transitions.labels(state).inc()
+
+    def allow(self) -> bool:
+        """Можно ли отправить запрос (в half_open - только один пробный)"""
+        if self.state == self.OPEN:
+            if time.monotonic() - self._opened_at < self.open_seconds:
+                _rejected_breaker_open.inc()
+                return False
+            self._transition(self.HALF_OPEN)
+
+        if self.state == self.HALF_OPEN:
+            # Пробный запрос, оборвавшийся без результата, не должен держать предохранитель вечно
+            now = time.monotonic()
+            if self._probe_in_flight and now - self._probe_started < self.open_seconds:
+                _rejected_breaker_open.inc()
+                return False
+            self._probe_in_flight = True
+            self._probe_started = now
+
+        return True
+
+    def record_success(self):
+        self.failures = 0
+        self._probe_in_flight = False
+        self._transition(self.CLOSED)
+
+    def release_probe(self):
+        """Пробный запрос не дошёл до Mistral - следующий может пробовать сразу"""
+        self._probe_in_flight = False
+
+    def record_failure(self):
+        self.failures += 1
+        self._probe_in_flight = False
+        if self.state == self.HALF_OPEN or self.failures >= self.failure_threshold:
+            self._opened_at = time.monotonic()
+            self._transition(self.OPEN)
+
+    @property
+    def degraded(self) -> bool:
+        return self.state != self.CLOSED
+
+
+class DegradedReplies:
+    """
+    Ответы, пока Mistral недоступен или бот разгружается
+
+    Недавние ответы на короткие сообщения («привет», «как дела»)
+    запоминаются по пользователю и нормализованному тексту и отдаются
+    повторно только ему же: ответ сгенерирован с его историей и
+    фактами о нём («как меня зовут?»), другим его показывать нельзя.
+    Если такого сообщения ещё не было - отвечает заготовкой.
+    """
+
+    # Длиннее этого сообщение слишком конкретное, чтобы переиспользовать ответ
+    MAX_KEY_LENGTH = 60
+
+    CANNED = [
+        "Ой… у меня голова сейчас совсем не варит 😵 Напиши чуть позже, ладно?",
+        "Подожди немного… я тут задумалась и зависла 😳",
+        "Э-э… мне нужно минутку передохнуть. Давай чуть позже? 😅",
+    ]
+
+    def __init__(self, max_size: int = DEGRADED_CACHE_SIZE):
+        self.max_size = max_size
+        self._cache: "OrderedDict[Tuple[int, str], str]" = OrderedDict()
+
+    @staticmethod
+    def _key(text: str) -> Optional[str]:
+        key = " ".join(re.sub(r"[^\w\s]", " ", text.lower()).split())
+        if not key or len(key) > DegradedReplies.MAX_KEY_LENGTH:
+            return None
+        return key
+
+    def remember(self, user_id: int, user_text: str, reply: str):
+        text_key = self._key(user_text)
+        if text_key is None:
+            return
+        key = (user_id, text_key)
+        self._cache[key] = reply
+        self._cache.move_to_end(key)
+        if len(self._cache) > self.max_size:
+            self._cache.popitem(last=False)
+
+    def reply(self, user_id: int, user_text: str) -> str:
+        key = (user_id, self._key(user_text))
+        if key in self._cache:
+            _degraded_cache.inc()
+            return self._cache[key]
+
+        _degraded_canned.inc()
+        return random.choice(self.CANNED)
+
+
+def is_throttled(error: Exception) -> bool:
+    """Ответ 429 от Mistral (SDK кладёт HTTP-статус в status_code)"""
+    return getattr(error, "status_code", None) == 429
+
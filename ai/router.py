@@ -0,0 +1,120 @@
+"""
+Выбор модели и длины ответа под сообщение
+
+Признаки дешёвые: длина сообщения, вопрос это или болтовня, уровень
+доверия и текущая загрузка Mistral. По ним набираются очки сложности
+и выбирается уровень из MODEL_TIERS (fast / standard / large). Под
+нагрузкой уровень понижается, а при перегрузке весь трафик уходит на
+самую дешёвую модель - как и запросы тех, кто почти исчерпал бюджет
+токенов (utils/token_budget.py), и обычных пользователей в режиме
+разгрузки short (ai/degradation.py).
+
+Каждое решение пишется в лог (логгер ai.router) вместе с латентностью
+и токенами ответа - по этим строкам политику можно настраивать офлайн.
+"""
+import logging
+import re
+from typing import NamedTuple, Optional
+
+from ai.scheduler import LLMScheduler
+from config import (
+    ENABLE_MODEL_ROUTING, MODEL_TIERS, ROUTING_LOAD_DOWNGRADE, ROUTING_LOAD_SHED,
+    MISTRAL_MODEL, MAX_TOKENS,
+)
+from utils.metrics import metrics
+
+logger = logging.getLogger(__name__)
+
+_routed = metrics.counter("mahiro_llm_routed_total", "Выбор уровня модели", labels=("tier", "reason"))
+
+TIER_ORDER = ("fast", "standard", "large")
+
+# Сообщение длиннее - вероятно, рассказ или сложный вопрос
+LONG_MESSAGE = 200
+SHORT_MESSAGE = 40
+
+_QUESTION_RE = re.compile(
+    r"\?|^(как|почему|зачем|что|чем|кто|где|когда|какой|какая|какие|сколько|объясни|расскажи|посоветуй)\b",
+    re.IGNORECASE,
+)
+_DEEP_RE = re.compile(r"\b(почему|объясни|расскажи|посоветуй|помоги|что думаешь|как быть)\b", re.IGNORECASE)
+
+
+class RouteDecision(NamedTuple):
+    tier: str
+    model: str
+    max_tokens: int
+    reason: str
+    length: int
+    question: bool
+    trust: float
+    load: float
+
+
+class ModelRouter:
+    """Выбирает уровень модели для запроса"""
+
+    def __init__(self, scheduler: LLMScheduler, enabled: bool = ENABLE_MODEL_ROUTING):
+        self.scheduler = scheduler
+        self.enabled = enabled
+
+    @staticmethod
+    def _complexity(text: str, question: bool, trust: float) -> int:
+        score = 0
+        if len(text) > LONG_MESSAGE:
+            score += 2
+        elif len(text) > SHORT_MESSAGE:
+            score += 1
+        if question:
+            score += 1
+        if _DEEP_RE.search(text):
+            score += 1
+        # С близкими собеседниками Махиро отвечает подробнее
+        if trust >= 0.5:
+            score += 1
+        return score
+
+    def route(self, text: str, trust: float, economy: Optional[str] = None) -> RouteDecision:
+        """
+        Args:
+            economy: причина экономного ответа (budget_soft - пользователь близок
+                к бюджету токенов, degraded - режим разгрузки) - самый дешёвый уровень
+        """
+        text = text.strip()
+        question = bool(_QUESTION_RE.search(text))
+        load = self.scheduler.utilization()
+
+        if economy:
+            model, max_tokens = MODEL_TIERS["fast"]
+            _routed.labels("fast", economy).inc()
+            return RouteDecision("fast", model, max_tokens, economy, len(text), question, trust, load)
+
+        if not self.enabled:
+            return RouteDecision("standard", MISTRAL_MODEL, MAX_TOKENS, "disabled", len(text), question, trust, load)
+
+        score = self._complexity(text, question, trust)
+        level = 0 if score <= 1 else 1 if score <= 3 else 2
+        reason = f"score={score}"
+
+        if load >= ROUTING_LOAD_SHED:
+            level, reason = 0, "load_shed"
+        elif load >= ROUTING_LOAD_DOWNGRADE and level > 0:
+            level, reason = level - 1, "load_downgrade"
+
+        tier = TIER_ORDER[level]
+        model, max_tokens = MODEL_TIERS[tier]
+        _routed.labels(tier, reason.split("=")[0]).inc()
+        return RouteDecision(tier, model, max_tokens, reason, len(text), question, trust, load)
+
+    @staticmethod
+    def log_decision(user_id: int, decision: RouteDecision, latency_ms: Optional[int], tokens: Optional[int]):
+        """Строка для офлайн-настройки: признаки, решение, латентность и токены"""
+        logger.info(
+            f"route tier={decision.tier} reason={decision.reason} len={decision.length} "
+            f"question={int(decision.question)} trust={decision.trust:.2f} load={decision.load:.2f} "
+            f"max_tokens={decision.max_tokens}",
+            extra={
+                "user_id": user_id, "stage": "route", "model": decision.model,
+                "latency_ms": latency_ms, "tokens": tokens,
+            }
+        )
@@ -0,0 +1,143 @@
+"""
+Очередь запросов к Mistral с приоритетами и честностью между пользователями
+
+Когда все слоты AdaptiveLimiter заняты, запросы ждут здесь. Свободный
+слот достаётся самому приоритетному классу (admin > donor > regular >
+background), поэтому под нагрузкой задержка у админов и донатеров
+почти не растёт. Внутри класса очередь честная между пользователями
+(weighted fair queuing): у каждого запроса есть виртуальное время
+окончания = max(время класса, прошлое время пользователя) + стоимость.
+Пользователь, отправивший десять сообщений подряд, получает метки
+дальше и дальше в будущем и не вытесняет остальных. Стоимость -
+запрошенный max_tokens относительно MAX_TOKENS, так что длинные
+ответы «стоят» дороже.
+"""
+import asyncio
+import heapq
+import itertools
+import time
+from typing import Dict, List, Tuple
+
+from ai.resilience import AdaptiveLimiter, rejected_requests
+from config import LLM_PRIORITY_CLASSES, MAX_TOKENS
+from utils.metrics import metrics, queue_depth
+
+_queue_seconds = metrics.histogram(
+    "mahiro_llm_queue_seconds", "Ожидание слота Mistral по классам", labels=("priority",)
+)
+_class_wait = {name: _queue_seconds.labels(name) for name in LLM_PRIORITY_CLASSES}
+_class_depth = {name: queue_depth.labels(f"llm_{name}") for name in LLM_PRIORITY_CLASSES}
+_queue_timeouts = rejected_requests.labels("queue_timeout")
+
+_RANKS = {name: rank for rank, name in enumerate(LLM_PRIORITY_CLASSES)}
+
+# Когда столько пользователей помнится - забываем тех, кто уже обслужен
+_PRUNE_FLOWS = 10000
+
+
+class LLMScheduler:
+    """Выдаёт слоты AdaptiveLimiter в порядке приоритета и честной очереди"""
+
+    def __init__(self, limiter: AdaptiveLimiter):
+        self.limiter = limiter
+        limiter.on_release = self._dispatch
+        # (ранг класса, виртуальное время, порядковый номер, future, класс)
+        self._heap: List[Tuple[int, float, int, asyncio.Future, str]] = []
+        self._seq = itertools.count()
+        self._virtual_time: Dict[str, float] = dict.fromkeys(LLM_PRIORITY_CLASSES, 0.0)
+        self._flow_finish: Dict[Tuple[str, int], float] = {}
+        self._waiting: Dict[str, int] = dict.fromkeys(LLM_PRIORITY_CLASSES, 0)
+
+    def waiting(self) -> int:
+        return len(self._heap)
+
+    def utilization(self) -> float:
+        """Запросы в работе и в очереди относительно текущего лимита"""
+        return (self.limiter.inflight + len(self._heap)) / int(self.limiter.limit)
+
+    def _tag(self, priority: str, user_id: int, cost: float) -> float:
+        flow = (priority, user_id)
+        start = max(self._virtual_time[priority], self._flow_finish.get(flow, 0.0))
+        finish = start + cost
+        self._flow_finish[flow] = finish
+
+        if len(self._flow_finish) > _PRUNE_FLOWS:
+            self._flow_finish = {
+                key: tag for key, tag in self._flow_finish.items()
+                if tag > self._virtual_time[key[0]]
+            }
+        return finish
+
+    def _set_waiting(self, priority: str, delta: int):
+        self._waiting[priority] += delta
+        _class_depth[priority].set(self._waiting[priority])
+
+    def _forget(self, entry: Tuple):
+        """Убирает из очереди ушедшего по таймауту или отмене"""
+        try:
+            self._heap.remove(entry)
+        except ValueError:
+            return
+        heapq.heapify(self._heap)
+        self._set_waiting(entry[4], -1)
+
+    def _give_back(self, entry: Tuple):
+        """
+        Ждущий ушёл (таймаут или отмена): убирает его из очереди,
+        а если слот ему уже успели выдать - отдаёт слот следующему
+        """
+        future = entry[3]
+        if future.done() and not future.cancelled():
+            self.limiter.release(None)
+        else:
+            self._forget(entry)
+
+    def _dispatch(self):
+        """Раздаёт освободившиеся слоты ожидающим"""
+        while self._heap and self.limiter.has_capacity():
+            _, tag, _, future, priority = heapq.heappop(self._heap)
+            self._set_waiting(priority, -1)
+            if future.done():
+                # Ждущий уже ушёл по таймауту или отмене, но _forget ещё не успел
+                continue
+            self._virtual_time[priority] = tag
+            self.limiter.take()
+            future.set_result(None)
+
+    async def acquire(self, user_id: int, priority: str, max_tokens: int, timeout: float) -> bool:
+        """
+        Ждёт слот для запроса
+
+        Returns:
+            True - слот выдан (его нужно вернуть через limiter.release),
+            False - не дождались за timeout
+        """
+        if priority not in _RANKS:
+            priority = "regular"
+        started = time.perf_counter()
+        tag = self._tag(priority, user_id, max_tokens / MAX_TOKENS)
+
+        if not self._heap and self.limiter.has_capacity():
+            self._virtual_time[priority] = tag
+            self.limiter.take()
+            _class_wait[priority].observe(0.0)
+            return True
+
+        future = asyncio.get_running_loop().create_future()
+        entry = (_RANKS[priority], tag, next(self._seq), future, priority)
+        heapq.heappush(self._heap, entry)
+        self._set_waiting(priority, 1)
+
+        try:
+            await asyncio.wait_for(future, timeout)
+        except asyncio.TimeoutError:
+            self._give_back(entry)
+            _queue_timeouts.inc()
+            return False
+        except asyncio.CancelledError:
+            self._give_back(entry)
+            raise
+        finally:
+            _class_wait[priority].observe(time.perf_counter() - started)
+
+        return True
@@ -177,38 +177,48 @@ class TriggerSystem:
         Returns:
             Специальная реакция или None
         """
+        match = self.match_trigger(text, trust_level)
+        return match[1] if match else None
+
+    def match_trigger(self, text: str, trust_level: float) -> Optional[Tuple[str, str]]:
+        """
+        Как check_triggers, но возвращает и сработавший триггер
+
+        Returns:
+            (триггер, реакция) или None
+        """
         text_lower = text.lower()
 
         # Приоритет 1: Метатриггеры (про ИИ)
         for trigger, responses in self.meta_triggers.items():
             if trigger in text_lower:
                 logger.info(f"Meta trigger activated: {trigger}")
-                return random.choice(responses)
+                return trigger, random.choice(responses)
 
         # Приоритет 2: Триггеры персонажей
         for trigger, responses in self.character_triggers.items():
             if trigger in text_lower:
                 logger.info(f"Character trigger activated: {trigger}")
-                return random.choice(responses)
+                return trigger, random.choice(responses)
 
         # Приоритет 3: Триггеры внешности (только если доверие >= 0.3)
         if trust_level >= 0.3:
             for trigger, responses in self.appearance_triggers.items():
                 if trigger in text_lower:
                     logger.info(f"Appearance trigger activated: {trigger}")
-                    return random.choice(responses)
+                    return trigger, random.choice(responses)
 
         # Приоритет 4: Триггеры состояния
         for trigger, responses in self.state_triggers.items():
             if trigger in text_lower:
                 logger.info(f"State trigger activated: {trigger}")
-                return random.choice(responses)
+                return trigger, random.choice(responses)
 
         # Приоритет 5: Триггеры активностей
         for trigger, responses in self.activity_triggers.items():
             if trigger in text_lower:
                 logger.info(f"Activity trigger activated: {trigger}")
-                return random.choice(responses)
+                return trigger, random.choice(responses)
 
         return None
 
@@ -0,0 +1,129 @@
+"""
+Бенчмарк хеджирования запросов к Mistral на локальном фейковом сервере
+
+Поднимает aiohttp-сервер, отвечающий на /v1/chat/completions потоком
+в формате Mistral (SSE). Время до первого токена берётся из
+распределения: обычно логнормальное вокруг --ttft, а в доле --tail
+запросов - задержка --tail-delay (тот самый «хвост»). Затем гоняет
+MistralClient без хеджирования и с ним и печатает перцентили
+латентности и долю дублей.
+
+Запуск:
+    python bench_llm_hedging.py [--requests 400] [--concurrency 16] [--tail 0.05]
+"""
+import argparse
+import asyncio
+import json
+import random
+import time
+
+from aiohttp import web
+from mistralai import Mistral
+
+from ai.mistral_client import MistralClient
+from ai.resilience import HedgePolicy
+
+REPLY_WORDS = ["Э-э…", "привет!", "я", "тут", "немного", "задумалась", "😳"]
+
+
+def make_app(ttft: float, tail: float, tail_delay: float, stats: dict) -> web.Application:
+    async def chat_completions(request: web.Request) -> web.StreamResponse:
+        body = await request.json()
+        stats["upstream"] += 1
+
+        delay = tail_delay if random.random() < tail else random.lognormvariate(0, 0.3) * ttft
+        response = web.StreamResponse(headers={"Content-Type": "text/event-stream"})
+        await response.prepare(request)
+        await asyncio.sleep(delay)
+
+        try:
+            for i, word in enumerate(REPLY_WORDS):
+                last = i == len(REPLY_WORDS) - 1
+                chunk = {
+                    "id": "bench",
+                    "object": "chat.completion.chunk",
+                    "created": int(time.time()),
+                    "model": body["model"],
+                    "choices": [{"index": 0, "delta": {"content": word + " "}, "finish_reason": "stop" if last else None}],
+                }
+                if last:
+                    chunk["usage"] = {"prompt_tokens": 50, "completion_tokens": len(REPLY_WORDS), "total_tokens": 57}
+                await response.write(f"data: {json.dumps(chunk, ensure_ascii=False)}\n\n".encode())
+                await asyncio.sleep(0.005)
+
+            await response.write(b"data: [DONE]\n\n")
+        except ConnectionResetError:
+            # Клиент отменил проигравший дубль
+            pass
+        return response
+
+    app = web.Application()
+    app.router.add_post("/v1/chat/completions", chat_completions)
+    return app
+
+
+def percentile(values, q):
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(len(ordered) * q))]
+
+
+async def run(client: MistralClient, requests: int, concurrency: int) -> list:
+    semaphore = asyncio.Semaphore(concurrency)
+    latencies = []
+
+    async def one(i):
+        async with semaphore:
+            started = time.perf_counter()
+            reply = await client.generate_response("Ты Махиро.", [], f"привет {i}")
+            if reply:
+                latencies.append(time.perf_counter() - started)
+
+    await asyncio.gather(*(one(i) for i in range(requests)))
+    return latencies
+
+
+async def main():
+    parser = argparse.ArgumentParser(description="Бенчмарк хеджирования запросов к Mistral")
+    parser.add_argument("--requests", type=int, default=400)
+    parser.add_argument("--concurrency", type=int, default=16)
+    parser.add_argument("--ttft", type=float, default=0.15, help="типичное время до первого токена, с")
+    parser.add_argument("--tail", type=float, default=0.05, help="доля медленных ответов")
+    parser.add_argument("--tail-delay", type=float, default=2.0, help="задержка медленного ответа, с")
+    parser.add_argument("--percentile", type=float, default=0.95, help="перцентиль TTFT для порога хеджирования")
+    parser.add_argument("--min-delay", type=float, default=0.2, help="нижняя граница порога хеджирования, с")
+    parser.add_argument("--budget", type=float, default=0.15, help="доля запросов, которые можно продублировать")
+    parser.add_argument("--port", type=int, default=8765)
+    args = parser.parse_args()
+
+    stats = {"upstream": 0}
+    runner = web.AppRunner(make_app(args.ttft, args.tail, args.tail_delay, stats))
+    await runner.setup()
+    await web.TCPSite(runner, "127.0.0.1", args.port).start()
+
+    try:
+        for hedging in (False, True):
+            client = MistralClient()
+            client.client = Mistral(api_key="bench", server_url=f"http://127.0.0.1:{args.port}")
+            client.limiter.limit = client.limiter.max_limit = args.concurrency
+            # Без хеджирования - тот же потоковый путь с нулевым бюджетом, чтобы сравнение было честным
+            client.hedging = True
+            client.hedge_policy = HedgePolicy(
+                percentile=args.percentile, min_delay=args.min_delay, budget=args.budget if hedging else 0.0
+            )
+
+            stats["upstream"] = 0
+            latencies = await run(client, args.requests, args.concurrency)
+            p50, p95, p99 = (percentile(latencies, q) for q in (0.5, 0.95, 0.99))
+            extra = stats["upstream"] / args.requests - 1
+            print(
+                f"{'с хеджированием' if hedging else 'без хеджирования'}: "
+                f"p50 {p50 * 1000:.0f} мс, p95 {p95 * 1000:.0f} мс, p99 {p99 * 1000:.0f} мс, "
+                f"ответов {len(latencies)}/{args.requests}, лишних запросов {extra:.1%}, "
+                f"порог {client.hedge_policy.threshold() * 1000:.0f} мс"
+            )
+    finally:
+        await runner.cleanup()
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
@@ -0,0 +1,93 @@
+"""
+Проверка очереди к Mistral: таймаут и отмена ждущего в гонке с освобождением слота
+
+Слот держит один запрос, второй ждёт в LLMScheduler. Освобождение
+слота приходит в момент таймаута (или отмены) ждущего и несколько
+итераций цикла событий до и после него - так перебираются все порядки,
+в которых они могут встретиться. После каждого прогона проверяется,
+что освобождающий запрос не упал, очередь пуста и ни один слот не
+потерян (inflight == 0). Печатает число прогонов и расхождения.
+
+Запуск:
+    python bench_llm_scheduler.py [--rounds 200]
+"""
+import argparse
+import asyncio
+
+from ai.resilience import AdaptiveLimiter
+from ai.scheduler import LLMScheduler
+from config import MAX_TOKENS
+
+TIMEOUT = 0.01
+# Сколько итераций цикла событий отделяет освобождение от таймаута
+SHIFTS = range(-3, 8)
+
+
+async def _yield(times: int):
+    for _ in range(times):
+        await asyncio.sleep(0)
+
+
+async def _race(mode: str, shift: int) -> list:
+    """Один прогон; возвращает список найденных проблем"""
+    limiter = AdaptiveLimiter(min_limit=1, max_limit=1, initial=1)
+    scheduler = LLMScheduler(limiter)
+    problems = []
+
+    assert await scheduler.acquire(1, "regular", MAX_TOKENS, TIMEOUT)
+    waiter = asyncio.create_task(scheduler.acquire(2, "regular", MAX_TOKENS, TIMEOUT))
+    await asyncio.sleep(0)
+
+    if mode == "timeout":
+        await asyncio.sleep(TIMEOUT if shift >= 0 else TIMEOUT / 2)
+        await _yield(max(shift, 0))
+    else:
+        if shift >= 0:
+            waiter.cancel()
+        await _yield(abs(shift))
+
+    try:
+        limiter.release(None)
+    except Exception as e:
+        problems.append(f"освобождение упало: {type(e).__name__}")
+
+    if mode == "cancel" and shift < 0:
+        waiter.cancel()
+
+    try:
+        acquired = await waiter
+    except asyncio.CancelledError:
+        acquired = False
+    if acquired:
+        limiter.release(None)
+
+    if limiter.inflight != 0:
+        problems.append(f"inflight={limiter.inflight}")
+    if scheduler.waiting():
+        problems.append(f"в очереди осталось {scheduler.waiting()}")
+    return problems
+
+
+async def main():
+    parser = argparse.ArgumentParser(description="Гонки таймаута и отмены в очереди к Mistral")
+    parser.add_argument("--rounds", type=int, default=200)
+    args = parser.parse_args()
+
+    failed = 0
+    for mode in ("timeout", "cancel"):
+        runs = 0
+        for _ in range(args.rounds):
+            for shift in SHIFTS:
+                runs += 1
+                problems = await _race(mode, shift)
+                if problems:
+                    failed += 1
+                    print(f"    ✗ {mode}, сдвиг {shift}: {', '.join(problems)}")
+        print(f"{mode}: {runs} прогонов")
+
+    print("ок" if not failed else f"проблем: {failed}")
+    raise SystemExit(1 if failed else 0)
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
@@ -0,0 +1,156 @@
+"""
+Бенчмарк анализа настроения и сверка с прежним поиском подстрок
+
+Ожидаемое настроение для каждого сообщения корпуса даёт прежняя
+реализация (legacy_analyze). Словарь (memory/mood_lexicon.py) должен
+совпадать с ней везде, кроме INTENDED_CHANGES: совпадений внутри
+чужих слов и отрицания «не». Печатает расхождения и время на сообщение.
+
+Запуск:
+    python bench_mood_analysis.py [--repeat 2000]
+"""
+import argparse
+import time
+
+from memory.mood_system import MoodSystem
+
+# (текст, доверие)
+CORPUS = [
+    # Комплименты
+    ("ты такая милая", 0.5),
+    ("Махиро, я тебя люблю!", 0.6),
+    ("ты мне нравишься", 0.4),
+    ("какая ты красивая сегодня", 0.8),
+    ("ты умница, спасибо", 0.5),
+    ("это было офигенно", 0.9),
+    ("ты крутая", 0.7),
+    ("супер, спасибо тебе", 0.5),
+    ("ты классная", 0.1),
+    ("хорошая девочка", 0.4),
+    ("ты милый", 0.8),
+    ("круто", 0.8),
+    ("хорошо, пока", 0.8),
+    ("ладно, хорошо", 0.8),
+    ("не знаю, хорошо ли это", 0.8),
+    ("я люблю тебя, Махиро", 0.2),
+    ("ты тупая, но милая", 0.6),
+    # Грубость
+    ("ты тупая", 0.5),
+    ("заткнись уже", 0.9),
+    ("какая же ты дура", 0.2),
+    ("ну ты и дурак", 0.5),
+    ("отстань от меня", 0.5),
+    ("ты идиотка", 0.5),
+    ("достала, честно", 0.5),
+    ("глупая железка", 0.3),
+    ("ты плохая", 0.5),
+    # Грусть
+    ("мне сегодня грустно", 0.7),
+    ("так одиноко вечером", 0.9),
+    ("мне плохо", 0.6),
+    ("у меня был плохой день", 0.8),
+    ("плохие новости", 0.8),
+    ("плохое настроение", 0.8),
+    ("печально всё это", 0.8),
+    ("скучно дома", 0.6),
+    ("мне грустно", 0.2),
+    ("грущу", 0.8),
+    # Ловушки подстрок и отрицание
+    ("мне не грустно, всё ок", 0.8),
+    ("это неплохо получилось", 0.8),
+    ("неплохой фильм вчера посмотрел", 0.8),
+    ("смотрел передачу про дураков на дорогах", 0.5),
+    ("у меня есть дурацкая привычка", 0.5),
+    ("купил суперклей", 0.5),
+    ("сегодня была скучнейшая лекция", 0.8),
+    ("я тебя не люблю", 0.8),
+    ("ты не глупая", 0.5),
+    # Нейтральное
+    ("привет, как дела?", 0.5),
+    ("что посоветуешь посмотреть?", 0.5),
+    ("сегодня ходил в магазин", 0.5),
+    ("расскажи про себя", 0.5),
+    ("а какая у тебя любимая еда?", 0.5),
+    ("любишь ли ты пельмени?", 0.5),
+    ("ок", 0.5),
+]
+
+# Намеренные отличия от поиска подстрок: {текст: настроение по словарю}
+INTENDED_CHANGES = {
+    # «плохо» внутри «неплохо» / «неплохой»
+    "это неплохо получилось": None,
+    "неплохой фильм вчера посмотрел": None,
+    # «дура» внутри «дураков», «дурацкая»
+    "смотрел передачу про дураков на дорогах": None,
+    "у меня есть дурацкая привычка": None,
+    # «супер» внутри «суперклей»
+    "купил суперклей": None,
+    # Отрицание
+    "мне не грустно, всё ок": None,
+    "я тебя не люблю": "раздражённая",
+    "ты не глупая": "счастливая",
+}
+
+
+def legacy_analyze(text: str, trust_level: float):
+    """Прежняя реализация: any(подстрока in text.lower()) по трём спискам"""
+    text_lower = text.lower()
+    positive = ["люблю", "нравишься", "классная", "милая", "красивая",
+                "хорошая", "умная", "крутая", "супер", "офигенная"]
+    negative = ["тупая", "глупая", "дура", "идиот", "плохая", "отстань", "заткнись", "достала"]
+    sad = ["грустно", "плохо", "печально", "одиноко", "скучно"]
+
+    if any(t in text_lower for t in positive) and trust_level > 0.3:
+        return "счастливая"
+    if any(t in text_lower for t in negative):
+        return "раздражённая"
+    if any(t in text_lower for t in sad) and trust_level > 0.5:
+        return "грустная"
+    if len(text.strip()) < 3:
+        return "раздражённая"
+    if len(text) > 500:
+        return "взволнованная"
+    return None
+
+
+def expected_mood(text: str, trust: float):
+    if text in INTENDED_CHANGES:
+        return INTENDED_CHANGES[text]
+    return legacy_analyze(text, trust)
+
+
+def evaluate(name: str, analyze, repeat: int):
+    correct = 0
+    misses = []
+    for text, trust in CORPUS:
+        expected = expected_mood(text, trust)
+        got = analyze(text, trust)
+        if got == expected:
+            correct += 1
+        else:
+            misses.append((text, expected, got))
+
+    started = time.perf_counter()
+    for _ in range(repeat):
+        for text, trust in CORPUS:
+            analyze(text, trust)
+    per_message = (time.perf_counter() - started) / (repeat * len(CORPUS)) * 1e6
+
+    print(f"{name}: совпадает {correct}/{len(CORPUS)}, {per_message:.1f} мкс/сообщение")
+    for text, expected, got in misses:
+        print(f"    ✗ «{text}»: ожидалось {expected}, получено {got}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Бенчмарк анализа настроения")
+    parser.add_argument("--repeat", type=int, default=2000)
+    args = parser.parse_args()
+
+    mood_system = MoodSystem()
+    evaluate("подстроки (было)", legacy_analyze, args.repeat)
+    evaluate("словарь (стало)", mood_system._analyze_message, args.repeat)
+    print(f"намеренных отличий: {len(INTENDED_CHANGES)}")
+
+
+if __name__ == "__main__":
+    main()
@@ -5,15 +5,25 @@ from aiogram.fsm.context import FSMContext
 from aiogram.fsm.state import State, StatesGroup
 from pathlib import Path
 from datetime import datetime
+import asyncio
 import logging
 
 from bot.filters import IsAdmin
-from utils.services import statistics, user_tracker, trust_system, mood_system, memory, rate_limiter
+from bot.outbound import bulk_sends
+from config import LOG_FILE, LOG_ARCHIVE_DIR
+from utils.log_files import LOG_LEVELS, tail_lines, search_logs, parse_since, format_line
+from utils.services import statistics, user_tracker, trust_system, mood_system, memory, rate_limiter, activity_rollup, conversation_archive, acl
 
 logger = logging.getLogger(__name__)
 
 router = Router()
 
+# /logs: сколько строк показывать без аргументов и сколько совпадений при поиске
+LOGS_TAIL_LINES = 20
+LOGS_SEARCH_LIMIT = 30
+# /search: сколько реплик архива показывать
+SEARCH_RESULTS_LIMIT = 10
+
 
 # FSM для добавления/удаления пользователей
 class AdminStates(StatesGroup):
@@ -41,16 +51,10 @@ def get_main_admin_menu() -> InlineKeyboardMarkup:
 
 def get_whitelist_menu() -> InlineKeyboardMarkup:
     """Меню Whitelist"""
-    # Читаем напрямую из .env
-    import os
-    from dotenv import load_dotenv
-    load_dotenv()
-    
-    enable_whitelist = os.getenv("ENABLE_WHITELIST", "false").lower() == "true"
-    whitelist_ids_str = os.getenv("WHITELIST_USER_IDS", "")
-    whitelist_count = len([x for x in whitelist_ids_str.split(",") if x.strip()])
+    snapshot = acl.snapshot
+    whitelist_count = len(snapshot.whitelist)
     
-    status = "✅ Вкл" if enable_whitelist else "❌ Выкл"
+    status = "✅ Вкл" if snapshot.whitelist_enabled else "❌ Выкл"
     
     keyboard = [
         [InlineKeyboardButton(text=f"🔐 Whitelist: {status}", callback_data="admin_toggle_whitelist")],
@@ -64,12 +68,7 @@ def get_whitelist_menu() -> InlineKeyboardMarkup:
 
 def get_blacklist_menu() -> InlineKeyboardMarkup:
     """Меню Blacklist"""
-    import os
-    from dotenv import load_dotenv
-    load_dotenv()
-    
-    blacklist_ids_str = os.getenv("BLACKLIST_USER_IDS", "")
-    blacklist_count = len([x for x in blacklist_ids_str.split(",") if x.strip()])
+    blacklist_count = len(acl.snapshot.blacklist)
     
     keyboard = [
         [InlineKeyboardButton(text="➕ Добавить в Blacklist", callback_data="admin_blacklist_add")],
@@ -164,13 +163,7 @@ async def admin_users_list(callback: CallbackQuery):
     """Список всех пользователей"""
     users = await user_tracker.get_all_users()
     
-    import os
-    from dotenv import load_dotenv
-    load_dotenv()
-    
-    admin_ids = [int(x) for x in os.getenv("ADMIN_USER_IDS", "").split(",") if x.strip()]
-    whitelist_ids = [int(x) for x in os.getenv("WHITELIST_USER_IDS", "").split(",") if x.strip()]
-    blacklist_ids = [int(x) for x in os.getenv("BLACKLIST_USER_IDS", "").split(",") if x.strip()]
+    snapshot = acl.snapshot
     
     if not users:
         text = "📭 Пользователей пока нет"
@@ -187,11 +180,11 @@ async def admin_users_list(callback: CallbackQuery):
             blocked = user.get('blocked_messages', 0)
             
             status = []
-            if user_id in admin_ids:
+            if user_id in snapshot.admins:
                 status.append("👑")
-            if user_id in whitelist_ids:
+            if user_id in snapshot.whitelist:
                 status.append("✅")
-            if user_id in blacklist_ids:
+            if user_id in snapshot.blacklist:
                 status.append("🚫")
             
             status_str = " ".join(status) if status else "👤"
@@ -243,15 +236,10 @@ async def admin_blocked_users(callback: CallbackQuery):
 @router.callback_query(F.data == "admin_whitelist_menu", IsAdmin())
 async def admin_whitelist_menu(callback: CallbackQuery):
     """Меню Whitelist"""
-    import os
-    from dotenv import load_dotenv
-    load_dotenv()
-    
-    enable_whitelist = os.getenv("ENABLE_WHITELIST", "false").lower() == "true"
-    whitelist_ids_str = os.getenv("WHITELIST_USER_IDS", "")
-    whitelist_count = len([x for x in whitelist_ids_str.split(",") if x.strip()])
+    snapshot = acl.snapshot
+    whitelist_count = len(snapshot.whitelist)
     
-    status = "✅ Включён" if enable_whitelist else "❌ Выключен"
+    status = "✅ Включён" if snapshot.whitelist_enabled else "❌ Выключен"
     
     text = f"""🔐 УПРАВЛЕНИЕ WHITELIST
 
@@ -271,12 +259,7 @@ async def admin_whitelist_menu(callback: CallbackQuery):
 @router.callback_query(F.data == "admin_blacklist_menu", IsAdmin())
 async def admin_blacklist_menu(callback: CallbackQuery):
     """Меню Blacklist"""
-    import os
-    from dotenv import load_dotenv
-    load_dotenv()
-    
-    blacklist_ids_str = os.getenv("BLACKLIST_USER_IDS", "")
-    blacklist_count = len([x for x in blacklist_ids_str.split(",") if x.strip()])
+    blacklist_count = len(acl.snapshot.blacklist)
     
     text = f"""🚫 УПРАВЛЕНИЕ BLACKLIST
 
@@ -294,15 +277,10 @@ async def admin_blacklist_menu(callback: CallbackQuery):
 @router.callback_query(F.data == "admin_list_whitelist", IsAdmin())
 async def admin_list_whitelist(callback: CallbackQuery):
     """Показать список Whitelist"""
-    import os
-    from dotenv import load_dotenv
-    load_dotenv()
-    
-    enable_whitelist = os.getenv("ENABLE_WHITELIST", "false").lower() == "true"
-    whitelist_ids_str = os.getenv("WHITELIST_USER_IDS", "")
-    whitelist_ids = [int(x) for x in whitelist_ids_str.split(",") if x.strip()]
+    snapshot = acl.snapshot
+    whitelist_ids = sorted(snapshot.whitelist)
     
-    if not enable_whitelist:
+    if not snapshot.whitelist_enabled:
         text = "❌ Whitelist выключен\n\nВсе пользователи имеют доступ к боту."
     elif not whitelist_ids:
         text = "⚠️ Whitelist пуст\n\nТолько админы могут пользоваться ботом."
@@ -325,12 +303,7 @@ async def admin_list_whitelist(callback: CallbackQuery):
 @router.callback_query(F.data == "admin_list_blacklist", IsAdmin())
 async def admin_list_blacklist(callback: CallbackQuery):
     """Показать список Blacklist"""
-    import os
-    from dotenv import load_dotenv
-    load_dotenv()
-    
-    blacklist_ids_str = os.getenv("BLACKLIST_USER_IDS", "")
-    blacklist_ids = [int(x) for x in blacklist_ids_str.split(",") if x.strip()]
+    blacklist_ids = sorted(acl.snapshot.blacklist)
     
     if not blacklist_ids:
         text = "✅ Blacklist пуст\n\nНет заблокированных пользователей."
@@ -379,13 +352,10 @@ async def process_whitelist_add(message: Message, state: FSMContext):
         await message.answer("❌ ID должен быть числом! Попробуйте ещё раз или /cancel")
         return
     
-    result = await update_env_list("WHITELIST_USER_IDS", user_id, action="add")
+    result = await acl.add("whitelist", user_id)
     
     if result:
-        await message.answer(
-            f"✅ Пользователь {user_id} добавлен в Whitelist!\n\n"
-            f"⚠️ ВАЖНО: Теперь выполни команду /reload_config для применения изменений"
-        )
+        await message.answer(f"✅ Пользователь {user_id} добавлен в Whitelist!")
         logger.info(f"Admin {message.from_user.id} added {user_id} to whitelist")
     else:
         await message.answer(f"ℹ️ Пользователь {user_id} уже в whitelist")
@@ -421,13 +391,10 @@ async def process_whitelist_remove(message: Message, state: FSMContext):
         await message.answer("❌ ID должен быть числом!")
         return
     
-    result = await update_env_list("WHITELIST_USER_IDS", user_id, action="remove")
+    result = await acl.remove("whitelist", user_id)
     
     if result:
-        await message.answer(
-            f"✅ Пользователь {user_id} удалён из Whitelist!\n\n"
-            f"⚠️ ВАЖНО: Выполни /reload_config для применения"
-        )
+        await message.answer(f"✅ Пользователь {user_id} удалён из Whitelist!")
         logger.info(f"Admin {message.from_user.id} removed {user_id} from whitelist")
     else:
         await message.answer(f"ℹ️ Пользователь {user_id} не найден в whitelist")
@@ -463,13 +430,10 @@ async def process_blacklist_add(message: Message, state: FSMContext):
         await message.answer("❌ ID должен быть числом!")
         return
     
-    result = await update_env_list("BLACKLIST_USER_IDS", user_id, action="add")
+    result = await acl.add("blacklist", user_id)
     
     if result:
-        await message.answer(
-            f"✅ Пользователь {user_id} добавлен в Blacklist!\n\n"
-            f"⚠️ ВАЖНО: Выполни /reload_config для применения"
-        )
+        await message.answer(f"✅ Пользователь {user_id} добавлен в Blacklist!")
         logger.info(f"Admin {message.from_user.id} added {user_id} to blacklist")
     else:
         await message.answer(f"ℹ️ Пользователь {user_id} уже в blacklist")
@@ -505,13 +469,10 @@ async def process_blacklist_remove(message: Message, state: FSMContext):
         await message.answer("❌ ID должен быть числом!")
         return
     
-    result = await update_env_list("BLACKLIST_USER_IDS", user_id, action="remove")
+    result = await acl.remove("blacklist", user_id)
     
     if result:
-        await message.answer(
-            f"✅ Пользователь {user_id} удалён из Blacklist!\n\n"
-            f"⚠️ ВАЖНО: Выполни /reload_config для применения"
-        )
+        await message.answer(f"✅ Пользователь {user_id} удалён из Blacklist!")
         logger.info(f"Admin {message.from_user.id} removed {user_id} from blacklist")
     else:
         await message.answer(f"ℹ️ Пользователь {user_id} не найден в blacklist")
@@ -522,42 +483,22 @@ async def process_blacklist_remove(message: Message, state: FSMContext):
 @router.callback_query(F.data == "admin_toggle_whitelist", IsAdmin())
 async def admin_toggle_whitelist(callback: CallbackQuery):
     """Переключить Whitelist"""
-    env_file = Path(".env")
-    
-    if not env_file.exists():
-        await callback.answer("❌ Файл .env не найден!", show_alert=True)
-        return
+    enabled = await acl.toggle_whitelist()
     
-    with open(env_file, 'r', encoding='utf-8') as f:
-        lines = f.readlines()
-    
-    found = False
-    for i, line in enumerate(lines):
-        if line.startswith("ENABLE_WHITELIST="):
-            current = line.split("=", 1)[1].strip().lower()
-            new_value = "false" if current == "true" else "true"
-            lines[i] = f"ENABLE_WHITELIST={new_value}\n"
-            found = True
-            break
-    
-    if not found:
-        lines.append("ENABLE_WHITELIST=true\n")
-    
-    with open(env_file, 'w', encoding='utf-8') as f:
-        f.writelines(lines)
-    
-    await callback.answer("✅ Настройка изменена! Выполни /reload_config", show_alert=True)
+    await callback.answer("✅ Whitelist включён" if enabled else "✅ Whitelist выключен", show_alert=True)
+    logger.info(f"Admin {callback.from_user.id} set whitelist enabled={enabled}")
     await admin_whitelist_menu(callback)
 
 
 @router.message(Command("reload_config"), IsAdmin())
 async def cmd_reload_config(message: Message):
-    """Перезагрузка конфигурации"""
-    import importlib
-    import config
-    importlib.reload(config)
+    """Перечитать списки доступа из data/acl.json (после ручной правки файла)"""
+    snapshot = await acl.reload()
     
-    await message.answer("✅ Конфигурация перезагружена!\n\nWhitelist/Blacklist обновлены.")
+    await message.answer(
+        "✅ Списки доступа перечитаны!\n\n"
+        f"Whitelist: {len(snapshot.whitelist)} | Blacklist: {len(snapshot.blacklist)}"
+    )
     logger.info(f"Config reloaded by admin {message.from_user.id}")
 
 
@@ -600,14 +541,16 @@ async def process_broadcast(message: Message, state: FSMContext):
     success = 0
     failed = 0
     
-    for user in users:
-        user_id = user['user_id']
-        try:
-            await message.bot.send_message(user_id, broadcast_text)
-            success += 1
-        except Exception as e:
-            failed += 1
-            logger.warning(f"Failed to send broadcast to {user_id}: {e}")
+    # Рассылка уступает ответам собеседникам и не выходит за лимиты Telegram
+    with bulk_sends():
+        for user in users:
+            user_id = user['user_id']
+            try:
+                await message.bot.send_message(user_id, broadcast_text)
+                success += 1
+            except Exception as e:
+                failed += 1
+                logger.warning(f"Failed to send broadcast to {user_id}: {e}")
     
     # Результат
     result_text = (
@@ -655,85 +598,40 @@ async def admin_images_stats(callback: CallbackQuery):
     await callback.answer()
 
 
-async def update_env_list(key: str, user_id: int, action: str) -> bool:
-    """Обновляет список в .env файле"""
-    env_file = Path(".env")
-    
-    if not env_file.exists():
-        return False
-    
-    with open(env_file, 'r', encoding='utf-8') as f:
-        lines = f.readlines()
-    
-    line_index = None
-    current_ids = []
-    
-    for i, line in enumerate(lines):
-        if line.startswith(f"{key}="):
-            line_index = i
-            ids_str = line.split("=", 1)[1].strip()
-            if ids_str:
-                current_ids = [int(x) for x in ids_str.split(",") if x.strip()]
-            break
-    
-    if action == "add":
-        if user_id in current_ids:
-            return False
-        current_ids.append(user_id)
-    elif action == "remove":
-        if user_id not in current_ids:
-            return False
-        current_ids.remove(user_id)
-    
-    new_ids_str = ",".join(map(str, current_ids))
-    
-    if line_index is not None:
-        lines[line_index] = f"{key}={new_ids_str}\n"
-    else:
-        lines.append(f"{key}={new_ids_str}\n")
-    
-    with open(env_file, 'w', encoding='utf-8') as f:
-        f.writelines(lines)
-    
-    return True
-
-
 # ========== НОВЫЕ РАСШИРЕННЫЕ ФУНКЦИИ ==========
 
 @router.callback_query(F.data == "admin_detailed_stats", IsAdmin())
 async def admin_detailed_stats(callback: CallbackQuery):
-    """Подробная статистика"""
-    from utils.user_tracker import UserTracker
-    from memory.mood_system import MoodSystem
-    
-    tracker = UserTracker()
-    mood_system = MoodSystem()
-    
-    users = await tracker.get_all_users()
-    
-    # Анализ по дням недели
-    from datetime import datetime
-    import collections
+    """Подробная статистика (по агрегатам активности за 7 дней)"""
+    from utils.activity_rollup import WEEKDAYS
     
-    weekday_activity = collections.Counter()
-    hour_activity = collections.Counter()
-    
-    for user in users:
-        last_seen = datetime.fromisoformat(user.get('last_seen', datetime.now().isoformat()))
-        weekday_activity[last_seen.strftime("%A")] += 1
-        hour_activity[last_seen.hour] += 1
+    activity = await activity_rollup.query_last(days=7)
+    users = await user_tracker.get_all_users()
     
     # Топ-5 активных часов
-    top_hours = sorted(hour_activity.items(), key=lambda x: x[1], reverse=True)[:5]
+    top_hours = sorted(enumerate(activity["by_hour"]), key=lambda x: x[1], reverse=True)[:5]
+    
+    text = "📊 ПОДРОБНАЯ СТАТИСТИКА (7 дней)\n\n"
+    text += f"💬 Сообщений: {activity['total']}\n"
     
-    text = "📊 ПОДРОБНАЯ СТАТИСТИКА\n\n"
-    text += f"📅 Активность по дням:\n"
-    for day, count in weekday_activity.most_common(7):
-        text += f"  {day}: {count}\n"
+    text += f"\n📅 Активность по дням:\n"
+    for weekday, count in enumerate(activity["by_weekday"]):
+        text += f"  {WEEKDAYS[weekday]}: {count}\n"
     
     text += f"\n⏰ Топ-5 активных часов:\n"
     for hour, count in top_hours:
-        text += f"  {hour}:00 - {count} польз.\n"
+        if count > 0:
+            text += f"  {hour}:00 - {count} сообщ.\n"
+    
+    if activity["by_mood"]:
+        text += f"\n😊 По настроениям:\n"
+        for mood, count in sorted(activity["by_mood"].items(), key=lambda x: x[1], reverse=True):
+            text += f"  {mood}: {count}\n"
+    
+    if activity["by_trigger"]:
+        text += f"\n🎯 Топ триггеров:\n"
+        for trigger, count in sorted(activity["by_trigger"].items(), key=lambda x: x[1], reverse=True)[:5]:
+            text += f"  {trigger}: {count}\n"
     
     text += f"\n💬 Средняя длина диалога: "
     avg_messages = sum(u.get('message_count', 0) for u in users) / max(len(users), 1)
@@ -748,6 +646,7 @@ async def admin_export_data(callback: CallbackQuery):
     """Экспорт данных"""
     keyboard = [
         [InlineKeyboardButton(text="💾 Полный бэкап (ZIP)", callback_data="export_full")],
+        [InlineKeyboardButton(text="🧩 Инкрементальный бэкап", callback_data="export_incremental")],
         [InlineKeyboardButton(text="📊 CSV пользователей", callback_data="export_csv")],
         [InlineKeyboardButton(text="📈 JSON статистика", callback_data="export_json")],
         [InlineKeyboardButton(text="« Назад", callback_data="admin_settings")],
@@ -765,27 +664,38 @@ async def admin_export_data(callback: CallbackQuery):
 @router.callback_query(F.data == "export_full", IsAdmin())
 async def export_full_backup(callback: CallbackQuery):
     """Полный бэкап"""
+    await send_backup(callback, incremental=False)
+
+
+@router.callback_query(F.data == "export_incremental", IsAdmin())
+async def export_incremental_backup(callback: CallbackQuery):
+    """Инкрементальный бэкап (только изменения с прошлого бэкапа)"""
+    await send_backup(callback, incremental=True)
+
+
+async def send_backup(callback: CallbackQuery, incremental: bool):
+    """Создаёт бэкап в фоновом потоке и отправляет его админу"""
     from utils.database_export import DatabaseExporter
     
     await callback.answer("⏳ Создаю бэкап...", show_alert=False)
     
     exporter = DatabaseExporter()
-    zip_path = await exporter.export_all()
+    zip_path = await exporter.export_all(incremental=incremental)
     
     if zip_path:
         try:
             from aiogram.types import FSInputFile
             file = FSInputFile(zip_path)
+            title = "🧩 Инкрементальный бэкап" if incremental else "💾 Полный бэкап базы данных"
             await callback.message.answer_document(
                 file,
-                caption=f"💾 Полный бэкап базы данных\n📅 {datetime.now().strftime('%Y-%m-%d %H:%M')}"
+                caption=f"{title}\n📅 {datetime.now().strftime('%Y-%m-%d %H:%M')}"
             )
-            await callback.answer("✅ Бэкап создан!", show_alert=True)
         except Exception as e:
             logger.error(f"Failed to send backup: {e}")
-            await callback.answer("❌ Ошибка отправки файла", show_alert=True)
+            await callback.message.answer("❌ Ошибка отправки файла")
     else:
-        await callback.answer("❌ Ошибка создания бэкапа", show_alert=True)
+        await callback.message.answer("❌ Ошибка создания бэкапа")
 
 
 @router.callback_query(F.data == "export_csv", IsAdmin())
@@ -902,27 +812,97 @@ async def admin_notifications_toggle(callback: CallbackQuery):
 
 @router.message(Command("logs"), IsAdmin())
 async def cmd_logs(message: Message):
-    """Показать последние логи"""
-    log_file = Path("mahiro_bot.log")
-    
-    if not log_file.exists():
-        await message.answer("📋 Файл логов не найден")
+    """
+    Последние логи или поиск по логам
+
+    /logs - последние строки текущего лога
+    /logs <текст> [уровень] [since] - поиск, например:
+    /logs mistral ERROR 6h, /logs 123456789 2026-01-28
+    """
+    log_file = Path(LOG_FILE)
+    args = message.text.split()[1:]
+
+    if not args:
+        last_lines = await asyncio.to_thread(tail_lines, log_file, LOGS_TAIL_LINES)
+        if not last_lines:
+            await message.answer("📋 Файл логов не найден")
+            return
+        await _send_log_lines(message, "📋 ПОСЛЕДНИЕ ЛОГИ:", last_lines)
         return
-    
-    # Читаем последние 50 строк
-    with open(log_file, 'r', encoding='utf-8') as f:
-        lines = f.readlines()
-        last_lines = lines[-50:]
-    
-    log_text = "📋 ПОСЛЕДНИЕ ЛОГИ:\n\n" + "".join(last_lines[-20:])
-    
-    # Если слишком длинно, отправляем файлом
-    if len(log_text) > 4000:
-        from aiogram.types import FSInputFile
-        file = FSInputFile(log_file)
-        await message.answer_document(file, caption="📋 Полный лог файл")
-    else:
-        await message.answer(f"```\n{log_text}\n```", parse_mode="Markdown")
+
+    pattern = args[0]
+    level = None
+    since = None
+    for arg in args[1:]:
+        if arg.upper() in LOG_LEVELS:
+            level = arg.upper()
+            continue
+        since = parse_since(arg)
+        if since is None:
+            await message.answer(
+                f"❌ Не понял «{arg}»\n\n"
+                "Формат: /logs <текст> [уровень] [since]\n"
+                "Уровни: " + ", ".join(LOG_LEVELS) + "\n"
+                "since: 30m, 6h, 7d или дата 2026-01-28"
+            )
+            return
+
+    found = await asyncio.to_thread(
+        search_logs, log_file, Path(LOG_ARCHIVE_DIR), pattern, level, since, LOGS_SEARCH_LIMIT
+    )
+    if not found:
+        await message.answer(f"🔍 По запросу «{pattern}» ничего не найдено")
+        return
+
+    await _send_log_lines(message, f"🔍 Найдено (последние {len(found)}):", found)
+
+
+async def _send_log_lines(message: Message, title: str, lines: list):
+    """Отправляет строки лога, обрезая начало под лимит сообщения"""
+    body = ""
+    for line in reversed([format_line(line) for line in lines]):
+        if len(title) + len(body) + len(line) + 20 > 4000:
+            break
+        body = line + "\n" + body
+
+    text = f"{title}\n\n{body}"
+    await message.answer(f"```\n{text}\n```", parse_mode="Markdown")
+
+
+@router.message(Command("search"), IsAdmin())
+async def cmd_search(message: Message):
+    """
+    Поиск по архиву диалогов
+
+    /search <запрос> - по всем пользователям
+    /search <user_id> <запрос> - по одному пользователю
+    """
+    args = message.text.split(maxsplit=1)[1:]
+    if not args:
+        await message.answer("Формат: /search [user_id] <запрос>")
+        return
+
+    query = args[0]
+    user_id = None
+    first, _, rest = query.partition(" ")
+    if first.isdigit() and rest:
+        user_id, query = int(first), rest
+
+    results = await conversation_archive.search(query, user_id=user_id, limit=SEARCH_RESULTS_LIMIT)
+    if not results:
+        await message.answer(f"🔍 По запросу «{query}» ничего не найдено")
+        return
+
+    lines = [f"🔍 АРХИВ: «{query}»\n"]
+    for result in results:
+        role = "👤" if result["role"] == "user" else "🎀"
+        content = result["content"].replace("\n", " ")
+        if len(content) > 200:
+            content = content[:200] + "…"
+        lines.append(f"{role} {result['user_id']} · {result['time']:%d.%m.%Y %H:%M}\n{content}\n")
+
+    text = "\n".join(lines)
+    await message.answer(text[:4000])
 
 
 @router.message(Command("system"), IsAdmin())
@@ -1,21 +1,21 @@
 from aiogram.filters import Filter
 from aiogram.types import Message
 
-from config import ADMIN_USER_IDS, BLACKLIST_USER_IDS, ENABLE_WHITELIST, WHITELIST_USER_IDS
+from utils.services import acl
 
 
 class IsAdmin(Filter):
     """Фильтр: пользователь - админ"""
 
     async def __call__(self, message: Message) -> bool:
-        return message.from_user.id in ADMIN_USER_IDS
+        return acl.is_admin(message.from_user.id)
 
 
 class IsNotBlacklisted(Filter):
     """Фильтр: пользователь не в чёрном списке"""
 
     async def __call__(self, message: Message) -> bool:
-        return message.from_user.id not in BLACKLIST_USER_IDS
+        return not acl.is_blacklisted(message.from_user.id)
 
 
 class IsWhitelisted(Filter):
@@ -24,15 +24,7 @@ class IsWhitelisted(Filter):
     """
 
     async def __call__(self, message: Message) -> bool:
-        user_id = message.from_user.id
-
-        if not ENABLE_WHITELIST:
-            return True
-
-        if user_id in ADMIN_USER_IDS:
-            return True
-
-        return user_id in WHITELIST_USER_IDS
+        return acl.is_whitelisted(message.from_user.id)
 
 
 class HasAccess(Filter):
@@ -43,14 +35,4 @@ class HasAccess(Filter):
 
     async def __call__(self, message: Message) -> bool:
         user_id = message.from_user.id
-
-        if user_id in BLACKLIST_USER_IDS:
-            return False
-
-        if not ENABLE_WHITELIST:
-            return True
-
-        if user_id in ADMIN_USER_IDS:
-            return True
-
-        return user_id in WHITELIST_USER_IDS
\ No newline at end of file
+        return not acl.is_blacklisted(user_id) and acl.is_whitelisted(user_id)
@@ -3,15 +3,21 @@ from aiogram.types import Message, CallbackQuery, InlineKeyboardMarkup, InlineKe
 from aiogram.filters import Command
 import logging
 import random
+import time
 
 from utils.services import (
     mistral_client, memory, trust_system, mood_system, message_counter,
-    long_term_memory, image_manager, statistics, rate_limiter, trigger_system, user_tracker
+    long_term_memory, image_manager, statistics, rate_limiter, trigger_system, user_tracker,
+    activity_rollup, fact_extractor, conversation_archive, acl, degraded_replies, model_router,
+    token_budget, degradation, spam_filter
 )
 from utils.admin_notifications import admin_notifier
+from utils.metrics import messages_total, errors_total, handler_stage_seconds
 from utils.donations import donation_system
+from utils.token_budget import SOFT, HARD
+from ai.degradation import SHORT, SHED
 from bot.filters import IsNotBlacklisted, IsAdmin
-from config import MAX_HISTORY_MESSAGES
+from config import MAX_HISTORY_MESSAGES, ENABLE_HISTORY_RECALL, HISTORY_RECALL_TURNS
 
 logger = logging.getLogger(__name__)
 
@@ -20,6 +26,22 @@ router = Router()
 from ai.prompts import get_system_prompt
 from ai.context_builder import get_time_of_day, format_history_for_context
 
+_STAGES = {
+    stage: handler_stage_seconds.labels(stage)
+    for stage in ("access", "context", "triggers", "prompt", "llm", "reply", "persist")
+}
+
+
+def _record_stage(stage: str, started: float) -> float:
+    """Записывает длительность этапа handle_message и возвращает начало следующего"""
+    now = time.perf_counter()
+    _STAGES[stage].observe(now - started)
+    return now
+
+
+def _elapsed_ms(started: float) -> int:
+    return round((time.perf_counter() - started) * 1000)
+
 
 @router.message(Command("start"))
 async def cmd_start(message: Message):
@@ -27,7 +49,6 @@ async def cmd_start(message: Message):
     user_id = message.from_user.id
     
     # Проверка доступа
-    from config import ENABLE_WHITELIST, WHITELIST_USER_IDS, BLACKLIST_USER_IDS, ADMIN_USER_IDS
     
     # Трекаем пользователя
     await user_tracker.track_user(
@@ -48,11 +69,11 @@ async def cmd_start(message: Message):
             message.from_user.first_name or "Аноним"
         )
     
-    if user_id in BLACKLIST_USER_IDS:
+    if acl.is_blacklisted(user_id):
         await message.answer("🚫 Доступ запрещён.")
         return
     
-    if ENABLE_WHITELIST and user_id not in ADMIN_USER_IDS and user_id not in WHITELIST_USER_IDS:
+    if not acl.is_whitelisted(user_id):
         await message.answer(
             "🔐 Доступ ограничен.\n\n"
             "Этот бот использует белый список пользователей.\n"
@@ -86,13 +107,13 @@ async def cmd_reset(message: Message):
     user_id = message.from_user.id
     
     # Проверка доступа
-    from config import ENABLE_WHITELIST, WHITELIST_USER_IDS, BLACKLIST_USER_IDS, ADMIN_USER_IDS
-    if user_id in BLACKLIST_USER_IDS:
+    if acl.is_blacklisted(user_id):
         return
-    if ENABLE_WHITELIST and user_id not in ADMIN_USER_IDS and user_id not in WHITELIST_USER_IDS:
+    if not acl.is_whitelisted(user_id):
         return
     
     await memory.save_history(user_id, [])
+    await conversation_archive.mark_reset(user_id)
     
     await message.answer(
         "Хм… начнём сначала? 😅\n"
@@ -106,10 +127,9 @@ async def cmd_mood(message: Message):
     user_id = message.from_user.id
     
     # Проверка доступа
-    from config import ENABLE_WHITELIST, WHITELIST_USER_IDS, BLACKLIST_USER_IDS, ADMIN_USER_IDS
-    if user_id in BLACKLIST_USER_IDS:
+    if acl.is_blacklisted(user_id):
         return
-    if ENABLE_WHITELIST and user_id not in ADMIN_USER_IDS and user_id not in WHITELIST_USER_IDS:
+    if not acl.is_whitelisted(user_id):
         return
     
     current_mood = await mood_system.get_mood(user_id)
@@ -180,10 +200,9 @@ async def cmd_stats(message: Message):
     user_id = message.from_user.id
     
     # Проверка доступа
-    from config import ENABLE_WHITELIST, WHITELIST_USER_IDS, BLACKLIST_USER_IDS, ADMIN_USER_IDS
-    if user_id in BLACKLIST_USER_IDS:
+    if acl.is_blacklisted(user_id):
         return
-    if ENABLE_WHITELIST and user_id not in ADMIN_USER_IDS and user_id not in WHITELIST_USER_IDS:
+    if not acl.is_whitelisted(user_id):
         return
     
     trust = await trust_system.get_trust(user_id)
@@ -191,10 +210,13 @@ async def cmd_stats(message: Message):
     history = await memory.load_history(user_id)
     msg_count = await message_counter.get_count(user_id)
     user_memory = await long_term_memory.get_memory(user_id)
+    budget = await token_budget.check(user_id)
     
     stats_text = "📊 Статистика нашего общения:\n\n"
     stats_text += f"💬 Сообщений в истории: {len(history)}\n"
     stats_text += f"📅 Сообщений сегодня: {msg_count}\n"
+    if budget.limit_day:
+        stats_text += f"🔋 Сил на разговоры сегодня: {max(0, 100 - budget.used_day * 100 // budget.limit_day)}%\n"
     stats_text += f"❤️ Уровень доверия: {trust:.0%}\n"
     stats_text += f"😊 Настроение: {mood}\n"
     
@@ -220,10 +242,9 @@ async def cmd_help(message: Message):
     user_id = message.from_user.id
     
     # Проверка доступа
-    from config import ENABLE_WHITELIST, WHITELIST_USER_IDS, BLACKLIST_USER_IDS, ADMIN_USER_IDS
-    if user_id in BLACKLIST_USER_IDS:
+    if acl.is_blacklisted(user_id):
         return
-    if ENABLE_WHITELIST and user_id not in ADMIN_USER_IDS and user_id not in WHITELIST_USER_IDS:
+    if not acl.is_whitelisted(user_id):
         return
     
     help_text = """🎀 Команды бота Махиро:
@@ -400,6 +421,7 @@ async def cmd_balance(message: Message):
 @router.message(F.text)
 async def handle_message(message: Message):
     """Обработка текстовых сообщений"""
+    stage_started = handler_started = time.perf_counter()
     user_id = message.from_user.id
     user_text = message.text
     username = message.from_user.username
@@ -407,24 +429,22 @@ async def handle_message(message: Message):
     last_name = message.from_user.last_name
     
     # Проверяем доступ ДО rate limit
-    from config import ENABLE_WHITELIST, WHITELIST_USER_IDS, BLACKLIST_USER_IDS, ADMIN_USER_IDS
     
     # Проверка blacklist (приоритет)
-    if user_id in BLACKLIST_USER_IDS:
+    if acl.is_blacklisted(user_id):
         await user_tracker.track_user(user_id, username, first_name, last_name, had_access=False)
         await message.answer("🚫 Доступ запрещён.")
         return
     
     # Проверка whitelist
-    if ENABLE_WHITELIST:
-        if user_id not in ADMIN_USER_IDS and user_id not in WHITELIST_USER_IDS:
-            await user_tracker.track_user(user_id, username, first_name, last_name, had_access=False)
-            await message.answer(
-                "🔐 Доступ ограничен.\n\n"
-                "Этот бот использует белый список пользователей.\n"
-                "Обратитесь к администратору для получения доступа."
-            )
-            return
+    if not acl.is_whitelisted(user_id):
+        await user_tracker.track_user(user_id, username, first_name, last_name, had_access=False)
+        await message.answer(
+            "🔐 Доступ ограничен.\n\n"
+            "Этот бот использует белый список пользователей.\n"
+            "Обратитесь к администратору для получения доступа."
+        )
+        return
     
     # Трекаем пользователя (доступ разрешён)
     await user_tracker.track_user(user_id, username, first_name, last_name, had_access=True)
@@ -435,6 +455,9 @@ async def handle_message(message: Message):
         await message.answer(f"Эй! {reason} 😤")
         return
     
+    messages_total.inc()
+    stage_started = _record_stage("access", stage_started)
+    
     try:
         await message.bot.send_chat_action(message.chat.id, "typing")
         
@@ -442,6 +465,20 @@ async def handle_message(message: Message):
         rate_limiter.record_message(user_id)
         msg_count = await message_counter.increment(user_id)
         
+        # Повтор недавнего сообщения или флуд - отвечаем без Mistral
+        spam = spam_filter.check(user_id, user_text)
+        if spam.reply:
+            rate_limiter.add_spam_penalty(user_id, spam.penalty)
+            await message.answer(spam.reply)
+            logger.info(
+                f"Spam filter answered {user_id}: {spam.kind}",
+                extra={"user_id": user_id, "stage": "spam", "latency_ms": _elapsed_ms(handler_started)}
+            )
+            return
+        
+        # Факты о пользователе извлекаются в фоне
+        fact_extractor.submit(user_id, user_text)
+        
         # Получаем контекст
         time_of_day = get_time_of_day()
         trust_level = await trust_system.get_trust(user_id)
@@ -455,11 +492,15 @@ async def handle_message(message: Message):
             trust_level=trust_level,
             message_count_today=msg_count
         )
+        stage_started = _record_stage("context", stage_started)
         
         # Проверяем триггеры
-        trigger_response = trigger_system.check_triggers(user_text, trust_level)
+        trigger_match = trigger_system.match_trigger(user_text, trust_level)
+        stage_started = _record_stage("triggers", stage_started)
         
-        if trigger_response:
+        if trigger_match:
+            trigger_name, trigger_response = trigger_match
+            
             # Триггер сработал - отправляем готовый ответ
             await message.answer(trigger_response)
             
@@ -471,36 +512,111 @@ async def handle_message(message: Message):
                     mood=mood
                 )
                 await statistics.increment_images()
+            stage_started = _record_stage("reply", stage_started)
             
             # Сохраняем в историю
             await memory.add_message(user_id, "user", user_text, MAX_HISTORY_MESSAGES)
             await memory.add_message(user_id, "assistant", trigger_response, MAX_HISTORY_MESSAGES)
+            conversation_archive.submit(user_id, user_text, trigger_response)
             await trust_system.increment_trust(user_id)
             await statistics.increment_messages(mood)
+            await activity_rollup.record(mood=mood, trigger=trigger_name)
+            _record_stage("persist", stage_started)
             
-            logger.info(f"Trigger response sent to {user_id}")
+            logger.info(
+                f"Trigger response sent to {user_id}: trigger={trigger_name}",
+                extra={"user_id": user_id, "stage": "trigger", "latency_ms": _elapsed_ms(handler_started)}
+            )
+            return
+        
+        # Бюджет токенов: у исчерпавших - без Mistral, у близких к пределу - экономный режим
+        budget = await token_budget.check(user_id)
+        if budget.level == HARD:
+            await message.answer(
+                "Э-э… я сегодня уже столько болтала, что язык заплетается 😵\n"
+                "Давай продолжим попозже?"
+            )
+            logger.info(
+                f"Token budget exhausted for {user_id}: day={budget.used_day}/{budget.limit_day}, "
+                f"month={budget.used_month}/{budget.limit_month}",
+                extra={"user_id": user_id, "stage": "budget", "latency_ms": _elapsed_ms(handler_started)}
+            )
+            return
+        
+        # Под нагрузкой слот Mistral первым получают админы, затем донатеры
+        if acl.is_admin(user_id):
+            priority = "admin"
+        elif await token_budget.is_donor(user_id):
+            priority = "donor"
+        else:
+            priority = "regular"
+        
+        # Очередь к Mistral переполнена - обычным пользователям отвечаем без неё
+        load_mode = degradation.mode_for(priority)
+        if load_mode == SHED:
+            await message.answer(degraded_replies.reply(user_id, user_text))
+            logger.info(
+                f"Load shedding response sent to {user_id}",
+                extra={"user_id": user_id, "stage": "degraded", "latency_ms": _elapsed_ms(handler_started)}
+            )
             return
         
         # Генерируем system prompt
         system_prompt = get_system_prompt(time_of_day, trust_level, mood)
         
         # Добавляем долгосрочную память
-        ltm_context = await long_term_memory.get_context_string(user_id)
+        ltm_context = await long_term_memory.get_context_string(user_id, query=user_text)
         if ltm_context:
             system_prompt += ltm_context
         
+        # Старые реплики из архива, похожие на текущее сообщение
+        if ENABLE_HISTORY_RECALL:
+            recalled = await conversation_archive.recall(
+                user_id, user_text, skip_recent=MAX_HISTORY_MESSAGES, limit=HISTORY_RECALL_TURNS
+            )
+            if recalled:
+                system_prompt += "\n\n🕰 ИЗ ВАШИХ ПРОШЛЫХ РАЗГОВОРОВ:\n" + "\n".join(
+                    f"[{turn['time']:%d.%m.%Y}] {'Собеседник' if turn['role'] == 'user' else 'Ты'}: {turn['content'][:300]}"
+                    for turn in recalled
+                )
+        
         # Форматируем историю
         formatted_history = format_history_for_context(history, MAX_HISTORY_MESSAGES)
+        stage_started = _record_stage("prompt", stage_started)
         
-        # Генерируем ответ
-        response = await mistral_client.generate_response(
+        # Генерируем ответ (модель и длина ответа - по сложности сообщения и загрузке)
+        if budget.level == SOFT:
+            economy = "budget_soft"
+        elif load_mode == SHORT:
+            economy = "degraded"
+        else:
+            economy = None
+        route = model_router.route(user_text, trust_level, economy=economy)
+        llm_started = time.perf_counter()
+        result = await mistral_client.generate(
             system_prompt=system_prompt,
             history=formatted_history,
-            user_message=user_text
+            user_message=user_text,
+            model=route.model,
+            max_tokens=route.max_tokens,
+            user_id=user_id,
+            priority=priority
+        )
+        response = result.text if result else None
+        degradation.observe(time.perf_counter() - llm_started)
+        if result and not result.shared:
+            await token_budget.record(user_id, result.total_tokens, budget.level)
+        model_router.log_decision(
+            user_id, route,
+            result.latency_ms if result else None,
+            result.total_tokens if result and not result.shared else None
         )
+        stage_started = _record_stage("llm", stage_started)
         
         if response:
             await message.answer(response)
+            degraded_replies.remember(user_id, user_text, response)
+            spam_filter.remember(user_id, spam, response)
             
             # Возможно, отправим картинку
             if image_manager.should_send_image():
@@ -511,19 +627,40 @@ async def handle_message(message: Message):
                     caption="(нашла картинку! 😊)"
                 )
                 await statistics.increment_images()
+            stage_started = _record_stage("reply", stage_started)
             
             # Сохраняем
             await memory.add_message(user_id, "user", user_text, MAX_HISTORY_MESSAGES)
             await memory.add_message(user_id, "assistant", response, MAX_HISTORY_MESSAGES)
+            conversation_archive.submit(user_id, user_text, response)
             await trust_system.increment_trust(user_id)
             await statistics.increment_messages(mood)
+            await activity_rollup.record(mood=mood)
+            _record_stage("persist", stage_started)
             
-            logger.info(f"Response sent to {user_id}: mood={mood}, trust={trust_level:.2f}")
+            logger.info(
+                f"Response sent to {user_id}: mood={mood}, trust={trust_level:.2f}",
+                extra={"user_id": user_id, "stage": "reply", "latency_ms": _elapsed_ms(handler_started)}
+            )
+        elif mistral_client.degraded:
+            # Mistral недоступен - отвечаем сразу, без ожидания таймаута
+            await message.answer(degraded_replies.reply(user_id, user_text))
+            errors_total.labels("llm_degraded").inc()
+            logger.warning(
+                f"Degraded response sent to {user_id}",
+                extra={"user_id": user_id, "stage": "degraded", "latency_ms": _elapsed_ms(handler_started)}
+            )
         else:
             await message.answer("А-ай… что-то у меня в голове помутилось… 😖\nМожешь повторить?")
+            errors_total.labels("empty_response").inc()
             await statistics.increment_errors()
     
     except Exception as e:
-        logger.error(f"Ошибка обработки сообщения от {user_id}: {e}", exc_info=True)
+        logger.error(
+            f"Ошибка обработки сообщения от {user_id}: {e}",
+            exc_info=True,
+            extra={"user_id": user_id, "stage": "handler", "latency_ms": _elapsed_ms(handler_started)}
+        )
+        errors_total.labels("handler").inc()
         await message.answer("Э-эй… что-то пошло не так… 💢")
         await statistics.increment_errors()
\ No newline at end of file
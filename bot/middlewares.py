@@ -0,0 +1,184 @@
+"""
+Middleware диспетчера
+
+DedupMiddleware отбрасывает повторно доставленные апдейты. После
+перезапуска или обрыва связи Telegram может прислать апдейт ещё раз,
+и без проверки Махиро снова сходит в Mistral, дважды поднимет доверие
+и запишет историю дважды.
+"""
+import asyncio
+import base64
+import json
+import logging
+import os
+from pathlib import Path
+from typing import Any, Awaitable, Callable, Dict
+
+import aiofiles
+from aiogram import BaseMiddleware
+from aiogram.types import TelegramObject, Update
+
+from utils.metrics import metrics
+
+logger = logging.getLogger(__name__)
+
+_updates = metrics.counter("mahiro_updates_dedup_total", "Проверка апдейтов на повтор", labels=("result",))
+_updates_new = _updates.labels("new")
+_updates_duplicate = _updates.labels("duplicate")
+_updates_reset = _updates.labels("reset")
+
+NEW = "new"
+DUPLICATE = "duplicate"
+RESET = "reset"
+
+
+class UpdateWindow:
+    """
+    Виденные update_id в скользящем окне фиксированного размера
+
+    update_id у бота растут подряд, поэтому вместо множества хватает
+    битовой карты на SIZE последних номеров (8 КБ) и наибольшего
+    виденного номера. Номер выше окна сдвигает его, номер внутри -
+    проверяется по биту. Номер намного ниже окна значит, что Telegram
+    начал нумерацию заново (так бывает после недели без апдейтов), -
+    окно начинается с него.
+    """
+
+    SIZE = 1 << 16
+
+    def __init__(self):
+        self.bits = bytearray(self.SIZE // 8)
+        self.highest = None
+
+    def _test_and_set(self, update_id: int) -> bool:
+        index = update_id % self.SIZE
+        mask = 1 << (index & 7)
+        seen = bool(self.bits[index >> 3] & mask)
+        self.bits[index >> 3] |= mask
+        return seen
+
+    def _clear(self, update_id: int):
+        index = update_id % self.SIZE
+        self.bits[index >> 3] &= ~(1 << (index & 7)) & 0xFF
+
+    def check(self, update_id: int) -> str:
+        """Отмечает update_id и возвращает new / duplicate / reset"""
+        if self.highest is None or update_id <= self.highest - self.SIZE or update_id >= self.highest + self.SIZE:
+            result = NEW if self.highest is None else RESET
+            self.bits = bytearray(self.SIZE // 8)
+            self.highest = update_id
+            self._test_and_set(update_id)
+            return result
+
+        if update_id > self.highest:
+            # Номера, вышедшие из окна, освобождают свои биты
+            for skipped in range(self.highest + 1, update_id):
+                self._clear(skipped)
+            self._clear(update_id)
+            self.highest = update_id
+
+        return DUPLICATE if self._test_and_set(update_id) else NEW
+
+    def dump(self) -> Dict:
+        return {"highest": self.highest, "bits": base64.b64encode(bytes(self.bits)).decode("ascii")}
+
+    def restore(self, data: Dict):
+        bits = base64.b64decode(data.get("bits", ""))
+        if data.get("highest") is None or len(bits) != len(self.bits):
+            return
+        self.highest = data["highest"]
+        self.bits = bytearray(bits)
+
+
+class DedupMiddleware(BaseMiddleware):
+    """
+    Пропускает каждый update_id один раз
+
+    Окно переживает перезапуск: каждый новый номер дописывается строкой
+    в seen_updates.journal до обработки апдейта, а журнал время от
+    времени сворачивается в снимок seen_updates.json. Память и файлы
+    ограничены размером окна, сколько бы апдейтов ни прошло.
+    """
+
+    # Сколько строк журнала копится до сворачивания в снимок
+    JOURNAL_COMPACT_LINES = 1000
+
+    def __init__(self, storage_dir: str = "data"):
+        self.storage_dir = Path(storage_dir)
+        self.storage_dir.mkdir(exist_ok=True)
+        self.snapshot_file = self.storage_dir / "seen_updates.json"
+        self.journal_file = self.storage_dir / "seen_updates.journal"
+        self.window = UpdateWindow()
+        self._journal_lines = 0
+        self._lock = asyncio.Lock()
+
+    async def load(self):
+        """Поднимает окно из снимка и журнала (при старте бота)"""
+        if self.snapshot_file.exists():
+            try:
+                async with aiofiles.open(self.snapshot_file, 'r', encoding='utf-8') as f:
+                    self.window.restore(json.loads(await f.read()))
+            except Exception as e:
+                logger.error(f"Ошибка загрузки виденных апдейтов: {e}")
+
+        if self.journal_file.exists():
+            async with aiofiles.open(self.journal_file, 'r', encoding='utf-8') as f:
+                async for line in f:
+                    if line.strip().isdigit():
+                        self.window.check(int(line))
+
+        await self.flush()
+        logger.info(f"Update dedup window loaded: highest={self.window.highest}")
+
+    async def flush(self):
+        """Сохраняет снимок окна и очищает журнал"""
+        async with self._lock:
+            await self._write_snapshot()
+
+    async def _write_snapshot(self):
+        try:
+            tmp_path = self.snapshot_file.with_suffix(".tmp")
+            async with aiofiles.open(tmp_path, 'w', encoding='utf-8') as f:
+                await f.write(json.dumps(self.window.dump()))
+            os.replace(tmp_path, self.snapshot_file)
+
+            async with aiofiles.open(self.journal_file, 'w', encoding='utf-8') as f:
+                await f.write("")
+            self._journal_lines = 0
+        except Exception as e:
+            logger.error(f"Ошибка сохранения виденных апдейтов: {e}")
+
+    async def __call__(
+            self,
+            handler: Callable[[TelegramObject, Dict[str, Any]], Awaitable[Any]],
+            event: TelegramObject,
+            data: Dict[str, Any]
+    ) -> Any:
+        if not isinstance(event, Update):
+            return await handler(event, data)
+
+        # Проверка и отметка - без await между ними, апдейты обрабатываются параллельно
+        result = self.window.check(event.update_id)
+        if result == DUPLICATE:
+            _updates_duplicate.inc()
+            logger.info(f"Duplicate update dropped: {event.update_id}", extra={"stage": "dedup"})
+            return None
+
+        if result == RESET:
+            _updates_reset.inc()
+            logger.warning(f"Update numbering restarted at {event.update_id}", extra={"stage": "dedup"})
+        else:
+            _updates_new.inc()
+
+        async with self._lock:
+            try:
+                async with aiofiles.open(self.journal_file, 'a', encoding='utf-8') as f:
+                    await f.write(f"{event.update_id}\n")
+                self._journal_lines += 1
+            except Exception as e:
+                logger.error(f"Ошибка записи журнала апдейтов: {e}")
+
+            if self._journal_lines >= self.JOURNAL_COMPACT_LINES:
+                await self._write_snapshot()
+
+        return await handler(event, data)
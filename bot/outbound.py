@@ -0,0 +1,203 @@
+"""
+Общая очередь исходящих запросов к Telegram
+
+Ответы, картинки, рассылка и уведомления админам шлются через один
+Bot, но до этого каждый отправлял сам по себе: рассылка упиралась в
+лимиты Telegram, получала flood-wait, и ответы собеседникам ждали
+вместе с ней. OutboundScheduler - middleware сессии бота, через
+него проходит каждый запрос к Bot API:
+
+- отправка сообщений ограничена общим лимитом бота и лимитом чата
+  (token bucket), остальные методы проходят сразу;
+- отправки внутри bulk_sends() (рассылка) - низкий приоритет: своя
+  доля общего лимита и ожидание, пока ждут ответы собеседникам;
+- TelegramRetryAfter обрабатывается здесь: на паузу ставится чат,
+  в который пришёл flood wait, а вся отправка - только если за
+  TG_FLOOD_GLOBAL_WINDOW секунд flood wait пришёл из TG_FLOOD_GLOBAL_CHATS
+  разных чатов (значит, упёрлись в общий лимит бота). Запрос
+  повторяется до TG_RETRY_ATTEMPTS раз.
+"""
+import asyncio
+import logging
+import time
+from collections import OrderedDict, deque
+from contextlib import contextmanager
+from contextvars import ContextVar
+from typing import Optional
+
+from aiogram import Bot
+from aiogram.client.session.middlewares.base import BaseRequestMiddleware, NextRequestMiddlewareType
+from aiogram.exceptions import TelegramRetryAfter
+from aiogram.methods import TelegramMethod
+from aiogram.methods.base import Response, TelegramType
+
+from config import (
+    TG_GLOBAL_RATE, TG_BULK_RATE, TG_CHAT_RATE, TG_GROUP_RATE, TG_CHAT_BURST, TG_RETRY_ATTEMPTS,
+    TG_FLOOD_GLOBAL_CHATS, TG_FLOOD_GLOBAL_WINDOW,
+)
+from utils.metrics import metrics, queue_depth
+
+logger = logging.getLogger(__name__)
+
+_send_wait = metrics.histogram(
+    "mahiro_tg_send_wait_seconds", "Ожидание в очереди отправки Telegram", labels=("priority",)
+)
+_retry_after = metrics.counter(
+    "mahiro_tg_retry_after_total", "Ответы Telegram RetryAfter (flood wait)", labels=("scope",)
+)
+_wait = {priority: _send_wait.labels(priority) for priority in ("interactive", "bulk")}
+_retry_scope = {scope: _retry_after.labels(scope) for scope in ("chat", "global")}
+_queue = {
+    "interactive": queue_depth.labels("tg_interactive"),
+    "bulk": queue_depth.labels("tg_bulk"),
+}
+
+_bulk: ContextVar[bool] = ContextVar("outbound_bulk", default=False)
+
+# Методы, которые считаются отправкой сообщения в чат
+_SEND_PREFIXES = ("Send", "Copy", "Forward")
+_NOT_SENDS = ("SendChatAction",)
+
+
+@contextmanager
+def bulk_sends():
+    """Отправки внутри блока идут с низким приоритетом (рассылки)"""
+    token = _bulk.set(True)
+    try:
+        yield
+    finally:
+        _bulk.reset(token)
+
+
+class TokenBucket:
+    def __init__(self, rate: float, burst: float):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.updated = time.monotonic()
+        # До какого момента отправка стоит после RetryAfter
+        self.paused_until = 0.0
+
+    def delay(self, now: float) -> float:
+        """Через сколько секунд появится токен (0 - уже есть)"""
+        self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+        wait = 0.0 if self.tokens >= 1 else (1 - self.tokens) / self.rate
+        return max(wait, self.paused_until - now)
+
+    def pause(self, until: float):
+        self.paused_until = max(self.paused_until, until)
+
+    def take(self):
+        self.tokens -= 1
+
+
+class OutboundScheduler(BaseRequestMiddleware):
+    """Лимиты Telegram, приоритет ответов над рассылкой и RetryAfter"""
+
+    # Сколько чатов помнить (давно молчавшие забываются - их лимит и так полон)
+    MAX_CHATS = 10000
+    # Как часто рассылка проверяет, не освободилась ли очередь от ответов
+    BULK_YIELD_SECONDS = 0.05
+
+    def __init__(self):
+        self._global = TokenBucket(TG_GLOBAL_RATE, TG_GLOBAL_RATE)
+        self._bulk = TokenBucket(TG_BULK_RATE, TG_BULK_RATE)
+        self._chats: "OrderedDict[int, TokenBucket]" = OrderedDict()
+        # (время, чат) недавних flood wait - по ним видно, упёрся ли весь бот
+        self._flood_waits: deque = deque()
+        self._contending = 0
+
+    def _chat_bucket(self, chat_id: int) -> TokenBucket:
+        bucket = self._chats.get(chat_id)
+        if bucket is None:
+            # Отрицательные ID - группы и каналы, у них лимит строже
+            rate = TG_GROUP_RATE if chat_id < 0 else TG_CHAT_RATE
+            bucket = self._chats[chat_id] = TokenBucket(rate, TG_CHAT_BURST)
+            if len(self._chats) > self.MAX_CHATS:
+                self._chats.popitem(last=False)
+        else:
+            self._chats.move_to_end(chat_id)
+        return bucket
+
+    async def _acquire(self, chat_id: Optional[int], bulk: bool):
+        priority = "bulk" if bulk else "interactive"
+        started = time.perf_counter()
+        _queue[priority].inc()
+        # Ответ ждёт общего лимита (а не лимита своего чата) - рассылка уступает
+        contending = False
+        try:
+            while True:
+                now = time.monotonic()
+                chat_wait = self._chat_bucket(chat_id).delay(now) if isinstance(chat_id, int) else 0.0
+                wait = max(chat_wait, self._global.delay(now))
+                if bulk:
+                    wait = max(wait, self._bulk.delay(now))
+                    if self._contending:
+                        wait = max(wait, self.BULK_YIELD_SECONDS)
+
+                if wait <= 0:
+                    self._global.take()
+                    if bulk:
+                        self._bulk.take()
+                    if isinstance(chat_id, int):
+                        self._chat_bucket(chat_id).take()
+                    return
+
+                if not bulk and contending != (chat_wait <= 0):
+                    contending = chat_wait <= 0
+                    self._contending += 1 if contending else -1
+                await asyncio.sleep(wait)
+        finally:
+            if contending:
+                self._contending -= 1
+            _queue[priority].dec()
+            _wait[priority].observe(time.perf_counter() - started)
+
+    def _on_retry_after(self, chat_id: Optional[int], retry_after: float) -> str:
+        """
+        Ставит на паузу чат, получивший flood wait, или всю отправку
+
+        Returns:
+            "chat" или "global"
+        """
+        now = time.monotonic()
+        until = now + retry_after
+        if isinstance(chat_id, int):
+            self._chat_bucket(chat_id).pause(until)
+            self._flood_waits.append((now, chat_id))
+            while self._flood_waits and now - self._flood_waits[0][0] > TG_FLOOD_GLOBAL_WINDOW:
+                self._flood_waits.popleft()
+            if len({chat for _, chat in self._flood_waits}) < TG_FLOOD_GLOBAL_CHATS:
+                return "chat"
+
+        # Flood wait сразу из нескольких чатов (или без чата) - лимит всего бота
+        self._global.pause(until)
+        return "global"
+
+    async def __call__(
+            self,
+            make_request: NextRequestMiddlewareType[TelegramType],
+            bot: Bot,
+            method: TelegramMethod[TelegramType],
+    ) -> Response[TelegramType]:
+        name = type(method).__name__
+        if not name.startswith(_SEND_PREFIXES) or name in _NOT_SENDS:
+            return await make_request(bot, method)
+
+        chat_id = getattr(method, "chat_id", None)
+        bulk = _bulk.get()
+        for attempt in range(TG_RETRY_ATTEMPTS + 1):
+            await self._acquire(chat_id, bulk)
+            try:
+                return await make_request(bot, method)
+            except TelegramRetryAfter as e:
+                scope = self._on_retry_after(chat_id, e.retry_after)
+                _retry_scope[scope].inc()
+                logger.warning(
+                    f"Telegram RetryAfter {e.retry_after}s on {name} "
+                    f"(chat {chat_id}, {scope} pause, attempt {attempt + 1})",
+                    extra={"stage": "outbound"}
+                )
+                if attempt == TG_RETRY_ATTEMPTS:
+                    raise
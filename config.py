@@ -9,6 +9,8 @@ TELEGRAM_TOKEN = os.getenv("TELEGRAM_TOKEN")
 # ========== Mistral AI ==========
 MISTRAL_API_KEY = os.getenv("MISTRAL_API_KEY")
 MISTRAL_MODEL = "mistral-small-latest"
+# Другой адрес API (например, локальный фейковый сервер для бенчмарков)
+MISTRAL_SERVER_URL = os.getenv("MISTRAL_SERVER_URL") or None
 
 # ========== Память ==========
 MAX_HISTORY_MESSAGES = 20
@@ -19,11 +21,112 @@ MAX_TRUST = 1.0
 TEMPERATURE = 0.85
 MAX_TOKENS = 500
 
+# ========== Выбор модели ==========
+# Модель и лимит ответа подбираются под сообщение (ai/router.py);
+# если выключено - всегда MISTRAL_MODEL и MAX_TOKENS
+ENABLE_MODEL_ROUTING = os.getenv("ENABLE_MODEL_ROUTING", "true").lower() == "true"
+# уровень: (модель, max_tokens)
+MODEL_TIERS = {
+    "fast": ("ministral-8b-latest", 250),
+    "standard": (MISTRAL_MODEL, MAX_TOKENS),
+    "large": ("mistral-large-latest", 700),
+}
+# Загрузка Mistral (запросы в работе и в очереди / лимит параллельности):
+# выше первого порога уровень понижается на ступень, выше второго - всегда fast
+ROUTING_LOAD_DOWNGRADE = 0.6
+ROUTING_LOAD_SHED = 0.9
+
+# ========== Устойчивость к сбоям Mistral ==========
+# Сколько запросов к Mistral одновременно: лимит подстраивается (AIMD)
+# по латентности и ответам 429 в этих пределах
+LLM_MIN_CONCURRENCY = 1
+LLM_MAX_CONCURRENCY = 16
+LLM_INITIAL_CONCURRENCY = 4
+LLM_TARGET_LATENCY = 8.0  # секунд; дольше - лимит снижается
+LLM_QUEUE_TIMEOUT = 20.0  # секунд ожидания свободного слота до отказа
+# Классы приоритета очереди к Mistral (ai/scheduler.py): свободный слот
+# достаётся классу выше; внутри класса - по очереди между пользователями
+LLM_PRIORITY_CLASSES = ("admin", "donor", "regular", "background")
+# Предохранитель: после стольких сбоев подряд запросы не отправляются
+# BREAKER_OPEN_SECONDS секунд, затем пробуется один запрос
+BREAKER_FAILURE_THRESHOLD = 5
+BREAKER_OPEN_SECONDS = 30
+# Хеджирование: если первый токен не пришёл за перцентиль LLM_HEDGE_PERCENTILE
+# недавних запросов (но не раньше LLM_HEDGE_MIN_DELAY), отправляется дубль,
+# и побеждает тот, кто закончит первым. Дублей - не больше LLM_HEDGE_BUDGET от запросов
+LLM_HEDGING_ENABLED = os.getenv("LLM_HEDGING_ENABLED", "false").lower() == "true"
+LLM_HEDGE_PERCENTILE = 0.95
+LLM_HEDGE_MIN_DELAY = 1.0  # секунд
+LLM_HEDGE_BUDGET = 0.05
+# Сколько недавних ответов помнить для ответов в деградированном режиме
+# (ключ - пользователь и текст, ответ отдаётся только тому же пользователю)
+DEGRADED_CACHE_SIZE = 10000
+# Разгрузка (ai/degradation.py): при длинной очереди к Mistral или
+# медленных ответах новые сообщения обычных пользователей получают
+# короткий ответ быстрой модели (short), а при перегрузке - ответ из
+# кэша или заготовку (shed). Админы и донатеры обслуживаются как обычно
+ENABLE_LOAD_SHEDDING = os.getenv("ENABLE_LOAD_SHEDDING", "true").lower() == "true"
+SHED_QUEUE_SHORT = 8  # запросов в очереди
+SHED_QUEUE_SHED = 24
+SHED_LATENCY_SHORT = 12.0  # секунд на ответ Mistral вместе с очередью
+SHED_LATENCY_SHED = 25.0
+# Режим смягчается, когда показатели ниже этой доли от порога,
+# и не раньше SHED_MIN_DWELL секунд после прошлого переключения
+SHED_RECOVERY_RATIO = 0.5
+SHED_MIN_DWELL = 60
+
 # ========== Rate Limiting ==========
 MAX_MESSAGES_PER_MINUTE = 10
 MAX_MESSAGES_PER_DAY = 100
 COOLDOWN_SECONDS = 2
 
+# ========== Отправка в Telegram ==========
+# Все запросы к Bot API идут через общую очередь (bot/outbound.py).
+# Лимиты Telegram: ~30 сообщений в секунду на бота, 1 в секунду в личный
+# чат, 20 в минуту в группу. Рассылки получают не больше TG_BULK_RATE,
+# остальное - запас для ответов собеседникам
+TG_GLOBAL_RATE = 30.0  # сообщений в секунду
+TG_BULK_RATE = 20.0
+TG_CHAT_RATE = 1.0
+TG_GROUP_RATE = 20 / 60
+TG_CHAT_BURST = 3
+# Сколько раз повторять запрос после RetryAfter
+TG_RETRY_ATTEMPTS = 3
+# RetryAfter ставит на паузу только свой чат; вся отправка встаёт, если flood wait
+# пришёл из стольких разных чатов за TG_FLOOD_GLOBAL_WINDOW секунд
+TG_FLOOD_GLOBAL_CHATS = 3
+TG_FLOOD_GLOBAL_WINDOW = 10
+
+# ========== Фильтр повторов и флуда ==========
+# Повтор (SimHash отличается не больше чем на SPAM_SIMHASH_DISTANCE бит из 64)
+# недавнего сообщения длиннее SPAM_MIN_LENGTH символов отвечается без Mistral.
+# Повторы добавляют очки спама в RateLimiter (затухают за SPAM_SCORE_HALF_LIFE
+# секунд вдвое), после SPAM_SCORE_LIMIT очков сообщения не принимаются
+ENABLE_SPAM_FILTER = os.getenv("ENABLE_SPAM_FILTER", "true").lower() == "true"
+SPAM_SIMHASH_DISTANCE = 6
+SPAM_MIN_LENGTH = 12
+SPAM_MAX_CHARS = 1000  # отпечаток считается по началу длинного сообщения
+SPAM_WINDOW_SECONDS = 600
+SPAM_HISTORY_SIZE = 8
+SPAM_FLOOD_REPEATS = 3  # столько повторов в окне - уже флуд
+SPAM_SCORE_LIMIT = 6.0
+SPAM_SCORE_HALF_LIFE = 300
+
+# ========== Бюджет токенов ==========
+# Токены Mistral (prompt + completion) на пользователя. После доли
+# TOKEN_BUDGET_SOFT_RATIO ответы генерируются экономнее (быстрая модель,
+# короче), после лимита - Махиро отвечает только триггерами
+# 0 - без ограничения
+TOKEN_BUDGET_DAILY = 40000
+TOKEN_BUDGET_MONTHLY = 600000
+TOKEN_BUDGET_SOFT_RATIO = 0.8
+# Во сколько раз больше бюджет у тех, кто поддержал бота звёздами
+DONOR_BUDGET_MULTIPLIER = 3
+# Общий дневной бюджет бота (0 - без ограничения)
+GLOBAL_TOKEN_BUDGET_DAILY = 3000000
+# Сколько пользователей держать в кэше счётчиков токенов (остальные читаются с диска)
+TOKEN_BUDGET_CACHE_USERS = 5000
+
 # ========== Whitelist/Blacklist ==========
 ADMIN_USER_IDS = [int(x) for x in os.getenv("ADMIN_USER_IDS", "").split(",") if x]
 BLACKLIST_USER_IDS = [int(x) for x in os.getenv("BLACKLIST_USER_IDS", "").split(",") if x]
@@ -34,7 +137,41 @@ WHITELIST_USER_IDS = [int(x) for x in os.getenv("WHITELIST_USER_IDS", "").split(
 
 # ========== Долгосрочная память ==========
 ENABLE_LONG_TERM_MEMORY = True
-MAX_FACTS_PER_USER = 50
+MAX_FACTS_PER_USER = 1000
+# Сколько фактов максимум попадает в промпт и сколько токенов они могут занять
+LTM_TOP_K = 8
+LTM_CONTEXT_TOKEN_BUDGET = 150
+# Ниже этого косинусного сходства факт считается нерелевантным сообщению
+LTM_MIN_SIMILARITY = 0.15
+# Сколько пользователей держать в кэше долгосрочной памяти (остальные читаются с диска)
+LTM_CACHE_USERS = 5000
+
+# ========== Архив диалогов ==========
+ARCHIVE_QUEUE_SIZE = 5000
+ARCHIVE_FLUSH_INTERVAL = 5  # секунд между записями пачек на диск
+ARCHIVE_EMBEDDING_RERANK = True
+# После стольких строк журнал индекса архива сворачивается в снимок
+ARCHIVE_COMPACT_LINES = 50000
+# Подмешивать в промпт старые реплики, похожие на текущее сообщение
+ENABLE_HISTORY_RECALL = False
+HISTORY_RECALL_TURNS = 4
+
+# ========== Извлечение фактов ==========
+FACT_EXTRACTION_QUEUE_SIZE = 2000
+FACT_EXTRACTION_BATCH_SIZE = 40
+FACT_EXTRACTION_INTERVAL = 30  # секунд на сбор пачки
+FACT_EXTRACTION_USE_LLM = True
+FACT_EXTRACTION_LLM_CALLS_PER_HOUR = 60
+# Предел ответа модели: JSON с фактами растёт с размером пачки
+FACT_EXTRACTION_LLM_BASE_TOKENS = 100
+FACT_EXTRACTION_LLM_TOKENS_PER_MESSAGE = 50
+
+# ========== Настроение ==========
+MOOD_DECAY_SECONDS = 1800  # за это время отклонение от базового настроения падает в e раз
+MOOD_MESSAGE_IMPULSE = 1.0
+MOOD_SET_STRENGTH = 1.5  # /setmood и мини-игры
+MOOD_MAX_INTENSITY = 2.0
+MOOD_SWITCH_MARGIN = 0.3  # насколько соперник должен обогнать текущее настроение
 
 # ========== Картинки ==========
 IMAGES_ENABLED = True
@@ -44,6 +181,26 @@ IMAGE_SEND_CHANCE = 0.1
 # ========== Статистика ==========
 ENABLE_STATISTICS = True
 
+# ========== Агрегаты активности ==========
+ACTIVITY_MINUTE_RETENTION_HOURS = 2
+ACTIVITY_HOURLY_RETENTION_DAYS = 30
+ACTIVITY_DAILY_RETENTION_DAYS = 365
+
+# ========== Логи ==========
+LOG_FILE = "mahiro_bot.log"
+LOG_ARCHIVE_DIR = "logs"
+LOG_MAX_BYTES = 5 * 1024 * 1024
+LOG_BACKUP_COUNT = 60
+LOG_ROTATE_DAILY = True
+LOG_QUEUE_SIZE = 10000
+# Доля INFO/DEBUG-записей, которые пишутся от логгеров, логирующих каждое сообщение
+LOG_SAMPLE_RATES = {
+    "ai.triggers": 0.1,
+    "memory.trust_system": 0.1,
+    "memory.mood_system": 0.1,
+    "utils.rate_limiter": 0.1,
+}
+
 # ========== Языки ==========
 DEFAULT_LANGUAGE = "ru"
 SUPPORTED_LANGUAGES = ["ru", "en"]
\ No newline at end of file
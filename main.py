@@ -1,14 +1,17 @@
 import asyncio
 import logging
-import sys
 from aiogram import Bot, Dispatcher
 from aiogram.fsm.storage.memory import MemoryStorage as FSMMemoryStorage
 from pathlib import Path
 
-from config import TELEGRAM_TOKEN, ADMIN_USER_IDS
+from config import TELEGRAM_TOKEN
 from bot.handlers import router as main_router
 from bot.admin_panel import router as admin_router
+from bot.middlewares import DedupMiddleware
+from bot.outbound import OutboundScheduler
 from utils.admin_notifications import admin_notifier
+from utils.services import fact_extractor, conversation_archive, acl, token_budget, degradation, activity_rollup
+from utils.logging_setup import setup_logging, stop_logging
 
 # Optional: run FastAPI admin panel alongside the bot
 try:
@@ -18,15 +21,8 @@ except Exception:
     admin_app = None
     HAVE_ADMIN_WEB = False
 
-# Настройка логирования
-logging.basicConfig(
-    level=logging.INFO,
-    format='%(asctime)s - %(name)s - %(levelname)s - %(message)s',
-    handlers=[
-        logging.StreamHandler(sys.stdout),
-        logging.FileHandler('mahiro_bot.log', encoding='utf-8')
-    ]
-)
+# Настройка логирования (запись в файл - в отдельном потоке)
+setup_logging()
 logger = logging.getLogger(__name__)
 
 # Создаём необходимые папки
@@ -47,11 +43,23 @@ async def main():
     
     # Инициализация бота
     bot = Bot(token=TELEGRAM_TOKEN)
+    # Все отправки - через общую очередь с лимитами Telegram
+    bot.session.middleware(OutboundScheduler())
     dp = Dispatcher(storage=storage)
     
     # Инициализируем систему уведомлений
     admin_notifier.set_bot(bot)
-    admin_notifier.set_admins(ADMIN_USER_IDS)
+    # Список админов обновляется вместе со списками доступа
+    acl.subscribe(lambda snapshot: admin_notifier.set_admins(sorted(snapshot.admins)))
+    # Переключения режима разгрузки - админам
+    degradation.subscribe(
+        lambda mode, reason: asyncio.create_task(admin_notifier.notify_degradation(mode, reason))
+    )
+    
+    # Повторно доставленные апдейты отбрасываются до обработчиков
+    dedup = DedupMiddleware()
+    await dedup.load()
+    dp.update.outer_middleware(dedup)
     
     # Регистрация роутеров (ВАЖНО: admin_router ПЕРВЫМ!)
     from bot.minigames import router as minigames_router
@@ -92,6 +100,11 @@ async def main():
         except Exception as e:
             logger.warning(f"Не удалось запустить admin web: {e}")
 
+    # Фоновое извлечение фактов в долгосрочную память
+    fact_extractor.start()
+    # Фоновая запись архива диалогов и его индекса
+    conversation_archive.start()
+
     # Запуск polling
     try:
         await dp.start_polling(bot, allowed_updates=["message", "callback_query"])
@@ -103,6 +116,11 @@ async def main():
                 await admin_task
             except asyncio.CancelledError:
                 pass
+        await fact_extractor.stop()
+        await conversation_archive.stop()
+        await token_budget.flush()
+        await activity_rollup.flush()
+        await dedup.flush()
         await bot.session.close()
         logger.info("Бот остановлен")
 
@@ -113,4 +131,6 @@ if __name__ == "__main__":
     except KeyboardInterrupt:
         logger.info("Получен сигнал остановки (Ctrl+C)")
     except Exception as e:
-        logger.error(f"Критическая ошибка: {e}", exc_info=True)
\ No newline at end of file
+        logger.error(f"Критическая ошибка: {e}", exc_info=True)
+    finally:
+        stop_logging()
\ No newline at end of file
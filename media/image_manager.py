@@ -5,9 +5,14 @@ import logging
 
 from aiogram.types import FSInputFile
 from config import IMAGES_FOLDER, IMAGES_ENABLED, IMAGE_SEND_CHANCE
+from utils.metrics import images_sent
 
 logger = logging.getLogger(__name__)
 
+_sent_ok = images_sent.labels("ok")
+_sent_error = images_sent.labels("error")
+_sent_missing = images_sent.labels("missing")
+
 
 class ImageManager:
     """
@@ -130,6 +135,7 @@ class ImageManager:
 
         if not image_path:
             logger.warning("Не удалось найти картинку для отправки")
+            _sent_missing.inc()
             return
 
         try:
@@ -139,8 +145,10 @@ class ImageManager:
                 photo=photo,
                 caption=caption
             )
+            _sent_ok.inc()
             logger.info(f"Отправлена картинка: {image_path.name}")
         except Exception as e:
+            _sent_error.inc()
             logger.error(f"Ошибка отправки картинки: {e}")
 
     def get_statistics(self) -> dict:
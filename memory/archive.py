@@ -0,0 +1,576 @@
+"""
+Архив всех реплик и поиск по нему
+
+Каждая реплика дописывается в сжатый файл пользователя
+data/archive/<user_id % 256>/<user_id>.jsonl.gz (новый gzip-член на пачку).
+Рядом ведётся инвертированный индекс: append-only журнал postings.log,
+где на каждую реплику одна строка с частотами её терминов и смещением
+gzip-члена, в котором она лежит, - чтобы читать только его, а не весь
+файл. Журнал время от времени сворачивается в снимок postings.jsonl
+(строка на термин и на пользователя; пишется частями, не останавливая бота).
+При старте читается снимок и хвост журнала, дальше индекс пополняется
+инкрементально. Запись идёт в фоне из очереди, ответ пользователю её не ждёт.
+"""
+import asyncio
+import gzip
+import json
+import logging
+import math
+import os
+import re
+import time
+import zlib
+from bisect import bisect_left
+from collections import Counter
+from datetime import datetime
+from pathlib import Path
+from typing import Dict, List, Optional, Tuple
+
+import aiofiles
+import numpy as np
+
+from config import (
+    ARCHIVE_QUEUE_SIZE,
+    ARCHIVE_FLUSH_INTERVAL,
+    ARCHIVE_EMBEDDING_RERANK,
+    ARCHIVE_COMPACT_LINES,
+)
+from memory.vector_index import embed
+from utils.metrics import metrics, queue_depth, storage_seconds
+
+logger = logging.getLogger(__name__)
+
+_queue_depth = queue_depth.labels("archive")
+_dropped = metrics.counter("mahiro_archive_dropped_total", "Реплики, не попавшие в архив из-за переполнения очереди")
+_write_seconds = storage_seconds.labels("archive", "write")
+_search_seconds = metrics.histogram("mahiro_archive_search_seconds", "Поиск по архиву", labels=("kind",))
+_admin_search_seconds = _search_seconds.labels("admin")
+_recall_seconds = _search_seconds.labels("recall")
+
+SHARDS = 256
+
+_WORD_RE = re.compile(r"\w+", re.UNICODE)
+_STOPWORDS = frozenset(
+    "и в во не на я ты он она мы вы они что как а но то это с со к по за из у же ли бы "
+    "да нет ну мне меня тебе тебя так все всё еще ещё уже там тут вот".split()
+)
+# Префикс как грубый стемминг: «котик», «котики», «котиков» -> «котик»
+STEM_LENGTH = 5
+
+# Параметры BM25
+_K1 = 1.2
+_B = 0.75
+
+
+def tokenize(text: str) -> List[str]:
+    """Термины реплики: слова без стоп-слов, обрезанные до STEM_LENGTH"""
+    terms = []
+    for word in _WORD_RE.findall(text.lower().replace("ё", "е")):
+        if len(word) < 2 or word in _STOPWORDS:
+            continue
+        terms.append(word[:STEM_LENGTH])
+    return terms
+
+
+def _read_member(f, offset: int) -> bytes:
+    """Распаковывает один gzip-член, начинающийся со смещения offset"""
+    f.seek(offset)
+    decompressor = zlib.decompressobj(16 + zlib.MAX_WBITS)
+    chunks = []
+    while not decompressor.eof:
+        block = f.read(64 * 1024)
+        if not block:
+            break
+        chunks.append(decompressor.decompress(block))
+    return b"".join(chunks)
+
+
+class ConversationArchive:
+    """
+    Полная история диалогов с поиском
+
+    Реплика адресуется парой (user_id, seq), seq - её номер у
+    пользователя. Списки вхождений терминов разложены по пользователям
+    и упорядочены по seq, так что вспоминание для одного пользователя
+    не обходит чужие реплики. Поиск - BM25 по инвертированному индексу,
+    при ARCHIVE_EMBEDDING_RERANK лучшие кандидаты дополнительно
+    переранжируются по косинусному сходству хэширующих эмбеддингов.
+    """
+
+    # Терминов (или пользователей) на одну часть снимка
+    COMPACT_CHUNK = 500
+
+    def __init__(self, storage_dir: str = "data"):
+        self.root = Path(storage_dir) / "archive"
+        self.root.mkdir(parents=True, exist_ok=True)
+        self.postings_file = self.root / "postings.log"
+        self.snapshot_file = self.root / "postings.jsonl"
+
+        # термин -> user_id -> [[seq, tf, длина реплики]] по возрастанию seq
+        self._postings: Dict[str, Dict[int, List[List[int]]]] = {}
+        # термин -> в скольких репликах встречается
+        self._df: Counter = Counter()
+        # user_id -> seq -> смещение gzip-члена с репликой (-1 - неизвестно)
+        self._docs: Dict[int, Dict[int, int]] = {}
+        self._doc_count = 0
+        self._total_len = 0
+        # Строк в журнале после последнего снимка
+        self._journal_lines = 0
+        # user_id -> число реплик в архиве
+        self._turns: Dict[int, int] = {}
+        # user_id -> seq, с которого начинается вспоминание (после /reset)
+        self._recall_floor: Dict[int, int] = {}
+
+        self._loaded = False
+        self._load_lock = asyncio.Lock()
+        self._flush_lock = asyncio.Lock()
+        self._queue: asyncio.Queue = asyncio.Queue(maxsize=ARCHIVE_QUEUE_SIZE)
+        self._task: Optional[asyncio.Task] = None
+
+    # ========== Файлы ==========
+
+    def _user_file(self, user_id: int) -> Path:
+        return self.root / f"{user_id % SHARDS:02x}" / f"{user_id}.jsonl.gz"
+
+    async def _ensure_loaded(self):
+        """Загружает индекс (один раз); до окончания загрузки recall ничего не вспоминает"""
+        if self._loaded:
+            return
+        async with self._load_lock:
+            if not self._loaded:
+                await asyncio.to_thread(self._load_index)
+                self._loaded = True
+
+    def _load_index(self):
+        """Читает снимок postings.jsonl и хвост журнала postings.log в память"""
+        started = time.perf_counter()
+        if self.snapshot_file.exists():
+            try:
+                with open(self.snapshot_file, "r", encoding="utf-8") as f:
+                    self._restore(f)
+            except Exception as e:
+                logger.error(f"Ошибка загрузки снимка индекса архива: {e}")
+
+        if self.postings_file.exists():
+            with open(self.postings_file, "r", encoding="utf-8") as f:
+                for line in f:
+                    try:
+                        entry = json.loads(line)
+                    except ValueError:
+                        # Недописанная строка после аварийной остановки
+                        continue
+                    self._apply(entry)
+                    self._journal_lines += 1
+
+        logger.info(
+            f"Индекс архива загружен: {self._doc_count} реплик, {len(self._postings)} терминов, "
+            f"{self._journal_lines} строк журнала за {time.perf_counter() - started:.2f}с"
+        )
+
+    def _apply(self, entry: Dict):
+        """Применяет строку журнала к индексу в памяти"""
+        user_id = entry["u"]
+
+        if "reset" in entry:
+            self._recall_floor[user_id] = entry["reset"]
+            return
+
+        seq = entry["s"]
+        docs = self._docs.setdefault(user_id, {})
+        if seq in docs:
+            # Строка уже вошла в снимок (остановка между снимком и очисткой журнала)
+            return
+        docs[seq] = entry.get("o", -1)
+
+        terms = entry["tf"]
+        length = sum(terms.values())
+        for term, tf in terms.items():
+            self._postings.setdefault(term, {}).setdefault(user_id, []).append([seq, tf, length])
+            self._df[term] += 1
+
+        self._doc_count += 1
+        self._total_len += length
+        self._turns[user_id] = max(self._turns.get(user_id, 0), seq + 1)
+
+    def _restore(self, lines):
+        """
+        Поднимает индекс из строк снимка:
+            {"t": термин, "p": {user_id: [[seq, tf, длина]]}}
+            {"u": user_id, "n": число реплик, "d": [[seq, смещение]], "f": начало вспоминания}
+            {"total_len": ...} - последняя строка
+        """
+        for line in lines:
+            item = json.loads(line)
+            if "t" in item:
+                by_user = {int(uid): postings for uid, postings in item["p"].items()}
+                self._postings[item["t"]] = by_user
+                self._df[item["t"]] = sum(len(postings) for postings in by_user.values())
+            elif "u" in item:
+                user_id = item["u"]
+                self._docs[user_id] = {seq: offset for seq, offset in item["d"]}
+                self._doc_count += len(item["d"])
+                self._turns[user_id] = item["n"]
+                if "f" in item:
+                    self._recall_floor[user_id] = item["f"]
+            else:
+                self._total_len = item["total_len"]
+
+    def _snapshot_lines(self, terms: List[str], users: List[int]):
+        """Строки снимка частями по COMPACT_CHUNK терминов или пользователей"""
+        for start in range(0, len(terms), self.COMPACT_CHUNK):
+            yield "".join(
+                json.dumps({"t": term, "p": self._postings[term]}, ensure_ascii=False, separators=(",", ":")) + "\n"
+                for term in terms[start:start + self.COMPACT_CHUNK]
+            )
+
+        for start in range(0, len(users), self.COMPACT_CHUNK):
+            chunk = []
+            for user_id in users[start:start + self.COMPACT_CHUNK]:
+                item = {
+                    "u": user_id,
+                    "n": self._turns[user_id],
+                    "d": list(self._docs.get(user_id, {}).items()),
+                }
+                if user_id in self._recall_floor:
+                    item["f"] = self._recall_floor[user_id]
+                chunk.append(json.dumps(item, separators=(",", ":")) + "\n")
+            yield "".join(chunk)
+
+        yield json.dumps({"total_len": self._total_len}) + "\n"
+
+    async def _compact(self):
+        """
+        Сворачивает журнал в снимок (под _flush_lock)
+
+        Пока держится _flush_lock, индекс не меняется. Снимок
+        сериализуется частями по COMPACT_CHUNK терминов, между частями
+        цикл событий свободен - большой индекс не останавливает ответы.
+        """
+        started = time.perf_counter()
+        terms = list(self._postings)
+        users = list(self._turns)
+
+        tmp_path = self.snapshot_file.with_suffix(".tmp")
+        async with aiofiles.open(tmp_path, "w", encoding="utf-8") as f:
+            for chunk in self._snapshot_lines(terms, users):
+                await f.write(chunk)
+        os.replace(tmp_path, self.snapshot_file)
+
+        async with aiofiles.open(self.postings_file, "w", encoding="utf-8") as f:
+            await f.write("")
+        logger.info(
+            f"Журнал индекса архива свёрнут: {self._journal_lines} строк "
+            f"за {time.perf_counter() - started:.2f}с"
+        )
+        self._journal_lines = 0
+
+    async def _maybe_compact(self):
+        """Сворачивает журнал, если он дорос до ARCHIVE_COMPACT_LINES строк"""
+        if self._journal_lines < ARCHIVE_COMPACT_LINES:
+            return
+        async with self._flush_lock:
+            try:
+                await self._compact()
+            except Exception as e:
+                logger.error(f"Ошибка сворачивания журнала архива: {e}", exc_info=True)
+
+    def _write_batch(self, batch: List[Tuple[int, str, str, int, int]]) -> List[Dict]:
+        """
+        Дописывает пачку реплик в архивы пользователей и журнал индекса
+
+        Выполняется в отдельном потоке. seq назначаются заранее,
+        в цикле событий, поэтому здесь только I/O.
+
+        Returns:
+            строки журнала для применения к индексу
+        """
+        started = time.perf_counter()
+        by_user: Dict[int, List[str]] = {}
+        entries = []
+
+        for user_id, role, content, timestamp, seq in batch:
+            line = json.dumps({"s": seq, "t": timestamp, "r": role, "c": content}, ensure_ascii=False)
+            by_user.setdefault(user_id, []).append(line)
+
+        # Пачка пользователя - один gzip-член; его смещение попадает в индекс
+        offsets = {}
+        for user_id, lines in by_user.items():
+            path = self._user_file(user_id)
+            path.parent.mkdir(exist_ok=True)
+            offsets[user_id] = path.stat().st_size if path.exists() else 0
+            with gzip.open(path, "at", encoding="utf-8") as f:
+                f.write("\n".join(lines) + "\n")
+
+        for user_id, role, content, timestamp, seq in batch:
+            entries.append({"u": user_id, "s": seq, "o": offsets[user_id], "tf": dict(Counter(tokenize(content)))})
+
+        with open(self.postings_file, "a", encoding="utf-8") as f:
+            for entry in entries:
+                f.write(json.dumps(entry, ensure_ascii=False, separators=(",", ":")) + "\n")
+
+        _write_seconds.observe(time.perf_counter() - started)
+        return entries
+
+    def _read_turns(self, user_id: int, offsets: Dict[int, int]) -> Dict[int, Dict]:
+        """
+        Читает нужные реплики из архива пользователя (в отдельном потоке)
+
+        Args:
+            offsets: seq -> смещение gzip-члена; распаковываются только эти члены
+        """
+        path = self._user_file(user_id)
+        if not path.exists():
+            return {}
+
+        with open(path, "rb") as f:
+            if any(offset < 0 for offset in offsets.values()):
+                # Реплики из журнала без смещений - файл целиком
+                blocks = [gzip.decompress(f.read())]
+            else:
+                blocks = [_read_member(f, offset) for offset in sorted(set(offsets.values()))]
+
+        found = {}
+        for block in blocks:
+            for line in block.decode("utf-8").splitlines():
+                # Быстрая проверка номера до разбора всей строки
+                head = line[6:line.find(",", 6)]
+                if not head.isdigit() or int(head) not in offsets:
+                    continue
+                try:
+                    turn = json.loads(line)
+                except ValueError:
+                    continue
+                found[turn["s"]] = turn
+        return found
+
+    # ========== Запись ==========
+
+    def submit(self, user_id: int, user_text: str, reply: str):
+        """Ставит обмен репликами в очередь на архивирование (без ожидания)"""
+        timestamp = int(time.time())
+        for role, content in (("user", user_text), ("assistant", reply)):
+            try:
+                self._queue.put_nowait((user_id, role, content, timestamp))
+                _queue_depth.inc()
+            except asyncio.QueueFull:
+                _dropped.inc()
+
+    async def mark_reset(self, user_id: int):
+        """После /reset старые реплики больше не вспоминаются в диалоге (но ищутся админом)"""
+        await self._flush()
+        async with self._flush_lock:
+            entry = {"u": user_id, "reset": self._turns.get(user_id, 0)}
+            self._apply(entry)
+            await asyncio.to_thread(self._append_postings, entry)
+            self._journal_lines += 1
+
+    def _append_postings(self, entry: Dict):
+        with open(self.postings_file, "a", encoding="utf-8") as f:
+            f.write(json.dumps(entry, separators=(",", ":")) + "\n")
+
+    async def _flush(self):
+        """Записывает всё, что накопилось в очереди"""
+        await self._ensure_loaded()
+
+        async with self._flush_lock:
+            batch = []
+            while not self._queue.empty():
+                user_id, role, content, timestamp = self._queue.get_nowait()
+                _queue_depth.dec()
+                seq = self._turns.get(user_id, 0)
+                self._turns[user_id] = seq + 1
+                batch.append((user_id, role, content, timestamp, seq))
+
+            if not batch:
+                return
+
+            try:
+                entries = await asyncio.to_thread(self._write_batch, batch)
+            except Exception as e:
+                logger.error(f"Ошибка записи архива: {e}", exc_info=True)
+                return
+
+            for entry in entries:
+                self._apply(entry)
+            self._journal_lines += len(entries)
+
+        await self._maybe_compact()
+
+    async def _backfill(self):
+        """Первый запуск: переносит в архив текущие истории user_*.json"""
+        if self.postings_file.exists() or self.snapshot_file.exists():
+            return
+
+        for path in sorted(self.root.parent.glob("user_*.json")):
+            try:
+                user_id = int(path.stem.split("_", 1)[1])
+                with open(path, "r", encoding="utf-8") as f:
+                    history = json.load(f).get("history", [])
+            except Exception:
+                continue
+
+            timestamp = int(path.stat().st_mtime)
+            # Индекс меняется только под _flush_lock - как в _flush и _compact
+            async with self._flush_lock:
+                batch = []
+                for message in history:
+                    seq = self._turns.get(user_id, 0)
+                    self._turns[user_id] = seq + 1
+                    batch.append((user_id, message.get("role"), message.get("content") or "", timestamp, seq))
+
+                if batch:
+                    for entry in await asyncio.to_thread(self._write_batch, batch):
+                        self._apply(entry)
+                        self._journal_lines += 1
+
+        # Журнал должен существовать, даже если переносить было нечего
+        self.postings_file.touch()
+
+    async def _run(self):
+        await self._ensure_loaded()
+        try:
+            await self._backfill()
+        except Exception as e:
+            logger.error(f"Ошибка переноса историй в архив: {e}", exc_info=True)
+
+        while True:
+            await asyncio.sleep(ARCHIVE_FLUSH_INTERVAL)
+            await self._flush()
+
+    def start(self):
+        """Запускает фоновую запись архива"""
+        if self._task is None:
+            self._task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        """Останавливает фоновую задачу и дописывает очередь"""
+        if self._task is None:
+            return
+        self._task.cancel()
+        try:
+            await self._task
+        except asyncio.CancelledError:
+            pass
+        self._task = None
+        await self._flush()
+
+    # ========== Поиск ==========
+
+    def _bm25(self, terms: List[str], user_id: Optional[int] = None,
+              max_seq: Optional[int] = None, min_seq: int = 0) -> Counter:
+        """Оценки BM25 по репликам (с фильтром по пользователю и диапазону seq)"""
+        scores = Counter()
+        total_docs = self._doc_count
+        if not total_docs:
+            return scores
+        avg_len = self._total_len / total_docs or 1
+
+        for term in set(terms):
+            by_user = self._postings.get(term)
+            if not by_user:
+                continue
+            df = self._df[term]
+            idf = math.log(1 + (total_docs - df + 0.5) / (df + 0.5))
+
+            if user_id is None:
+                groups = by_user.items()
+            else:
+                # Список пользователя отсортирован по seq - диапазон берётся бинарным поиском
+                postings = by_user.get(user_id)
+                if not postings:
+                    continue
+                start = bisect_left(postings, [min_seq])
+                end = len(postings) if max_seq is None else bisect_left(postings, [max_seq])
+                groups = ((user_id, postings[start:end]),)
+
+            for uid, postings in groups:
+                for seq, tf, length in postings:
+                    scores[(uid, seq)] += idf * tf * (_K1 + 1) / (tf + _K1 * (1 - _B + _B * length / avg_len))
+
+        return scores
+
+    async def _fetch(self, keys: List[Tuple[int, int]]) -> Dict[Tuple[int, int], Dict]:
+        by_user: Dict[int, Dict[int, int]] = {}
+        for uid, seq in keys:
+            by_user.setdefault(uid, {})[seq] = self._docs.get(uid, {}).get(seq, -1)
+
+        turns = {}
+        for uid, offsets in by_user.items():
+            for seq, turn in (await asyncio.to_thread(self._read_turns, uid, offsets)).items():
+                turns[(uid, seq)] = turn
+        return turns
+
+    def _rerank(self, query: str, candidates: List[Tuple[Tuple[int, int], float]],
+                turns: Dict[Tuple[int, int], Dict]) -> List[Tuple[Tuple[int, int], float]]:
+        """Смешивает BM25 с косинусным сходством эмбеддингов"""
+        keys = [key for key, _ in candidates if key in turns]
+        if not keys:
+            return []
+
+        matrix = np.stack([embed(turns[key]["c"]) for key in keys])
+        similarity = matrix @ embed(query)
+        top_bm25 = max(score for _, score in candidates) or 1.0
+        bm25 = dict(candidates)
+
+        mixed = [(key, 0.5 * bm25[key] / top_bm25 + 0.5 * float(sim)) for key, sim in zip(keys, similarity)]
+        return sorted(mixed, key=lambda item: -item[1])
+
+    async def search(self, query: str, user_id: Optional[int] = None, limit: int = 10) -> List[Dict]:
+        """
+        Поиск реплик по всему архиву (или по одному пользователю)
+
+        Returns:
+            [{"user_id", "seq", "role", "content", "time", "score"}] по убыванию релевантности
+        """
+        started = time.perf_counter()
+        await self._ensure_loaded()
+
+        scores = self._bm25(tokenize(query), user_id)
+        candidates = scores.most_common(limit * 5 if ARCHIVE_EMBEDDING_RERANK else limit)
+        turns = await self._fetch([key for key, _ in candidates])
+
+        if ARCHIVE_EMBEDDING_RERANK:
+            ranked = self._rerank(query, candidates, turns)[:limit]
+        else:
+            ranked = [(key, score) for key, score in candidates if key in turns]
+
+        _admin_search_seconds.observe(time.perf_counter() - started)
+        return [
+            {
+                "user_id": uid,
+                "seq": seq,
+                "role": turns[(uid, seq)]["r"],
+                "content": turns[(uid, seq)]["c"],
+                "time": datetime.fromtimestamp(turns[(uid, seq)]["t"]),
+                "score": round(score, 3),
+            }
+            for (uid, seq), score in ranked
+        ]
+
+    async def recall(self, user_id: int, query: str, skip_recent: int, limit: int) -> List[Dict]:
+        """
+        Старые реплики пользователя, похожие на текущее сообщение
+
+        Args:
+            skip_recent: сколько последних реплик не брать (они и так в истории)
+            limit: сколько реплик вернуть
+        """
+        started = time.perf_counter()
+        if not self._loaded:
+            # Индекс ещё грузится в фоне - не задерживаем ответ
+            return []
+
+        max_seq = self._turns.get(user_id, 0) - skip_recent
+        min_seq = self._recall_floor.get(user_id, 0)
+        if max_seq <= min_seq:
+            return []
+
+        scores = self._bm25(tokenize(query), user_id, max_seq=max_seq, min_seq=min_seq)
+        best = [key for key, _ in scores.most_common(limit)]
+        turns = await self._fetch(best) if best else {}
+
+        _recall_seconds.observe(time.perf_counter() - started)
+        return [
+            {"role": turns[key]["r"], "content": turns[key]["c"], "time": datetime.fromtimestamp(turns[key]["t"])}
+            for key in sorted(best) if key in turns
+        ]
@@ -0,0 +1,244 @@
+import asyncio
+import json
+import logging
+import re
+import time
+from collections import deque
+from typing import Dict, List, Optional, Tuple
+
+from config import (
+    ENABLE_LONG_TERM_MEMORY,
+    FACT_EXTRACTION_QUEUE_SIZE,
+    FACT_EXTRACTION_BATCH_SIZE,
+    FACT_EXTRACTION_INTERVAL,
+    FACT_EXTRACTION_USE_LLM,
+    FACT_EXTRACTION_LLM_CALLS_PER_HOUR,
+    FACT_EXTRACTION_LLM_BASE_TOKENS,
+    FACT_EXTRACTION_LLM_TOKENS_PER_MESSAGE,
+)
+from utils.metrics import metrics, queue_depth
+
+logger = logging.getLogger(__name__)
+
+_queue_depth = queue_depth.labels("fact_extraction")
+_submitted = metrics.counter("mahiro_fact_messages_total", "Сообщения, отправленные на извлечение фактов", labels=("status",))
+_submitted_ok = _submitted.labels("queued")
+_submitted_dropped = _submitted.labels("dropped")
+_extracted = metrics.counter("mahiro_facts_extracted_total", "Извлечённые факты", labels=("source",))
+_extracted_rules = _extracted.labels("rules")
+_extracted_llm = _extracted.labels("llm")
+
+_NAME_WORD = r"([а-яёa-z]+(?:-[а-яёa-z]+)?)"
+# Слова после «зови меня» / «меня зовут», которые не бывают именем
+_NAME_STOP_WORDS = {
+    "когда", "если", "как", "так", "просто", "тоже", "теперь", "сегодня", "лучше", "все", "всё",
+    "тебя", "меня", "что", "чтобы", "не", "уже", "ещё", "еще", "иначе", "на", "в", "к", "домой",
+}
+_MONTHS = r"(?:января|февраля|марта|апреля|мая|июня|июля|августа|сентября|октября|ноября|декабря)"
+# Хвост фразы до знака препинания или до «... и я ...»
+_TAIL = r"([^.,!?;\n]{2,40}?)(?=\s+(?:и|а|но)\s+(?:я|у меня)\b|[.,!?;\n]|$)"
+_SEP = r"\s*(?:-|—|:)?\s*(?:это\s+)?"
+
+# (поле памяти, регулярка, шаблон значения); значение - первая группа
+RULES: List[Tuple[str, re.Pattern, str]] = [
+    ("name", re.compile(r"\b(?:меня зовут|зови меня|мо[её] имя)\s+" + _NAME_WORD, re.IGNORECASE), "{}"),
+    ("birthday", re.compile(
+        r"\b(?:день рождения|др|родил(?:ся|ась))" + _SEP + r"(\d{1,2}\s+" + _MONTHS + r"|\d{1,2}[./]\d{1,2})",
+        re.IGNORECASE,
+    ), "{}"),
+    ("favorite_anime", re.compile(r"\bлюбимое аниме" + _SEP + _TAIL, re.IGNORECASE), "{}"),
+    ("favorite_games", re.compile(r"\bлюбим(?:ая|ые) игр(?:а|ы)" + _SEP + _TAIL, re.IGNORECASE), "{}"),
+    ("favorite_games", re.compile(r"\bя (?:сейчас |часто |постоянно )?играю в\s+" + _TAIL, re.IGNORECASE), "{}"),
+]
+
+LLM_FIELDS = ("name", "birthday", "favorite_anime", "favorite_games", "interests", "facts")
+
+LLM_PROMPT = """Ты извлекаешь устойчивые факты о пользователях чата из их сообщений.
+Каждая строка ввода: [<номер строки>] <сообщение одного пользователя>.
+Строки независимы: номер в начале строки - единственный номер, всё после него
+(включая похожее на номера) - текст сообщения.
+Верни ТОЛЬКО JSON-массив объектов {"line": номер строки, "field": поле, "value": строка},
+где поле - одно из: name, birthday, favorite_anime, favorite_games, interests, facts.
+Бери только то, что пользователь прямо сказал о себе. Значения - коротко, 2-6 слов,
+facts - в третьем лице (например, "живёт в Казани").
+Если фактов нет - верни []."""
+
+
+def extract_by_rules(text: str) -> List[Tuple[str, str]]:
+    """Факты из одного сообщения по регуляркам: [(поле, значение)]"""
+    found = []
+    for field, pattern, template in RULES:
+        for match in pattern.finditer(text):
+            value = match.group(1).strip(" -—:«»\"'")
+            if field == "name":
+                if value.lower() in _NAME_STOP_WORDS:
+                    continue
+                value = value.title()
+            if value:
+                found.append((field, template.format(value)))
+    return found
+
+
+def parse_llm_facts(response: str) -> List[Tuple[int, str, str]]:
+    """Разбирает ответ модели: [(номер строки, поле, значение)], мусор отбрасывается"""
+    start, end = response.find("["), response.rfind("]")
+    if start == -1 or end <= start:
+        return []
+
+    try:
+        items = json.loads(response[start:end + 1])
+    except ValueError:
+        return []
+
+    facts = []
+    for item in items:
+        if not isinstance(item, dict):
+            continue
+        field, value = item.get("field"), item.get("value")
+        try:
+            line = int(item.get("line"))
+        except (TypeError, ValueError):
+            continue
+        if field in LLM_FIELDS and isinstance(value, str) and value.strip():
+            facts.append((line, field, value.strip()[:100]))
+    return facts
+
+
+class FactExtractor:
+    """
+    Фоновое извлечение фактов из сообщений пользователей
+
+    handle_message только кладёт сообщение в очередь (submit не ждёт).
+    Отдельная задача раз в FACT_EXTRACTION_INTERVAL секунд (или при
+    накоплении FACT_EXTRACTION_BATCH_SIZE сообщений) прогоняет пачку
+    через регулярки и, если включено, одним запросом к Mistral на всю
+    пачку сразу. Запросы к модели ограничены собственным бюджетом
+    в час и идут строго по одному, не мешая ответам пользователям;
+    их токены учитываются в общем бюджете бота.
+    """
+
+    def __init__(self, long_term_memory, mistral_client, token_budget):
+        self.long_term_memory = long_term_memory
+        self.mistral_client = mistral_client
+        self.token_budget = token_budget
+        self.use_llm = FACT_EXTRACTION_USE_LLM
+        self._queue: asyncio.Queue = asyncio.Queue(maxsize=FACT_EXTRACTION_QUEUE_SIZE)
+        self._llm_calls = deque()
+        self._task: Optional[asyncio.Task] = None
+
+    def submit(self, user_id: int, text: str):
+        """Ставит сообщение в очередь на извлечение (без ожидания)"""
+        if not ENABLE_LONG_TERM_MEMORY or not text:
+            return
+        try:
+            self._queue.put_nowait((user_id, text))
+            _submitted_ok.inc()
+            _queue_depth.inc()
+        except asyncio.QueueFull:
+            _submitted_dropped.inc()
+
+    def start(self):
+        """Запускает фоновую задачу"""
+        if self._task is None:
+            self._task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        """Останавливает задачу и дообрабатывает то, что уже в очереди"""
+        if self._task is None:
+            return
+        self._task.cancel()
+        try:
+            await self._task
+        except asyncio.CancelledError:
+            pass
+        self._task = None
+
+        batch = self._drain(self._queue.qsize())
+        if batch:
+            await self._process(batch, use_llm=False)
+
+    def _drain(self, limit: int) -> List[Tuple[int, str]]:
+        batch = []
+        while len(batch) < limit and not self._queue.empty():
+            batch.append(self._queue.get_nowait())
+            _queue_depth.dec()
+        return batch
+
+    async def _run(self):
+        while True:
+            # Ждём первое сообщение, потом добираем пачку до конца интервала
+            first = await self._queue.get()
+            _queue_depth.dec()
+            batch = [first]
+            deadline = time.monotonic() + FACT_EXTRACTION_INTERVAL
+
+            while len(batch) < FACT_EXTRACTION_BATCH_SIZE:
+                timeout = deadline - time.monotonic()
+                if timeout <= 0:
+                    break
+                try:
+                    batch.append(await asyncio.wait_for(self._queue.get(), timeout))
+                    _queue_depth.dec()
+                except asyncio.TimeoutError:
+                    break
+
+            try:
+                await self._process(batch, use_llm=self.use_llm)
+            except Exception as e:
+                logger.error(f"Ошибка извлечения фактов: {e}", exc_info=True)
+
+    def _llm_budget_available(self) -> bool:
+        now = time.monotonic()
+        while self._llm_calls and now - self._llm_calls[0] > 3600:
+            self._llm_calls.popleft()
+        return len(self._llm_calls) < FACT_EXTRACTION_LLM_CALLS_PER_HOUR
+
+    async def _extract_with_llm(self, batch: List[Tuple[int, str]]) -> List[Tuple[int, str, str]]:
+        # Пачки обрабатывает одна задача, так что запросы к модели и так идут по одному
+        if not self._llm_budget_available():
+            return []
+        self._llm_calls.append(time.monotonic())
+
+        # Каждое сообщение - ровно одна строка: перевод строки в тексте не
+        # должен выглядеть как сообщение другого пользователя
+        lines = "\n".join(
+            f"[{index}] {' '.join(text[:500].split())}" for index, (_, text) in enumerate(batch)
+        )
+        result = await self.mistral_client.generate(
+            system_prompt=LLM_PROMPT,
+            history=[],
+            user_message=lines,
+            temperature=0.0,
+            max_tokens=FACT_EXTRACTION_LLM_BASE_TOKENS + FACT_EXTRACTION_LLM_TOKENS_PER_MESSAGE * len(batch),
+            # Извлечение фактов подождёт - слоты в первую очередь для живых разговоров
+            priority="background",
+        )
+
+        if not result:
+            return []
+        if not result.shared:
+            # Запрос ничей - токены идут только в общий дневной бюджет бота
+            await self.token_budget.record_global(result.total_tokens)
+        response = result.text
+        # Пользователя определяет номер строки, а не то, что написала модель
+        return [
+            (batch[line][0], field, value)
+            for line, field, value in parse_llm_facts(response)
+            if 0 <= line < len(batch)
+        ]
+
+    async def _process(self, batch: List[Tuple[int, str]], use_llm: bool):
+        updates: Dict[int, List[Tuple[str, str]]] = {}
+
+        for user_id, text in batch:
+            for field, value in extract_by_rules(text):
+                updates.setdefault(user_id, []).append((field, value))
+                _extracted_rules.inc()
+
+        if use_llm:
+            for user_id, field, value in await self._extract_with_llm(batch):
+                updates.setdefault(user_id, []).append((field, value))
+                _extracted_llm.inc()
+
+        for user_id, facts in updates.items():
+            await self.long_term_memory.merge_facts(user_id, facts)
@@ -1,45 +1,99 @@
-from typing import Dict, List, Optional
+from collections import OrderedDict
+from typing import Dict, List, Optional, Tuple
 from pathlib import Path
+import asyncio
 import json
 import aiofiles
 from datetime import datetime
 import logging
+import re
 
-from config import MAX_FACTS_PER_USER, ENABLE_LONG_TERM_MEMORY
+from config import (
+    MAX_FACTS_PER_USER, ENABLE_LONG_TERM_MEMORY, LTM_TOP_K, LTM_CONTEXT_TOKEN_BUDGET, LTM_MIN_SIMILARITY,
+    LTM_CACHE_USERS,
+)
+from memory.storage import UserRecordStore
+from memory.vector_index import FactIndex
+from utils.metrics import cache_requests
 
 logger = logging.getLogger(__name__)
 
+_cache_hit = cache_requests.labels("long_term_memory", "hit")
+_cache_miss = cache_requests.labels("long_term_memory", "miss")
+
+# Сколько значений хранится в списочных полях (интересы, любимое аниме и игры)
+MAX_LIST_ITEMS = 20
+
+
+def _encode(memory: Dict) -> Dict:
+    """Память -> компактная запись: факты хранятся как [текст, unix-время]"""
+    record = {key: value for key, value in memory.items() if value}
+    if memory["facts"]:
+        record["facts"] = [
+            [fact["text"], int(datetime.fromisoformat(fact["timestamp"]).timestamp())]
+            for fact in memory["facts"]
+        ]
+    return record
+
+
+def _decode(record: Dict) -> Dict:
+    """Компактная запись -> память в привычном виде"""
+    memory = LongTermMemory._get_empty_memory()
+    memory.update(record)
+    memory["facts"] = [
+        {"text": text, "timestamp": datetime.fromtimestamp(ts).isoformat()}
+        for text, ts in record.get("facts", [])
+    ]
+    return memory
+
 
 class LongTermMemory:
-    """Долгосрочная память - запоминание фактов о пользователе"""
+    """
+    Долгосрочная память - запоминание фактов о пользователе
+
+    Память каждого пользователя - отдельная запись в UserRecordStore,
+    поэтому чтение и запись фактов касаются только его файла. В памяти
+    процесса держатся только LTM_CACHE_USERS недавних собеседников.
+    """
 
     def __init__(self, storage_dir: str = "data"):
         self.storage_dir = Path(storage_dir)
         self.storage_dir.mkdir(exist_ok=True)
-        self.memory_file = self.storage_dir / "long_term_memory.json"
-        self._cache: Dict[int, Dict] = {}
+        self.store = UserRecordStore("long_term_memory", storage_dir)
+        # Старый общий файл: один раз раскладывается по записям пользователей
+        self.legacy_file = self.storage_dir / "long_term_memory.json"
+        self._migrated = False
+        self._migration_lock = asyncio.Lock()
+        self._cache: "OrderedDict[int, Dict]" = OrderedDict()
+        self._index = FactIndex()
         self.enabled = ENABLE_LONG_TERM_MEMORY
 
-    async def _load_all_memories(self) -> Dict[str, Dict]:
-        """Загружает всю долгосрочную память"""
-        if not self.memory_file.exists():
-            return {}
-
-        try:
-            async with aiofiles.open(self.memory_file, 'r', encoding='utf-8') as f:
-                content = await f.read()
-                return json.loads(content)
-        except Exception as e:
-            logger.error(f"Ошибка загрузки долгосрочной памяти: {e}")
-            return {}
-
-    async def _save_all_memories(self, data: Dict[str, Dict]):
-        """Сохраняет всю долгосрочную память"""
-        try:
-            async with aiofiles.open(self.memory_file, 'w', encoding='utf-8') as f:
-                await f.write(json.dumps(data, ensure_ascii=False, indent=2))
-        except Exception as e:
-            logger.error(f"Ошибка сохранения долгосрочной памяти: {e}")
+    async def _migrate_legacy(self):
+        """Переносит long_term_memory.json в записи по пользователям"""
+        if self._migrated:
+            return
+
+        async with self._migration_lock:
+            if self._migrated:
+                return
+            self._migrated = True
+
+            if not self.legacy_file.exists():
+                return
+
+            try:
+                async with aiofiles.open(self.legacy_file, 'r', encoding='utf-8') as f:
+                    legacy = json.loads(await f.read())
+
+                for user_id, memory in legacy.items():
+                    full = self._get_empty_memory()
+                    full.update(memory)
+                    await self.store.put(int(user_id), _encode(full))
+
+                self.legacy_file.rename(self.legacy_file.with_suffix(".json.migrated"))
+                logger.info(f"Долгосрочная память перенесена в записи по пользователям: {len(legacy)}")
+            except Exception as e:
+                logger.error(f"Ошибка переноса долгосрочной памяти: {e}")
 
     async def get_memory(self, user_id: int) -> Dict:
         """Получает память о пользователе"""
@@ -47,15 +101,25 @@ class LongTermMemory:
             return self._get_empty_memory()
 
         if user_id in self._cache:
+            _cache_hit.inc()
+            self._cache.move_to_end(user_id)
             return self._cache[user_id]
 
-        all_memories = await self._load_all_memories()
-        memory = all_memories.get(str(user_id), self._get_empty_memory())
+        _cache_miss.inc()
+        await self._migrate_legacy()
+        record = await self.store.get(user_id)
+        memory = _decode(record) if record else self._get_empty_memory()
+        self._cache_put(user_id, memory)
+        return memory
 
+    def _cache_put(self, user_id: int, memory: Dict):
         self._cache[user_id] = memory
-        return memory
+        self._cache.move_to_end(user_id)
+        if len(self._cache) > LTM_CACHE_USERS:
+            self._cache.popitem(last=False)
 
-    def _get_empty_memory(self) -> Dict:
+    @staticmethod
+    def _get_empty_memory() -> Dict:
         """Возвращает пустую структуру памяти"""
         return {
             "name": None,
@@ -67,52 +131,123 @@ class LongTermMemory:
             "notes": []
         }
 
+    async def _update(self, user_id: int, updates: List[Tuple[str, str]]) -> List[str]:
+        """
+        Применяет обновления к памяти пользователя и сохраняет только его запись
+
+        Returns:
+            список изменений (пустой, если ничего нового)
+        """
+        async with self.store.lock(user_id):
+            memory = await self.get_memory(user_id)
+            changed = []
+
+            for field, value in updates:
+                if field in ("name", "birthday"):
+                    if memory.get(field) != value:
+                        memory[field] = value
+                        changed.append(f"{field}={value}")
+                    continue
+
+                if field == "facts":
+                    facts = memory["facts"]
+                    action, index = _merge_action(value, [f["text"] for f in facts])
+                    if action == SKIP:
+                        continue
+                    if action == REPLACE:
+                        # Более подробный факт заменяет старый и становится свежим
+                        del facts[index]
+                    facts.append({
+                        "text": value,
+                        "timestamp": datetime.now().isoformat(timespec="seconds")
+                    })
+                    changed.append(f"fact={value}")
+                    continue
+
+                values = memory.setdefault(field, [])
+                action, index = _merge_action(value, values)
+                if action == SKIP:
+                    continue
+                if action == REPLACE:
+                    del values[index]
+                values.append(value)
+                del values[:-MAX_LIST_ITEMS]
+                changed.append(f"{field}={value}")
+
+            if not changed:
+                return changed
+
+            # Ограничиваем количество фактов
+            if len(memory["facts"]) > MAX_FACTS_PER_USER:
+                memory["facts"] = memory["facts"][-MAX_FACTS_PER_USER:]
+
+            await self.store.put(user_id, _encode(memory))
+            # Запись могли вытеснить из кэша и перечитать до сохранения
+            self._cache_put(user_id, memory)
+            return changed
+
     async def add_fact(self, user_id: int, fact: str):
         """Добавляет факт о пользователе"""
         if not self.enabled:
             return
 
-        all_memories = await self._load_all_memories()
-
-        if str(user_id) not in all_memories:
-            all_memories[str(user_id)] = self._get_empty_memory()
-
-        user_memory = all_memories[str(user_id)]
-
-        # Добавляем факт с timestamp
-        user_memory["facts"].append({
-            "text": fact,
-            "timestamp": datetime.now().isoformat()
-        })
-
-        # Ограничиваем количество фактов
-        if len(user_memory["facts"]) > MAX_FACTS_PER_USER:
-            user_memory["facts"] = user_memory["facts"][-MAX_FACTS_PER_USER:]
-
-        await self._save_all_memories(all_memories)
-        self._cache[user_id] = user_memory
-
-        logger.info(f"Добавлен факт для пользователя {user_id}: {fact}")
+        if await self._update(user_id, [("facts", fact)]):
+            logger.info(f"Добавлен факт для пользователя {user_id}: {fact}")
 
     async def set_name(self, user_id: int, name: str):
         """Устанавливает имя пользователя"""
         if not self.enabled:
             return
 
-        all_memories = await self._load_all_memories()
-
-        if str(user_id) not in all_memories:
-            all_memories[str(user_id)] = self._get_empty_memory()
+        if await self._update(user_id, [("name", name)]):
+            logger.info(f"Установлено имя для {user_id}: {name}")
 
-        all_memories[str(user_id)]["name"] = name
+    async def merge_facts(self, user_id: int, updates: List[Tuple[str, str]]):
+        """
+        Сливает извлечённые факты с памятью пользователя (одна запись на диск)
 
-        await self._save_all_memories(all_memories)
-        self._cache[user_id] = all_memories[str(user_id)]
-
-        logger.info(f"Установлено имя для {user_id}: {name}")
+        Args:
+            updates: [(поле, значение)]; name и birthday перезаписываются,
+                списки и facts пополняются без дублей
+        """
+        if not self.enabled or not updates:
+            return
 
-    async def get_context_string(self, user_id: int) -> str:
-        """Возвращает строку с контекстом для промпта"""
+        changed = await self._update(user_id, updates)
+        if changed:
+            logger.info(f"Обновлена память {user_id}: {', '.join(changed)}", extra={"user_id": user_id, "stage": "facts"})
+
+    def select_facts(self, user_id: int, facts: List[Dict], query: Optional[str],
+                     top_k: int = LTM_TOP_K, token_budget: int = LTM_CONTEXT_TOKEN_BUDGET) -> List[str]:
+        """
+        Факты для промпта: самые похожие на сообщение, в пределах бюджета токенов
+
+        Если сообщение ни с чем не пересекается (или его нет),
+        берутся самые свежие факты, как раньше.
+        """
+        ranked = self._index.search(user_id, facts, query, top_k, LTM_MIN_SIMILARITY) if query else []
+        if not ranked:
+            ranked = [(i, 0.0) for i in range(len(facts) - 1, max(-1, len(facts) - 1 - top_k), -1)]
+
+        selected = []
+        tokens = 0
+        for index, _ in ranked:
+            text = facts[index]["text"]
+            cost = _estimate_tokens(text)
+            if tokens + cost > token_budget:
+                continue
+            selected.append(text)
+            tokens += cost
+        return selected
+
+    async def get_context_string(self, user_id: int, query: Optional[str] = None) -> str:
+        """
+        Возвращает строку с контекстом для промпта
+
+        Args:
+            user_id: ID пользователя
+            query: текущее сообщение - по нему выбираются релевантные факты
+        """
         memory = await self.get_memory(user_id)
 
         context_parts = []
@@ -121,8 +256,9 @@ class LongTermMemory:
             context_parts.append(f"Имя собеседника: {memory['name']}")
 
         if memory["facts"]:
-            recent_facts = [f["text"] for f in memory["facts"][-5:]]
-            context_parts.append(f"Факты о нём: {', '.join(recent_facts)}")
+            facts = self.select_facts(user_id, memory["facts"], query)
+            if facts:
+                context_parts.append(f"Факты о нём: {', '.join(facts)}")
 
         if memory["interests"]:
             context_parts.append(f"Интересы: {', '.join(memory['interests'])}")
@@ -136,4 +272,43 @@ class LongTermMemory:
         if not context_parts:
             return ""
 
-        return "\n\n📝 ЧТО ТЫ ЗНАЕШЬ О СОБЕСЕДНИКЕ:\n" + "\n".join(context_parts)
\ No newline at end of file
+        return "\n\n📝 ЧТО ТЫ ЗНАЕШЬ О СОБЕСЕДНИКЕ:\n" + "\n".join(context_parts)
+
+
+def _normalize(text: str) -> str:
+    return " ".join(re.sub(r"[^\w\s]", " ", text.lower()).split())
+
+
+SKIP = "skip"
+REPLACE = "replace"
+ADD = "add"
+
+
+def _merge_action(value: str, existing: List[str]) -> Tuple[str, Optional[int]]:
+    """
+    Как добавить значение в список без дублей
+
+    Сравнение - после нормализации и по целым словам:
+        skip    - такое же или более подробное значение уже есть
+        replace - новое подробнее старого («люблю аниме наруто»
+                  после «люблю аниме») - старое заменяется (индекс)
+        add     - новое значение
+    """
+    new = _normalize(value)
+    if not new:
+        return SKIP, None
+
+    for index, old_value in enumerate(existing):
+        old = _normalize(old_value)
+        if not old:
+            continue
+        if new == old or f" {new} " in f" {old} ":
+            return SKIP, index
+        if f" {old} " in f" {new} ":
+            return REPLACE, index
+    return ADD, None
+
+
+def _estimate_tokens(text: str) -> int:
+    """Грубая оценка числа токенов (для кириллицы ~3 символа на токен)"""
+    return len(text) // 3 + 1
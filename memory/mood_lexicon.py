@@ -0,0 +1,87 @@
+"""
+Словарь настроений: одна заранее собранная таблица словоформ
+
+Каждая запись словаря - основа слова, её окончания, категория и вес.
+При импорте записи разворачиваются в таблицу «словоформа -> (категория,
+вес)», а текст разбирается на слова за один проход: каждое слово -
+одна проверка по словарю. Совпадения идут только целыми словами
+(«плохо» больше не находится внутри «неплохой»), а отрицание «не»
+перед словом переворачивает оценку.
+"""
+import re
+from typing import Dict, List, Tuple
+
+CATEGORIES = ("positive", "negative", "sad")
+
+# (основа, окончания, категория, вес). Словоформы - прежние слова-триггеры
+# и их продолжения («дура» -> «дурак»), чтобы настроение менялось на тех
+# же сообщениях, что и раньше, кроме совпадений внутри чужих слов
+LEXICON: List[Tuple[str, Tuple[str, ...], str, float]] = [
+    # Комплименты и тёплые слова
+    ("люблю", ("",), "positive", 1.0),
+    ("нравишься", ("",), "positive", 1.0),
+    ("классная", ("",), "positive", 0.8),
+    ("милая", ("",), "positive", 0.8),
+    ("красивая", ("",), "positive", 0.8),
+    ("хорошая", ("",), "positive", 0.6),
+    ("умная", ("",), "positive", 0.8),
+    ("крутая", ("",), "positive", 0.7),
+    ("супер", ("",), "positive", 0.6),
+    ("офигенная", ("",), "positive", 0.9),
+    # Грубость
+    ("тупая", ("",), "negative", 1.0),
+    ("глупая", ("",), "negative", 0.8),
+    ("дура", ("", "к", "чок", "чина"), "negative", 1.0),
+    ("идиот", ("", "ка", "ина"), "negative", 1.0),
+    ("плохая", ("",), "negative", 0.7),
+    ("отстань", ("", "те"), "negative", 0.9),
+    ("заткнись", ("",), "negative", 1.0),
+    ("достала", ("",), "negative", 0.8),
+    # Грусть собеседника
+    ("грустно", ("",), "sad", 1.0),
+    ("плохо", ("", "й", "е", "го", "му", "м"), "sad", 0.7),
+    ("печально", ("",), "sad", 0.9),
+    ("одиноко", ("",), "sad", 1.0),
+    ("скучно", ("",), "sad", 0.6),
+]
+
+# Что становится с категорией под отрицанием: «не люблю» - грубовато,
+# «не глупая» - почти комплимент, «не грустно» - ничего
+NEGATION = {"positive": ("negative", 0.5), "negative": ("positive", 0.5), "sad": (None, 0.0)}
+
+_WORD_RE = re.compile(r"\w+")
+
+
+def _build_forms(lexicon) -> Dict[str, Tuple[str, float]]:
+    forms = {}
+    for stem, endings, category, weight in lexicon:
+        for ending in endings:
+            forms[stem + ending] = (category, weight)
+    return forms
+
+
+_FORMS = _build_forms(LEXICON)
+
+
+def score_text(text: str) -> Dict[str, float]:
+    """
+    Оценки категорий настроения за один проход по тексту
+
+    Returns:
+        {"positive": .., "negative": .., "sad": ..}
+    """
+    scores = dict.fromkeys(CATEGORIES, 0.0)
+    negated = False
+
+    for word in _WORD_RE.findall(text.lower().replace("ё", "е")):
+        entry = _FORMS.get(word)
+        if entry is not None:
+            category, weight = entry
+            if negated:
+                category, factor = NEGATION[category]
+                weight *= factor
+            if category is not None:
+                scores[category] += weight
+        negated = word == "не"
+
+    return scores
@@ -1,3 +1,6 @@
+import asyncio
+import math
+import os
 import random
 from datetime import datetime
 from typing import Dict, Optional
@@ -5,9 +8,25 @@ from pathlib import Path
 import json
 import aiofiles
 import logging
+import time
+
+from ai.context_builder import get_time_of_day
+from config import (
+    MOOD_DECAY_SECONDS, MOOD_MESSAGE_IMPULSE, MOOD_SET_STRENGTH, MOOD_MAX_INTENSITY,
+    MOOD_SWITCH_MARGIN,
+)
+from memory.mood_lexicon import score_text
+from utils.metrics import cache_requests, storage_seconds
 
 logger = logging.getLogger(__name__)
 
+_mood_cache_hit = cache_requests.labels("mood", "hit")
+_mood_cache_miss = cache_requests.labels("mood", "miss")
+_mood_read_seconds = storage_seconds.labels("mood", "read")
+_mood_write_seconds = storage_seconds.labels("mood", "write")
+_counters_read_seconds = storage_seconds.labels("message_counters", "read")
+_counters_write_seconds = storage_seconds.labels("message_counters", "write")
+
 
 class MoodSystem:
     """
@@ -36,6 +55,14 @@ class MoodSystem:
     # Вероятность случайной смены настроения (5%)
     RANDOM_MOOD_CHANGE_CHANCE = 0.05
 
+    # К чему настроение возвращается само по себе в разное время суток
+    BASELINES = {
+        "утро": {"сонная": 0.45, "обычное": 0.4, "усталая": 0.3},
+        "день": {"обычное": 0.5},
+        "вечер": {"обычное": 0.45, "счастливая": 0.35},
+        "ночь": {"сонная": 0.45, "обычное": 0.35, "взволнованная": 0.25},
+    }
+
     def __init__(self, storage_dir: str = "data"):
         self.storage_dir = Path(storage_dir)
         self.storage_dir.mkdir(exist_ok=True)
@@ -47,6 +74,7 @@ class MoodSystem:
         if not self.mood_file.exists():
             return {}
 
+        started = time.perf_counter()
         try:
             async with aiofiles.open(self.mood_file, 'r', encoding='utf-8') as f:
                 content = await f.read()
@@ -54,27 +82,94 @@ class MoodSystem:
         except Exception as e:
             logger.error(f"Ошибка загрузки настроений: {e}")
             return {}
+        finally:
+            _mood_read_seconds.observe(time.perf_counter() - started)
 
     async def _save_all_moods(self, data: Dict[str, Dict]):
         """Сохраняет все настроения"""
+        started = time.perf_counter()
         try:
             async with aiofiles.open(self.mood_file, 'w', encoding='utf-8') as f:
                 await f.write(json.dumps(data, ensure_ascii=False, indent=2))
         except Exception as e:
             logger.error(f"Ошибка сохранения настроений: {e}")
+        finally:
+            _mood_write_seconds.observe(time.perf_counter() - started)
 
-    async def get_mood(self, user_id: int) -> str:
-        """Получает текущее настроение для пользователя"""
+    # ========== Состояние ==========
+    #
+    # Настроение - вектор интенсивностей по MOODS плюс момент, когда он
+    # был посчитан. Между сообщениями вектор экспоненциально стремится
+    # к базовому для времени суток; текущее значение вычисляется при
+    # чтении из (state, ts, now), а на диск попадает только смена ярлыка.
+
+    def _baseline(self) -> Dict[str, float]:
+        return self.BASELINES.get(get_time_of_day(), {"обычное": 0.5})
+
+    def _one_hot(self, mood: str) -> Dict[str, float]:
+        return {mood: MOOD_SET_STRENGTH}
+
+    def _new_record(self, mood: str, state: Dict[str, float], now: float) -> Dict:
+        return {
+            "mood": mood,
+            "timestamp": datetime.fromtimestamp(now).isoformat(),
+            "ts": now,
+            "state": {m: round(v, 4) for m, v in state.items() if v > 0.001},
+        }
+
+    async def _get_record(self, user_id: int) -> Dict:
+        """Последнее сохранённое (или посчитанное) состояние пользователя"""
         if user_id in self._cache:
-            return self._cache[user_id].get("mood", "обычное")
+            _mood_cache_hit.inc()
+            return self._cache[user_id]
 
+        _mood_cache_miss.inc()
         all_moods = await self._load_all_moods()
-        user_data = all_moods.get(str(user_id), {"mood": "обычное", "timestamp": datetime.now().isoformat()})
+        record = all_moods.get(str(user_id))
+
+        if record is None:
+            baseline = self._baseline()
+            record = self._new_record(self._label(baseline), baseline, time.time())
+        elif "state" not in record:
+            # Старая запись: только ярлык и время
+            mood = record.get("mood", "обычное")
+            ts = datetime.fromisoformat(record["timestamp"]).timestamp() if record.get("timestamp") else time.time()
+            record = self._new_record(mood, self._one_hot(mood), ts)
+
+        self._cache[user_id] = record
+        return record
+
+    def _evaluate(self, record: Dict, now: float) -> Dict[str, float]:
+        """Состояние на момент now: затухание от сохранённого к базовому"""
+        baseline = self._baseline()
+        keep = math.exp(-max(0.0, now - record["ts"]) / MOOD_DECAY_SECONDS)
+        state = record["state"]
+        return {
+            mood: baseline.get(mood, 0.0) + (state.get(mood, 0.0) - baseline.get(mood, 0.0)) * keep
+            for mood in self.MOODS
+        }
 
-        # Кэшируем
-        self._cache[user_id] = user_data
+    def _label(self, state: Dict[str, float], current: Optional[str] = None) -> str:
+        """
+        Ярлык - самая сильная составляющая (при равенстве - первая по MOODS)
 
-        return user_data.get("mood", "обычное")
+        Текущий ярлык сохраняется, пока соперник не обгонит его
+        на MOOD_SWITCH_MARGIN: иначе близкие настроения мигали бы.
+        """
+        strongest = max(self.MOODS, key=lambda mood: state.get(mood, 0.0))
+        if current and state.get(current, 0.0) >= state[strongest] - MOOD_SWITCH_MARGIN:
+            return current
+        return strongest
+
+    async def _persist(self, user_id: int, record: Dict):
+        all_moods = await self._load_all_moods()
+        all_moods[str(user_id)] = record
+        await self._save_all_moods(all_moods)
+
+    async def get_mood(self, user_id: int) -> str:
+        """Текущее настроение для пользователя (чистое вычисление, без записи)"""
+        record = await self._get_record(user_id)
+        return self._label(self._evaluate(record, time.time()), record["mood"])
 
     async def set_mood(self, user_id: int, mood: str):
         """Устанавливает настроение для пользователя"""
@@ -82,14 +177,10 @@ class MoodSystem:
             logger.warning(f"Неизвестное настроение: {mood}")
             mood = "обычное"
 
-        all_moods = await self._load_all_moods()
-        all_moods[str(user_id)] = {
-            "mood": mood,
-            "timestamp": datetime.now().isoformat()
-        }
-        await self._save_all_moods(all_moods)
+        record = self._new_record(mood, self._one_hot(mood), time.time())
+        self._cache[user_id] = record
+        await self._persist(user_id, record)
 
-        self._cache[user_id] = all_moods[str(user_id)]
         logger.info(f"Настроение для {user_id}: {mood}")
 
     async def calculate_mood(
@@ -103,64 +194,53 @@ class MoodSystem:
         """
         Вычисляет настроение на основе контекста
 
+        Сообщение добавляет к состоянию импульс в сторону своего
+        настроения; запись на диск - только если сменился ярлык.
+
         Args:
             user_id: ID пользователя
             message_text: текст сообщения
-            time_of_day: время суток
+            time_of_day: время суток (базовое настроение берётся по текущему времени)
             trust_level: уровень доверия
             message_count_today: сколько сообщений сегодня от этого пользователя
 
         Returns:
             Настроение
         """
-        current_mood = await self.get_mood(user_id)
+        now = time.time()
+        record = await self._get_record(user_id)
+        state = self._evaluate(record, now)
 
-        # 1. Базовое настроение от времени суток
-        base_mood = self._get_time_based_mood(time_of_day)
-
-        # 2. Анализ сообщения пользователя
+        # 1. Анализ сообщения пользователя
         message_mood = self._analyze_message(message_text, trust_level)
+        if message_mood:
+            state[message_mood] += MOOD_MESSAGE_IMPULSE
 
-        # 3. Проверка на спам
-        if message_count_today > 30:
-            return "раздражённая"
-        elif message_count_today > 50:
-            return "усталая"
+        # 2. Спам утомляет и раздражает
+        if message_count_today > 50:
+            state["усталая"] += MOOD_MESSAGE_IMPULSE
+        elif message_count_today > 30:
+            state["раздражённая"] += MOOD_MESSAGE_IMPULSE
 
-        # 4. Случайная смена настроения (редко)
+        # 3. Случайная смена настроения (редко)
         if random.random() < self.RANDOM_MOOD_CHANGE_CHANCE:
-            new_mood = random.choice(self.MOODS)
-            logger.info(f"Случайная смена настроения на: {new_mood}")
-            await self.set_mood(user_id, new_mood)
-            return new_mood
+            random_mood = random.choice(self.MOODS)
+            state[random_mood] += MOOD_MESSAGE_IMPULSE
+            logger.info(f"Случайный импульс настроения: {random_mood}")
 
-        # 5. Приоритет: сообщение > текущее > базовое
-        if message_mood:
-            final_mood = message_mood
-        elif current_mood != "обычное":
-            # 20% шанс вернуться к базовому настроению
-            if random.random() < 0.2:
-                final_mood = base_mood
-            else:
-                final_mood = current_mood
-        else:
-            final_mood = base_mood
+        for mood in state:
+            state[mood] = min(state[mood], MOOD_MAX_INTENSITY)
 
-        # Сохраняем новое настроение
-        if final_mood != current_mood:
-            await self.set_mood(user_id, final_mood)
+        final_mood = self._label(state, record["mood"])
+        new_record = self._new_record(final_mood, state, now)
+        self._cache[user_id] = new_record
 
-        return final_mood
+        # Сохраняем только смену ярлыка: промежуточные состояния живут в памяти
+        if final_mood != record["mood"]:
+            await self._persist(user_id, new_record)
+            logger.info(f"Настроение для {user_id}: {record['mood']} -> {final_mood}")
 
-    def _get_time_based_mood(self, time_of_day: str) -> str:
-        """Определяет базовое настроение от времени суток"""
-        mood_map = {
-            "утро": random.choice(["сонная", "усталая", "обычное"]),
-            "день": "обычное",
-            "вечер": random.choice(["обычное", "счастливая"]),
-            "ночь": random.choice(["сонная", "взволнованная", "обычное"])
-        }
-        return mood_map.get(time_of_day, "обычное")
+        return final_mood
 
     def _analyze_message(self, text: str, trust_level: float) -> Optional[str]:
         """
@@ -169,36 +249,19 @@ class MoodSystem:
         Returns:
             Новое настроение или None (не менять)
         """
-        text_lower = text.lower()
-
-        # Позитивные триггеры
-        positive_triggers = [
-            "люблю", "нравишься", "классная", "милая", "красивая",
-            "хорошая", "умная", "крутая", "супер", "офигенная"
-        ]
-
-        # Негативные триггеры
-        negative_triggers = [
-            "тупая", "глупая", "дура", "идиот", "плохая",
-            "отстань", "заткнись", "достала"
-        ]
-
-        # Грустные триггеры
-        sad_triggers = [
-            "грустно", "плохо", "печально", "одиноко", "скучно"
-        ]
-
-        # Проверка на комплименты (делают счастливой)
-        if any(trigger in text_lower for trigger in positive_triggers):
-            if trust_level > 0.3:  # только если доверие есть
+        scores = score_text(text)
+
+        # Комплименты делают счастливой (только если доверие есть)
+        if scores["positive"] > 0:
+            if trust_level > 0.3:
                 return "счастливая"
 
-        # Проверка на грубость (раздражает)
-        if any(trigger in text_lower for trigger in negative_triggers):
+        # Грубость раздражает
+        if scores["negative"] > 0:
             return "раздражённая"
 
-        # Проверка на грусть у пользователя (сочувствие)
-        if any(trigger in text_lower for trigger in sad_triggers):
+        # Грусть у пользователя (сочувствие)
+        if scores["sad"] > 0:
             if trust_level > 0.5:
                 return "грустная"
 
@@ -214,19 +277,42 @@ class MoodSystem:
 
 
 class MessageCounter:
-    """Счётчик сообщений для отслеживания спама"""
+    """
+    Счётчик сообщений за сегодня для отслеживания спама
+
+    Счётчики текущего дня живут в памяти. Каждое увеличение -
+    одна строка «день user_id» в журнал message_counters.journal
+    (дописывание, без перезаписи файла). Когда журнал разрастается,
+    он сворачивается в снимок message_counters.json, где лежат
+    только сегодняшние счётчики. При смене дня итоги прошлого дня
+    (сколько пользователей и сообщений) уходят одной строкой в
+    message_counters_history.jsonl, а счётчики обнуляются.
+    """
+
+    # Сколько строк журнала копится до сворачивания в снимок
+    JOURNAL_COMPACT_LINES = 1000
 
     def __init__(self, storage_dir: str = "data"):
         self.storage_dir = Path(storage_dir)
         self.storage_dir.mkdir(exist_ok=True)
         self.counter_file = self.storage_dir / "message_counters.json"
-        self._cache: Dict[str, int] = {}
-
-    async def _load_counters(self) -> Dict[str, int]:
-        """Загружает счётчики"""
+        self.journal_file = self.storage_dir / "message_counters.journal"
+        self.history_file = self.storage_dir / "message_counters_history.jsonl"
+        self._day: Optional[str] = None
+        self._counts: Dict[int, int] = {}
+        self._journal_lines = 0
+        self._loaded = False
+        self._lock = asyncio.Lock()
+
+    @staticmethod
+    def _today() -> str:
+        return datetime.now().strftime("%Y-%m-%d")
+
+    async def _read_snapshot(self) -> Dict:
         if not self.counter_file.exists():
             return {}
 
+        started = time.perf_counter()
         try:
             async with aiofiles.open(self.counter_file, 'r', encoding='utf-8') as f:
                 content = await f.read()
@@ -234,43 +320,114 @@ class MessageCounter:
         except Exception as e:
             logger.error(f"Ошибка загрузки счётчиков: {e}")
             return {}
+        finally:
+            _counters_read_seconds.observe(time.perf_counter() - started)
 
-    async def _save_counters(self, data: Dict[str, int]):
-        """Сохраняет счётчики"""
+    async def _write_snapshot(self):
+        """Сохраняет снимок текущего дня и очищает журнал"""
+        started = time.perf_counter()
         try:
-            async with aiofiles.open(self.counter_file, 'w', encoding='utf-8') as f:
-                await f.write(json.dumps(data, indent=2))
+            data = {"day": self._day, "counts": {str(uid): n for uid, n in self._counts.items()}}
+            tmp_path = self.counter_file.with_suffix(".tmp")
+            async with aiofiles.open(tmp_path, 'w', encoding='utf-8') as f:
+                await f.write(json.dumps(data, separators=(",", ":")))
+            os.replace(tmp_path, self.counter_file)
+
+            async with aiofiles.open(self.journal_file, 'w', encoding='utf-8') as f:
+                await f.write("")
+            self._journal_lines = 0
         except Exception as e:
             logger.error(f"Ошибка сохранения счётчиков: {e}")
+        finally:
+            _counters_write_seconds.observe(time.perf_counter() - started)
 
-    def _get_today_key(self, user_id: int) -> str:
-        """Генерирует ключ для сегодняшнего дня"""
-        today = datetime.now().strftime("%Y-%m-%d")
-        return f"{user_id}_{today}"
+    async def _append_history(self, days: Dict[str, Dict[int, int]]):
+        """Итоги завершившихся дней - в историю активности"""
+        if not days:
+            return
+        try:
+            async with aiofiles.open(self.history_file, 'a', encoding='utf-8') as f:
+                for day in sorted(days):
+                    counts = days[day]
+                    await f.write(json.dumps({
+                        "day": day,
+                        "users": len(counts),
+                        "messages": sum(counts.values()),
+                    }) + "\n")
+        except Exception as e:
+            logger.error(f"Ошибка записи истории счётчиков: {e}")
 
-    async def increment(self, user_id: int) -> int:
-        """Увеличивает счётчик сообщений на сегодня"""
-        key = self._get_today_key(user_id)
+    async def _load(self):
+        """Поднимает счётчики из снимка и журнала (один раз за процесс)"""
+        today = self._today()
+        snapshot = await self._read_snapshot()
+        finished: Dict[str, Dict[int, int]] = {}
 
-        counters = await self._load_counters()
-        current = counters.get(key, 0)
-        new_count = current + 1
-        counters[key] = new_count
+        if "counts" in snapshot:
+            finished[snapshot["day"]] = {int(uid): n for uid, n in snapshot["counts"].items()}
+        else:
+            # Старый формат: {"<user_id>_<YYYY-MM-DD>": n} за все дни
+            for key, count in snapshot.items():
+                user_id, _, day = key.rpartition("_")
+                finished.setdefault(day, {})[int(user_id)] = count
+
+        if self.journal_file.exists():
+            async with aiofiles.open(self.journal_file, 'r', encoding='utf-8') as f:
+                async for line in f:
+                    parts = line.split()
+                    if len(parts) != 2:
+                        continue
+                    day_counts = finished.setdefault(parts[0], {})
+                    day_counts[int(parts[1])] = day_counts.get(int(parts[1]), 0) + 1
+
+        self._day = today
+        self._counts = finished.pop(today, {})
+        await self._append_history(finished)
+        await self._write_snapshot()
+        self._loaded = True
+
+    async def _ensure_current(self):
+        """Загружает счётчики при первом обращении и переключает день в полночь"""
+        if self._loaded and self._day == self._today():
+            return
+
+        async with self._lock:
+            if not self._loaded:
+                await self._load()
+                return
+
+            if self._day != self._today():
+                await self._append_history({self._day: self._counts})
+                self._day = self._today()
+                self._counts = {}
+                await self._write_snapshot()
 
-        await self._save_counters(counters)
-        self._cache[key] = new_count
+    async def increment(self, user_id: int) -> int:
+        """Увеличивает счётчик сообщений на сегодня"""
+        await self._ensure_current()
+
+        # Под тем же замком, что и снимок: иначе строка, дописанная, пока
+        # снимок пишется, пропала бы при очистке журнала
+        async with self._lock:
+            new_count = self._counts.get(user_id, 0) + 1
+            self._counts[user_id] = new_count
+
+            started = time.perf_counter()
+            try:
+                async with aiofiles.open(self.journal_file, 'a', encoding='utf-8') as f:
+                    await f.write(f"{self._day} {user_id}\n")
+                self._journal_lines += 1
+            except Exception as e:
+                logger.error(f"Ошибка записи журнала счётчиков: {e}")
+            finally:
+                _counters_write_seconds.observe(time.perf_counter() - started)
+
+            if self._journal_lines >= self.JOURNAL_COMPACT_LINES:
+                await self._write_snapshot()
 
         return new_count
 
     async def get_count(self, user_id: int) -> int:
         """Получает количество сообщений сегодня"""
-        key = self._get_today_key(user_id)
-
-        if key in self._cache:
-            return self._cache[key]
-
-        counters = await self._load_counters()
-        count = counters.get(key, 0)
-        self._cache[key] = count
-
-        return count
\ No newline at end of file
+        await self._ensure_current()
+        return self._counts.get(user_id, 0)
@@ -1,11 +1,19 @@
-from typing import Dict, List
+from typing import Dict, Iterator, List, Optional
+import asyncio
 import json
+import os
 import aiofiles
 from pathlib import Path
 import logging
+import time
+
+from utils.metrics import storage_seconds
 
 logger = logging.getLogger(__name__)
 
+_read_seconds = storage_seconds.labels("history", "read")
+_write_seconds = storage_seconds.labels("history", "write")
+
 
 class MemoryStorage:
     """Хранилище истории диалогов пользователей"""
@@ -25,6 +33,7 @@ class MemoryStorage:
         if not file_path.exists():
             return []
 
+        started = time.perf_counter()
         try:
             async with aiofiles.open(file_path, 'r', encoding='utf-8') as f:
                 content = await f.read()
@@ -33,17 +42,22 @@ class MemoryStorage:
         except Exception as e:
             logger.error(f"Ошибка загрузки истории для {user_id}: {e}")
             return []
+        finally:
+            _read_seconds.observe(time.perf_counter() - started)
 
     async def save_history(self, user_id: int, history: List[Dict[str, str]]):
         """Сохраняет историю пользователя"""
         file_path = self._get_user_file(user_id)
 
+        started = time.perf_counter()
         try:
             data = {"history": history}
             async with aiofiles.open(file_path, 'w', encoding='utf-8') as f:
                 await f.write(json.dumps(data, ensure_ascii=False, indent=2))
         except Exception as e:
             logger.error(f"Ошибка сохранения истории для {user_id}: {e}")
+        finally:
+            _write_seconds.observe(time.perf_counter() - started)
 
     async def add_message(self, user_id: int, role: str, content: str, max_messages: int = 20):
         """
@@ -62,4 +76,79 @@ class MemoryStorage:
         if len(history) > max_messages:
             history = history[-max_messages:]
 
-        await self.save_history(user_id, history)
\ No newline at end of file
+        await self.save_history(user_id, history)
+
+
+class UserRecordStore:
+    """
+    Записи по пользователям с доступом по ключу
+
+    Каждый пользователь - отдельный компактный JSON-файл
+    <storage_dir>/<name>/<shard>/<user_id>.json, где shard = user_id % 256,
+    чтобы в одном каталоге не скапливались миллионы файлов. Чтение
+    и запись касаются только одного пользователя, поэтому их стоимость
+    не зависит от общего числа пользователей. Запись атомарная:
+    во временный файл и os.replace.
+    """
+
+    SHARDS = 256
+
+    def __init__(self, name: str, storage_dir: str = "data"):
+        self.name = name
+        self.root = Path(storage_dir) / name
+        self.root.mkdir(parents=True, exist_ok=True)
+        # Блокировки по шардам: read-modify-write одного пользователя не перемешиваются
+        self._locks = [asyncio.Lock() for _ in range(self.SHARDS)]
+        self._read_seconds = storage_seconds.labels(name, "read")
+        self._write_seconds = storage_seconds.labels(name, "write")
+
+    def _path(self, user_id: int) -> Path:
+        return self.root / f"{user_id % self.SHARDS:02x}" / f"{user_id}.json"
+
+    def lock(self, user_id: int) -> asyncio.Lock:
+        """Блокировка для обновления записи пользователя"""
+        return self._locks[user_id % self.SHARDS]
+
+    async def get(self, user_id: int) -> Optional[Dict]:
+        """Запись пользователя или None, если её нет"""
+        path = self._path(user_id)
+        if not path.exists():
+            return None
+
+        started = time.perf_counter()
+        try:
+            async with aiofiles.open(path, 'r', encoding='utf-8') as f:
+                return json.loads(await f.read())
+        except Exception as e:
+            logger.error(f"Ошибка чтения {self.name}/{user_id}: {e}")
+            return None
+        finally:
+            self._read_seconds.observe(time.perf_counter() - started)
+
+    async def put(self, user_id: int, record: Dict):
+        """Сохраняет запись пользователя целиком"""
+        path = self._path(user_id)
+        path.parent.mkdir(exist_ok=True)
+        tmp_path = path.with_suffix(".tmp")
+
+        started = time.perf_counter()
+        try:
+            async with aiofiles.open(tmp_path, 'w', encoding='utf-8') as f:
+                await f.write(json.dumps(record, ensure_ascii=False, separators=(",", ":")))
+            os.replace(tmp_path, path)
+        except Exception as e:
+            logger.error(f"Ошибка записи {self.name}/{user_id}: {e}")
+        finally:
+            self._write_seconds.observe(time.perf_counter() - started)
+
+    async def delete(self, user_id: int):
+        """Удаляет запись пользователя"""
+        self._path(user_id).unlink(missing_ok=True)
+
+    def user_ids(self) -> Iterator[int]:
+        """ID всех пользователей с записями (обход каталогов, без чтения файлов)"""
+        for path in self.root.glob("*/*.json"):
+            try:
+                yield int(path.stem)
+            except ValueError:
+                continue
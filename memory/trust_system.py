@@ -3,11 +3,19 @@ import json
 from pathlib import Path
 import aiofiles
 import logging
+import time
 
 from config import TRUST_INCREMENT, MAX_TRUST
+from utils.metrics import cache_requests, storage_seconds
 
 logger = logging.getLogger(__name__)
 
+_read_seconds = storage_seconds.labels("trust", "read")
+_write_seconds = storage_seconds.labels("trust", "write")
+
+_cache_hit = cache_requests.labels("trust", "hit")
+_cache_miss = cache_requests.labels("trust", "miss")
+
 
 class TrustSystem:
     """Система доверия между пользователем и Махиро"""
@@ -23,6 +31,7 @@ class TrustSystem:
         if not self.trust_file.exists():
             return {}
 
+        started = time.perf_counter()
         try:
             async with aiofiles.open(self.trust_file, 'r', encoding='utf-8') as f:
                 content = await f.read()
@@ -30,20 +39,27 @@ class TrustSystem:
         except Exception as e:
             logger.error(f"Ошибка загрузки trust levels: {e}")
             return {}
+        finally:
+            _read_seconds.observe(time.perf_counter() - started)
 
     async def _save_all_trust(self, data: Dict[str, float]):
         """Сохраняет все уровни доверия"""
+        started = time.perf_counter()
         try:
             async with aiofiles.open(self.trust_file, 'w', encoding='utf-8') as f:
                 await f.write(json.dumps(data, indent=2))
         except Exception as e:
             logger.error(f"Ошибка сохранения trust levels: {e}")
+        finally:
+            _write_seconds.observe(time.perf_counter() - started)
 
     async def get_trust(self, user_id: int) -> float:
         """Получает уровень доверия пользователя"""
         if user_id in self._cache:
+            _cache_hit.inc()
             return self._cache[user_id]
 
+        _cache_miss.inc()
         all_trust = await self._load_all_trust()
         trust = all_trust.get(str(user_id), 0.0)
         self._cache[user_id] = trust
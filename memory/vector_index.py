@@ -0,0 +1,116 @@
+import re
+import zlib
+from collections import OrderedDict
+from typing import Dict, List, Sequence, Tuple
+
+import numpy as np
+
+# Размерность хэширующего векторизатора
+EMBEDDING_DIM = 512
+
+_WORD_RE = re.compile(r"\w+", re.UNICODE)
+
+
+def _feature_hash(feature: str) -> Tuple[int, float]:
+    """Индекс признака и знак (знак гасит систематические коллизии)"""
+    h = zlib.crc32(feature.encode("utf-8"))
+    return h % EMBEDDING_DIM, 1.0 if h & 0x80000000 else -1.0
+
+
+def embed(text: str) -> np.ndarray:
+    """
+    Локальный эмбеддинг текста без модели
+
+    Признаки - слова и символьные триграммы слов (с границами),
+    поэтому «аниме», «аниме-сериалы» и «анимешник» оказываются
+    рядом без стемминга. Вектор нормирован, так что скалярное
+    произведение двух эмбеддингов - косинусное сходство.
+    """
+    vector = np.zeros(EMBEDDING_DIM, dtype=np.float32)
+
+    for word in _WORD_RE.findall(text.lower()):
+        index, sign = _feature_hash("w:" + word)
+        vector[index] += sign * 2.0
+
+        padded = f"<{word}>"
+        for i in range(len(padded) - 2):
+            index, sign = _feature_hash(padded[i:i + 3])
+            vector[index] += sign
+
+    norm = float(np.linalg.norm(vector))
+    if norm > 0:
+        vector /= norm
+    return vector
+
+
+class FactIndex:
+    """
+    Векторный индекс фактов по пользователям
+
+    Для каждого пользователя хранится матрица эмбеддингов его фактов
+    (факты x EMBEDDING_DIM). Поиск - одно умножение матрицы на вектор
+    запроса, поэтому даже тысячи фактов перебираются за доли
+    миллисекунды. Эмбеддинг каждого факта считается один раз: при
+    изменении списка фактов строки старой матрицы переиспользуются.
+    Матрицы держатся только для MAX_USERS недавних собеседников.
+    """
+
+    # При 1000 фактах матрица - около 2 МБ; давно молчавшие вытесняются
+    MAX_USERS = 256
+
+    def __init__(self, max_users: int = MAX_USERS):
+        self.max_users = max_users
+        # user_id -> (подпись списка фактов, ключи фактов, матрица)
+        self._matrices: "OrderedDict[int, Tuple[tuple, List[str], np.ndarray]]" = OrderedDict()
+
+    @staticmethod
+    def _fact_key(fact: Dict) -> str:
+        return f"{fact.get('timestamp', '')}|{fact['text']}"
+
+    def _matrix(self, user_id: int, facts: Sequence[Dict]) -> np.ndarray:
+        # Факты только дописываются в конец и обрезаются с начала,
+        # поэтому длины и крайних фактов достаточно, чтобы заметить изменения
+        signature = (len(facts), self._fact_key(facts[0]), self._fact_key(facts[-1]))
+
+        cached = self._matrices.get(user_id)
+        if cached is not None:
+            self._matrices.move_to_end(user_id)
+            if cached[0] == signature:
+                return cached[2]
+
+        keys = [self._fact_key(fact) for fact in facts]
+        old_rows = {key: row for row, key in enumerate(cached[1])} if cached is not None else {}
+        matrix = np.empty((len(facts), EMBEDDING_DIM), dtype=np.float32)
+        for row, (key, fact) in enumerate(zip(keys, facts)):
+            old_row = old_rows.get(key)
+            matrix[row] = cached[2][old_row] if old_row is not None else embed(fact["text"])
+
+        self._matrices[user_id] = (signature, keys, matrix)
+        self._matrices.move_to_end(user_id)
+        if len(self._matrices) > self.max_users:
+            self._matrices.popitem(last=False)
+        return matrix
+
+    def search(self, user_id: int, facts: Sequence[Dict], query: str,
+               top_k: int, min_score: float = 0.0) -> List[Tuple[int, float]]:
+        """
+        Самые похожие на запрос факты
+
+        Returns:
+            [(индекс факта в facts, сходство)] по убыванию сходства;
+            факты со сходством не выше min_score отбрасываются
+        """
+        if not facts or top_k <= 0:
+            return []
+
+        matrix = self._matrix(user_id, facts)
+        scores = matrix @ embed(query)
+
+        if len(scores) > top_k:
+            candidates = np.argpartition(-scores, top_k - 1)[:top_k]
+        else:
+            candidates = np.arange(len(scores))
+
+        # При равном сходстве выше - более свежий факт
+        ranked = sorted(candidates, key=lambda i: (-scores[i], -i))
+        return [(int(i), float(scores[i])) for i in ranked if scores[i] > min_score]
@@ -0,0 +1,145 @@
+"""
+Списки доступа: админы, whitelist и blacklist
+
+Текущее состояние - неизменяемый снимок из frozenset'ов. Проверки
+на каждом сообщении - одно чтение ссылки на снимок и поиск в множестве.
+Изменения из админки собирают новый снимок, сохраняют его в
+data/acl.json и подменяют ссылку целиком, поэтому обработчики никогда
+не видят список «наполовину». Подписчики (уведомления админам и т.п.)
+получают новый снимок сразу после подмены - перезапуск и правка .env
+не нужны.
+
+При первом запуске списки берутся из config.py (.env). Админы из
+config.py добавляются к сохранённым при каждой загрузке.
+"""
+import asyncio
+import json
+import logging
+import os
+from pathlib import Path
+from typing import Callable, FrozenSet, List, NamedTuple
+
+from config import ADMIN_USER_IDS, BLACKLIST_USER_IDS, ENABLE_WHITELIST, WHITELIST_USER_IDS
+from utils.metrics import metrics
+
+logger = logging.getLogger(__name__)
+
+_acl_changes = metrics.counter("mahiro_acl_changes_total", "Изменения списков доступа", labels=("list",))
+
+# Списки, которые можно менять из админки
+EDITABLE_LISTS = ("whitelist", "blacklist")
+
+
+class AccessSnapshot(NamedTuple):
+    """Неизменяемое состояние списков доступа"""
+    admins: FrozenSet[int]
+    whitelist: FrozenSet[int]
+    blacklist: FrozenSet[int]
+    whitelist_enabled: bool
+
+
+class AccessControl:
+    """Проверки доступа по снимку и изменение списков без перезапуска"""
+
+    def __init__(self, storage_dir: str = "data"):
+        self.storage_dir = Path(storage_dir)
+        self.storage_dir.mkdir(exist_ok=True)
+        self.acl_file = self.storage_dir / "acl.json"
+        self._lock = asyncio.Lock()
+        self._subscribers: List[Callable[[AccessSnapshot], None]] = []
+        self._snapshot = self._read_snapshot()
+
+    def _read_snapshot(self) -> AccessSnapshot:
+        """Снимок из acl.json, а если его нет - из config.py"""
+        data = {}
+        if self.acl_file.exists():
+            try:
+                data = json.loads(self.acl_file.read_text(encoding="utf-8"))
+            except Exception as e:
+                logger.error(f"Ошибка загрузки списков доступа: {e}")
+
+        return AccessSnapshot(
+            admins=frozenset(data.get("admins", ())) | frozenset(ADMIN_USER_IDS),
+            whitelist=frozenset(data.get("whitelist", WHITELIST_USER_IDS)),
+            blacklist=frozenset(data.get("blacklist", BLACKLIST_USER_IDS)),
+            whitelist_enabled=data.get("whitelist_enabled", ENABLE_WHITELIST),
+        )
+
+    def _write_snapshot(self, snapshot: AccessSnapshot):
+        data = {
+            "admins": sorted(snapshot.admins),
+            "whitelist": sorted(snapshot.whitelist),
+            "blacklist": sorted(snapshot.blacklist),
+            "whitelist_enabled": snapshot.whitelist_enabled,
+        }
+        tmp_path = self.acl_file.with_suffix(".tmp")
+        tmp_path.write_text(json.dumps(data, indent=2), encoding="utf-8")
+        os.replace(tmp_path, self.acl_file)
+
+    @property
+    def snapshot(self) -> AccessSnapshot:
+        return self._snapshot
+
+    def subscribe(self, callback: Callable[[AccessSnapshot], None]):
+        """Подписка на изменения; колбэк сразу получает текущий снимок"""
+        self._subscribers.append(callback)
+        callback(self._snapshot)
+
+    def is_admin(self, user_id: int) -> bool:
+        return user_id in self._snapshot.admins
+
+    def is_blacklisted(self, user_id: int) -> bool:
+        return user_id in self._snapshot.blacklist
+
+    def is_whitelisted(self, user_id: int) -> bool:
+        """Проходит ли пользователь whitelist (всегда да, если он выключен, и для админов)"""
+        snapshot = self._snapshot
+        return (
+            not snapshot.whitelist_enabled
+            or user_id in snapshot.admins
+            or user_id in snapshot.whitelist
+        )
+
+    async def _commit(self, snapshot: AccessSnapshot, changed: str):
+        """Сохраняет снимок, подменяет текущий и оповещает подписчиков"""
+        await asyncio.to_thread(self._write_snapshot, snapshot)
+        self._snapshot = snapshot
+        _acl_changes.labels(changed).inc()
+
+        for callback in self._subscribers:
+            try:
+                callback(snapshot)
+            except Exception as e:
+                logger.error(f"Ошибка подписчика списков доступа: {e}")
+
+    async def add(self, list_name: str, user_id: int) -> bool:
+        """Добавляет пользователя в whitelist/blacklist. False - уже был в списке"""
+        async with self._lock:
+            current = getattr(self._snapshot, list_name)
+            if user_id in current:
+                return False
+            await self._commit(self._snapshot._replace(**{list_name: current | {user_id}}), list_name)
+            return True
+
+    async def remove(self, list_name: str, user_id: int) -> bool:
+        """Убирает пользователя из whitelist/blacklist. False - его там не было"""
+        async with self._lock:
+            current = getattr(self._snapshot, list_name)
+            if user_id not in current:
+                return False
+            await self._commit(self._snapshot._replace(**{list_name: current - {user_id}}), list_name)
+            return True
+
+    async def toggle_whitelist(self) -> bool:
+        """Включает/выключает whitelist, возвращает новое состояние"""
+        async with self._lock:
+            enabled = not self._snapshot.whitelist_enabled
+            await self._commit(self._snapshot._replace(whitelist_enabled=enabled), "whitelist_enabled")
+            return enabled
+
+    async def reload(self) -> AccessSnapshot:
+        """Перечитывает acl.json (после ручной правки файла)"""
+        async with self._lock:
+            snapshot = await asyncio.to_thread(self._read_snapshot)
+            await self._commit(snapshot, "reload")
+            return snapshot
@@ -0,0 +1,230 @@
+from pathlib import Path
+import json
+import asyncio
+import aiofiles
+from datetime import datetime, timedelta
+from typing import Dict, List, Optional
+import logging
+
+from config import (
+    ACTIVITY_MINUTE_RETENTION_HOURS,
+    ACTIVITY_HOURLY_RETENTION_DAYS,
+    ACTIVITY_DAILY_RETENTION_DAYS,
+)
+
+logger = logging.getLogger(__name__)
+
+# Форматы ключей корзин: строки сортируются так же, как время
+MINUTE_FORMAT = "%Y-%m-%dT%H:%M"
+HOUR_FORMAT = "%Y-%m-%dT%H"
+DAY_FORMAT = "%Y-%m-%d"
+
+WEEKDAYS = ["Пн", "Вт", "Ср", "Чт", "Пт", "Сб", "Вс"]
+
+
+def _new_bucket(with_hours: bool = False) -> Dict:
+    bucket = {"n": 0, "m": {}, "t": {}}
+    if with_hours:
+        bucket["h"] = [0] * 24
+    return bucket
+
+
+def _add_to_bucket(bucket: Dict, mood: Optional[str], trigger: Optional[str], hour: int = None):
+    bucket["n"] += 1
+    if mood:
+        bucket["m"][mood] = bucket["m"].get(mood, 0) + 1
+    if trigger:
+        bucket["t"][trigger] = bucket["t"].get(trigger, 0) + 1
+    if hour is not None:
+        bucket["h"][hour] += 1
+
+
+class ActivityRollup:
+    """
+    Агрегаты активности по времени
+
+    Каждое сообщение сразу попадает в три корзины: минутную,
+    часовую и дневную. Минутные корзины живут пару часов, часовые -
+    месяц, дневные - год. Запрос за произвольный интервал собирается
+    из самых крупных корзин, целиком попадающих в интервал, поэтому
+    стоимость запроса не зависит от числа сообщений и пользователей.
+    """
+
+    def __init__(self, storage_dir: str = "data"):
+        self.storage_dir = Path(storage_dir)
+        self.storage_dir.mkdir(exist_ok=True)
+        self.rollup_file = self.storage_dir / "activity_rollups.json"
+        self._minutes: Dict[str, Dict] = {}
+        self._hours: Dict[str, Dict] = {}
+        self._days: Dict[str, Dict] = {}
+        self._loaded = False
+        self._dirty = False
+        self._last_flush_minute: Optional[str] = None
+        self._lock = asyncio.Lock()
+
+    async def _load(self):
+        """Загружает агрегаты (один раз за процесс)"""
+        if self._loaded:
+            return
+
+        async with self._lock:
+            # Пока файл читается, record и query ждут здесь, а не работают с пустыми корзинами
+            if self._loaded:
+                return
+
+            if self.rollup_file.exists():
+                try:
+                    async with aiofiles.open(self.rollup_file, 'r', encoding='utf-8') as f:
+                        content = await f.read()
+                        data = json.loads(content)
+                    self._minutes = data.get("minutes", {})
+                    self._hours = data.get("hours", {})
+                    self._days = data.get("days", {})
+                except Exception as e:
+                    logger.error(f"Ошибка загрузки агрегатов активности: {e}")
+
+            self._loaded = True
+
+    async def _save(self):
+        """Сохраняет агрегаты"""
+        data = {"minutes": self._minutes, "hours": self._hours, "days": self._days}
+        try:
+            async with aiofiles.open(self.rollup_file, 'w', encoding='utf-8') as f:
+                await f.write(json.dumps(data, ensure_ascii=False, separators=(",", ":")))
+            self._dirty = False
+        except Exception as e:
+            logger.error(f"Ошибка сохранения агрегатов активности: {e}")
+
+    def _compact(self, now: datetime):
+        """Удаляет корзины старше срока хранения"""
+        minute_cutoff = (now - timedelta(hours=ACTIVITY_MINUTE_RETENTION_HOURS)).strftime(MINUTE_FORMAT)
+        hour_cutoff = (now - timedelta(days=ACTIVITY_HOURLY_RETENTION_DAYS)).strftime(HOUR_FORMAT)
+        day_cutoff = (now - timedelta(days=ACTIVITY_DAILY_RETENTION_DAYS)).strftime(DAY_FORMAT)
+
+        for buckets, cutoff in (
+            (self._minutes, minute_cutoff),
+            (self._hours, hour_cutoff),
+            (self._days, day_cutoff),
+        ):
+            for key in [k for k in buckets if k < cutoff]:
+                del buckets[key]
+
+    async def record(self, mood: Optional[str] = None, trigger: Optional[str] = None,
+                     at: Optional[datetime] = None):
+        """
+        Записывает одно сообщение
+
+        Args:
+            mood: настроение Махиро при ответе
+            trigger: сработавший триггер (если был)
+            at: время сообщения (по умолчанию - сейчас)
+        """
+        await self._load()
+
+        at = at or datetime.now()
+        minute_key = at.strftime(MINUTE_FORMAT)
+        hour_key = at.strftime(HOUR_FORMAT)
+        day_key = at.strftime(DAY_FORMAT)
+
+        if minute_key not in self._minutes:
+            self._minutes[minute_key] = _new_bucket()
+        if hour_key not in self._hours:
+            self._hours[hour_key] = _new_bucket()
+        if day_key not in self._days:
+            self._days[day_key] = _new_bucket(with_hours=True)
+
+        _add_to_bucket(self._minutes[minute_key], mood, trigger)
+        _add_to_bucket(self._hours[hour_key], mood, trigger)
+        _add_to_bucket(self._days[day_key], mood, trigger, hour=at.hour)
+        self._dirty = True
+
+        # На диск - не чаще раза в минуту
+        if minute_key != self._last_flush_minute:
+            self._last_flush_minute = minute_key
+            await self.flush(at)
+
+    async def flush(self, now: Optional[datetime] = None):
+        """Чистит устаревшие корзины и сохраняет агрегаты на диск"""
+        async with self._lock:
+            self._compact(now or datetime.now())
+            if self._dirty:
+                await self._save()
+
+    def _collect(self, start: datetime, end: datetime) -> List[tuple]:
+        """
+        Подбирает корзины, покрывающие [start, end)
+
+        Returns:
+            список (начало корзины, корзина, дневная ли)
+        """
+        parts = []
+        cursor = start.replace(second=0, microsecond=0)
+
+        while cursor < end:
+            day_start = cursor.replace(hour=0, minute=0)
+            next_day = day_start + timedelta(days=1)
+            if cursor == day_start and next_day <= end:
+                bucket = self._days.get(cursor.strftime(DAY_FORMAT))
+                if bucket:
+                    parts.append((cursor, bucket, True))
+                cursor = next_day
+                continue
+
+            hour_start = cursor.replace(minute=0)
+            next_hour = hour_start + timedelta(hours=1)
+            if cursor == hour_start and next_hour <= end:
+                bucket = self._hours.get(cursor.strftime(HOUR_FORMAT))
+                if bucket:
+                    parts.append((cursor, bucket, False))
+                cursor = next_hour
+                continue
+
+            bucket = self._minutes.get(cursor.strftime(MINUTE_FORMAT))
+            if bucket:
+                parts.append((cursor, bucket, False))
+            cursor += timedelta(minutes=1)
+
+        return parts
+
+    async def query(self, start: datetime, end: Optional[datetime] = None) -> Dict:
+        """
+        Активность за интервал [start, end)
+
+        Returns:
+            {"total", "by_hour" (24), "by_weekday" (7, с понедельника),
+             "by_mood", "by_trigger"}
+        """
+        await self._load()
+        end = end or datetime.now()
+
+        result = {
+            "total": 0,
+            "by_hour": [0] * 24,
+            "by_weekday": [0] * 7,
+            "by_mood": {},
+            "by_trigger": {},
+        }
+
+        for bucket_start, bucket, is_day in self._collect(start, end):
+            result["total"] += bucket["n"]
+            result["by_weekday"][bucket_start.weekday()] += bucket["n"]
+
+            if is_day:
+                for hour, count in enumerate(bucket["h"]):
+                    result["by_hour"][hour] += count
+            else:
+                result["by_hour"][bucket_start.hour] += bucket["n"]
+
+            for mood, count in bucket["m"].items():
+                result["by_mood"][mood] = result["by_mood"].get(mood, 0) + count
+            for trigger, count in bucket["t"].items():
+                result["by_trigger"][trigger] = result["by_trigger"].get(trigger, 0) + count
+
+        return result
+
+    async def query_last(self, days: int = 7) -> Dict:
+        """Активность за последние N дней"""
+        now = datetime.now()
+        # Начало выравниваем по часу: минутные корзины так давно уже удалены
+        start = (now - timedelta(days=days)).replace(minute=0, second=0, microsecond=0)
+        return await self.query(start, now)
@@ -97,6 +97,21 @@ class AdminNotifier:
         
         await self._send_to_admins(message)
     
+    async def notify_degradation(self, mode: str, reason: str):
+        """Уведомление о смене режима разгрузки"""
+        if not self.enabled or not self.bot:
+            return
+        
+        modes = {
+            "normal": "✅ Нагрузка спала - Махиро снова отвечает всем как обычно",
+            "short": "🟡 Очередь к Mistral растёт - обычным пользователям короткие ответы",
+            "shed": "🔴 Перегрузка - обычным пользователям ответы из кэша, без Mistral",
+        }
+        
+        message = f"{modes.get(mode, f'Режим разгрузки: {mode}')}\n\n📊 {reason}"
+        
+        await self._send_to_admins(message)
+    
     async def notify_custom(self, message: str):
         """Произвольное уведомление"""
         if not self.enabled or not self.bot:
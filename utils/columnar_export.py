@@ -0,0 +1,265 @@
+"""
+Колоночный экспорт данных бота для офлайн-аналитики
+
+Таблицы: users, conversations (метаданные каждой реплики), moods, donations.
+Пишется в Parquet, если установлен pyarrow, иначе - в собственный
+формат .mcol.gz: gzip с JSON-строками, где первая строка - схема,
+а каждая следующая - блок колонок длиной до CHUNK_ROWS строк.
+
+Запуск отдельно от бота:
+    python -m utils.columnar_export --data-dir data --out exports
+"""
+import argparse
+import gzip
+import json
+import logging
+from datetime import datetime
+from pathlib import Path
+from typing import Dict, Iterator, List, Optional, Tuple
+
+try:
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+    HAVE_PYARROW = True
+except ImportError:
+    pa = None
+    pq = None
+    HAVE_PYARROW = False
+
+logger = logging.getLogger(__name__)
+
+CHUNK_ROWS = 50_000
+
+# Схемы таблиц: (колонка, тип)
+SCHEMAS: Dict[str, List[Tuple[str, str]]] = {
+    "users": [
+        ("user_id", "int"),
+        ("username", "str"),
+        ("first_name", "str"),
+        ("last_name", "str"),
+        ("first_seen", "timestamp"),
+        ("last_seen", "timestamp"),
+        ("message_count", "int"),
+        ("successful_messages", "int"),
+        ("blocked_messages", "int"),
+    ],
+    "conversations": [
+        ("user_id", "int"),
+        ("turn", "int"),
+        ("role", "str"),
+        ("chars", "int"),
+        ("words", "int"),
+    ],
+    "moods": [
+        ("user_id", "int"),
+        ("mood", "str"),
+        ("timestamp", "timestamp"),
+    ],
+    "donations": [
+        ("user_id", "int"),
+        ("stars", "int"),
+        ("transaction_id", "str"),
+        ("timestamp", "timestamp"),
+        ("refunded", "bool"),
+        ("refund_date", "timestamp"),
+    ],
+}
+
+
+def _load_json(path: Path, default):
+    if not path.exists():
+        return default
+    try:
+        with open(path, 'r', encoding='utf-8') as f:
+            return json.load(f)
+    except Exception as e:
+        logger.error(f"Ошибка чтения {path}: {e}")
+        return default
+
+
+def _iter_users(data_dir: Path) -> Iterator[Dict]:
+    users = _load_json(data_dir / "users_tracker.json", {})
+    for user in users.values():
+        yield user
+
+
+def _iter_conversations(data_dir: Path) -> Iterator[Dict]:
+    """Реплики по одному файлу истории за раз"""
+    for path in sorted(data_dir.glob("user_*.json")):
+        try:
+            user_id = int(path.stem.split("_", 1)[1])
+        except ValueError:
+            continue
+
+        history = _load_json(path, {}).get("history", [])
+        for turn, message in enumerate(history):
+            content = message.get("content") or ""
+            yield {
+                "user_id": user_id,
+                "turn": turn,
+                "role": message.get("role"),
+                "chars": len(content),
+                "words": len(content.split()),
+            }
+
+
+def _iter_moods(data_dir: Path) -> Iterator[Dict]:
+    moods = _load_json(data_dir / "moods.json", {})
+    for user_id, data in moods.items():
+        yield {"user_id": int(user_id), "mood": data.get("mood"), "timestamp": data.get("timestamp")}
+
+
+def _iter_donations(data_dir: Path) -> Iterator[Dict]:
+    for donation in _load_json(data_dir / "donations.json", []):
+        yield donation
+
+
+SOURCES = {
+    "users": _iter_users,
+    "conversations": _iter_conversations,
+    "moods": _iter_moods,
+    "donations": _iter_donations,
+}
+
+
+def _coerce(value, kind: str):
+    if value is None or value == "":
+        return None
+    if kind == "int":
+        return int(value)
+    if kind == "bool":
+        return bool(value)
+    return str(value)
+
+
+class McolWriter:
+    """Запасной колоночный формат без зависимостей (.mcol.gz)"""
+
+    extension = ".mcol.gz"
+
+    def __init__(self, path: Path, table: str, schema: List[Tuple[str, str]]):
+        self._file = gzip.open(path, 'wt', encoding='utf-8')
+        header = {"format": "mahiro-columnar", "version": 1, "table": table, "schema": schema}
+        self._file.write(json.dumps(header, ensure_ascii=False) + "\n")
+
+    def write_chunk(self, columns: Dict[str, list], rows: int):
+        self._file.write(json.dumps({"rows": rows, "columns": columns}, ensure_ascii=False) + "\n")
+
+    def close(self):
+        self._file.close()
+
+
+class ParquetWriter:
+    """Parquet через pyarrow, одна row group на блок"""
+
+    extension = ".parquet"
+
+    _types = {
+        "int": lambda: pa.int64(),
+        "str": lambda: pa.string(),
+        "bool": lambda: pa.bool_(),
+        "timestamp": lambda: pa.timestamp("us"),
+    }
+
+    def __init__(self, path: Path, table: str, schema: List[Tuple[str, str]]):
+        self.schema = pa.schema([(name, self._types[kind]()) for name, kind in schema])
+        self.kinds = dict(schema)
+        self._writer = pq.ParquetWriter(str(path), self.schema, compression="zstd")
+
+    def write_chunk(self, columns: Dict[str, list], rows: int):
+        arrays = []
+        for field in self.schema:
+            values = columns[field.name]
+            if self.kinds[field.name] == "timestamp":
+                values = [datetime.fromisoformat(v) if v else None for v in values]
+            arrays.append(pa.array(values, type=field.type))
+        self._writer.write_table(pa.Table.from_arrays(arrays, schema=self.schema))
+
+    def close(self):
+        self._writer.close()
+
+
+def export_table(table: str, data_dir: Path, out_dir: Path, fmt: str = "auto",
+                 chunk_rows: int = CHUNK_ROWS) -> Tuple[Path, int]:
+    """
+    Экспортирует одну таблицу блоками по chunk_rows строк
+
+    Returns:
+        (путь к файлу, число строк)
+    """
+    schema = SCHEMAS[table]
+    use_parquet = fmt == "parquet" or (fmt == "auto" and HAVE_PYARROW)
+    if use_parquet and not HAVE_PYARROW:
+        raise RuntimeError("Для Parquet нужен pyarrow: pip install pyarrow")
+
+    writer_cls = ParquetWriter if use_parquet else McolWriter
+    timestamp = datetime.now().strftime("%Y%m%d_%H%M%S")
+    path = out_dir / f"{table}_{timestamp}{writer_cls.extension}"
+
+    writer = writer_cls(path, table, schema)
+    columns = {name: [] for name, _ in schema}
+    buffered = 0
+    total = 0
+
+    try:
+        for row in SOURCES[table](data_dir):
+            for name, kind in schema:
+                columns[name].append(_coerce(row.get(name), kind))
+            buffered += 1
+
+            if buffered >= chunk_rows:
+                writer.write_chunk(columns, buffered)
+                total += buffered
+                columns = {name: [] for name, _ in schema}
+                buffered = 0
+
+        if buffered or total == 0:
+            writer.write_chunk(columns, buffered)
+            total += buffered
+    finally:
+        writer.close()
+
+    logger.info(f"Columnar export {table}: {total} rows -> {path}")
+    return path, total
+
+
+def export_tables(data_dir: Path, out_dir: Path, tables: Optional[List[str]] = None,
+                  fmt: str = "auto", chunk_rows: int = CHUNK_ROWS) -> Dict[str, Tuple[Path, int]]:
+    """Экспортирует несколько таблиц (по умолчанию - все)"""
+    out_dir.mkdir(parents=True, exist_ok=True)
+    return {
+        table: export_table(table, data_dir, out_dir, fmt, chunk_rows)
+        for table in (tables or list(SCHEMAS))
+    }
+
+
+def read_mcol(path: Path) -> Iterator[Dict[str, list]]:
+    """Читает файл .mcol.gz блок за блоком"""
+    with gzip.open(path, 'rt', encoding='utf-8') as f:
+        f.readline()
+        for line in f:
+            yield json.loads(line)["columns"]
+
+
+def main(argv: Optional[List[str]] = None):
+    parser = argparse.ArgumentParser(description="Колоночный экспорт данных Махиро")
+    parser.add_argument("--data-dir", default="data", help="папка с данными бота")
+    parser.add_argument("--out", default="exports", help="куда писать файлы")
+    parser.add_argument("--tables", default=",".join(SCHEMAS), help="таблицы через запятую")
+    parser.add_argument("--format", default="auto", choices=["auto", "parquet", "mcol"])
+    parser.add_argument("--chunk-rows", type=int, default=CHUNK_ROWS)
+    args = parser.parse_args(argv)
+
+    tables = [t.strip() for t in args.tables.split(",") if t.strip()]
+    unknown = [t for t in tables if t not in SCHEMAS]
+    if unknown:
+        parser.error(f"неизвестные таблицы: {', '.join(unknown)}")
+
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+    results = export_tables(Path(args.data_dir), Path(args.out), tables, args.format, args.chunk_rows)
+    for table, (path, rows) in results.items():
+        print(f"{table}: {rows} строк -> {path}")
+
+
+if __name__ == "__main__":
+    main()
@@ -1,13 +1,31 @@
 import json
 import csv
+import asyncio
+import hashlib
+import os
 from pathlib import Path
 from datetime import datetime
-from typing import Optional
+from typing import Dict, Optional
 import zipfile
 import logging
 
 logger = logging.getLogger(__name__)
 
+MANIFEST_NAME = "backup_manifest.json"
+HASH_CHUNK_SIZE = 1024 * 1024
+
+# Один бэкап за раз: манифест общий для всех экспортёров
+_backup_lock = asyncio.Lock()
+
+
+def _file_sha256(path: Path) -> str:
+    """SHA-256 файла, читается кусками"""
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(HASH_CHUNK_SIZE), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
+
 
 class DatabaseExporter:
     """Экспорт всех данных бота"""
@@ -16,38 +34,113 @@ class DatabaseExporter:
         self.data_dir = Path(data_dir)
         self.export_dir = Path(export_dir)
         self.export_dir.mkdir(exist_ok=True)
+        self.manifest_file = self.export_dir / MANIFEST_NAME
     
-    async def export_all(self) -> Optional[Path]:
+    async def export_all(self, incremental: bool = False) -> Optional[Path]:
         """
-        Экспортирует ВСЕ данные в ZIP архив
+        Экспортирует данные в ZIP архив (в отдельном потоке)
+        
+        Args:
+            incremental: только файлы, изменившиеся с прошлого бэкапа
         
         Returns:
             Путь к созданному архиву или None при ошибке
         """
+        async with _backup_lock:
+            try:
+                zip_path = await asyncio.to_thread(self._build_archive, incremental)
+                logger.info(f"Database exported to {zip_path}")
+                return zip_path
+            except Exception as e:
+                logger.error(f"Export failed: {e}")
+                return None
+    
+    def _backup_sources(self) -> Dict[str, Path]:
+        """Файлы для бэкапа: всё из data/ и .env"""
+        sources = {}
+        
+        for path in sorted(self.data_dir.rglob("*")):
+            if path.is_file() and not path.name.endswith(".tmp"):
+                sources[path.relative_to(self.data_dir.parent).as_posix()] = path
+        
+        # Добавляем .env (без чувствительных данных)
+        env_path = Path(".env")
+        if env_path.exists():
+            sources[".env.backup"] = env_path
+        
+        return sources
+    
+    def _load_manifest(self) -> Dict:
+        if not self.manifest_file.exists():
+            return {"files": {}}
         try:
-            timestamp = datetime.now().strftime("%Y%m%d_%H%M%S")
-            zip_path = self.export_dir / f"mahiro_backup_{timestamp}.zip"
-            
-            with zipfile.ZipFile(zip_path, 'w', zipfile.ZIP_DEFLATED) as zipf:
-                # Добавляем все JSON файлы из data/
-                for json_file in self.data_dir.glob("*.json"):
-                    zipf.write(json_file, arcname=f"data/{json_file.name}")
+            with open(self.manifest_file, 'r', encoding='utf-8') as f:
+                return json.load(f)
+        except Exception as e:
+            logger.error(f"Ошибка чтения манифеста бэкапов: {e}")
+            return {"files": {}}
+    
+    def _build_archive(self, incremental: bool) -> Path:
+        """
+        Собирает архив. Выполняется вне event loop.
+        
+        Для каждого файла в манифесте хранятся размер, mtime и SHA-256.
+        Если размер и mtime не менялись, файл не перечитывается.
+        Инкрементальный архив содержит только изменённые файлы и
+        manifest.json с полным состоянием (включая удалённые пути),
+        чтобы цепочку бэкапов можно было развернуть обратно.
+        """
+        previous_manifest = self._load_manifest()
+        previous = previous_manifest.get("files", {}) if incremental else {}
+        
+        timestamp = datetime.now().strftime("%Y%m%d_%H%M%S")
+        kind = "incr" if incremental else "full"
+        zip_path = self.export_dir / f"mahiro_backup_{kind}_{timestamp}.zip"
+        tmp_path = zip_path.with_suffix(".zip.tmp")
+        
+        files = {}
+        changed = 0
+        
+        with zipfile.ZipFile(tmp_path, 'w', zipfile.ZIP_DEFLATED, compresslevel=6) as zipf:
+            for arcname, path in self._backup_sources().items():
+                stat = path.stat()
+                entry = {"size": stat.st_size, "mtime": stat.st_mtime}
                 
-                # Добавляем user_*.json файлы
-                for user_file in self.data_dir.glob("user_*.json"):
-                    zipf.write(user_file, arcname=f"data/{user_file.name}")
+                old = previous.get(arcname)
+                if old and old["size"] == entry["size"] and old["mtime"] == entry["mtime"]:
+                    entry["sha256"] = old["sha256"]
+                else:
+                    entry["sha256"] = _file_sha256(path)
                 
-                # Добавляем .env (без чувствительных данных)
-                env_path = Path(".env")
-                if env_path.exists():
-                    zipf.write(env_path, arcname=".env.backup")
-            
-            logger.info(f"Database exported to {zip_path}")
-            return zip_path
+                files[arcname] = entry
+                
+                if old and old["sha256"] == entry["sha256"]:
+                    continue
+                
+                # ZipFile.write копирует файл потоком, не читая его целиком
+                zipf.write(path, arcname=arcname)
+                changed += 1
             
-        except Exception as e:
-            logger.error(f"Export failed: {e}")
-            return None
+            manifest = {
+                "created": datetime.now().isoformat(),
+                "kind": kind,
+                "base": previous_manifest.get("archive") if incremental else None,
+                "archive": zip_path.name,
+                "deleted": sorted(set(previous) - set(files)),
+                "files": files,
+            }
+            zipf.writestr("manifest.json", json.dumps(manifest, ensure_ascii=False, indent=2))
+        
+        os.replace(tmp_path, zip_path)
+        
+        # Манифест обновляем только после успешной записи архива
+        manifest_tmp = self.manifest_file.with_suffix(".json.tmp")
+        with open(manifest_tmp, 'w', encoding='utf-8') as f:
+            json.dump(manifest, f, ensure_ascii=False)
+        os.replace(manifest_tmp, self.manifest_file)
+        
+        logger.info(f"Backup {kind}: {changed} of {len(files)} files changed")
+        return zip_path
     
     async def export_users_csv(self) -> Optional[Path]:
         """
@@ -131,14 +224,62 @@ class DatabaseExporter:
             logger.error(f"Statistics export failed: {e}")
             return None
     
+    async def export_columnar(self, tables: Optional[list] = None) -> Optional[Dict[str, Path]]:
+        """
+        Колоночный экспорт (Parquet или .mcol.gz) в отдельном потоке
+        
+        Returns:
+            {таблица: путь к файлу} или None при ошибке
+        """
+        try:
+            from utils.columnar_export import export_tables
+            
+            results = await asyncio.to_thread(export_tables, self.data_dir, self.export_dir, tables)
+            return {table: path for table, (path, _) in results.items()}
+            
+        except Exception as e:
+            logger.error(f"Columnar export failed: {e}")
+            return None
+    
+    def _backup_bases(self) -> Dict[str, Optional[str]]:
+        """Архив бэкапа -> архив, от которого он инкрементальный (None - полный)"""
+        bases = {}
+        for zip_path in self.export_dir.glob("mahiro_backup_*.zip"):
+            try:
+                with zipfile.ZipFile(zip_path) as zipf:
+                    bases[zip_path.name] = json.loads(zipf.read("manifest.json")).get("base")
+            except Exception:
+                bases[zip_path.name] = None
+        return bases
+    
     def cleanup_old_exports(self, days: int = 7):
-        """Удаляет старые экспорты"""
+        """
+        Удаляет старые экспорты
+        
+        Старый бэкап остаётся, пока от него зависит оставшийся
+        инкрементальный (вся цепочка до полного) или следующий
+        инкрементальный бэкап (архив из backup_manifest.json).
+        """
         try:
             from datetime import timedelta
             
             cutoff = datetime.now() - timedelta(days=days)
+            bases = self._backup_bases()
+            
+            # Цепочки оставшихся бэкапов и последнего, от которого пойдёт следующий
+            needed = set()
+            roots = [name for name in bases if (self.export_dir / name).stat().st_mtime >= cutoff.timestamp()]
+            latest = self._load_manifest().get("archive")
+            if latest:
+                roots.append(latest)
+            for name in roots:
+                while name and name not in needed:
+                    needed.add(name)
+                    name = bases.get(name)
             
             for export_file in self.export_dir.glob("*"):
+                if export_file.name == MANIFEST_NAME or export_file.name in needed:
+                    continue
                 if export_file.stat().st_mtime < cutoff.timestamp():
                     export_file.unlink()
                     logger.info(f"Deleted old export: {export_file.name}")
@@ -0,0 +1,279 @@
+import gzip
+import json
+import logging
+import logging.handlers
+import os
+import re
+import threading
+import time
+from collections import Counter
+from datetime import datetime, timedelta
+from pathlib import Path
+from typing import Dict, Iterator, List, Optional, Tuple
+
+LOG_LEVELS = ["DEBUG", "INFO", "WARNING", "ERROR", "CRITICAL"]
+
+# {"ts":"2026-01-28 15:18:14,123","level":"INFO",...} (JSON-строки utils.logging_setup)
+_JSON_RECORD_RE = re.compile(r'^\{"ts": "(\d{4}-\d\d-\d\d \d\d:\d\d:\d\d),\d+", "level": "([A-Z]+)"')
+# "2026-01-28 15:18:14,123 - bot.handlers - INFO - текст" (старые текстовые логи)
+_RECORD_RE = re.compile(r"^(\d{4}-\d\d-\d\d \d\d:\d\d:\d\d),\d+ - \S+ - ([A-Z]+) - ")
+_TIMESTAMP_FORMAT = "%Y-%m-%d %H:%M:%S"
+_SEGMENT_TIME_FORMAT = "%Y%m%d-%H%M%S-%f"
+
+INDEX_NAME = "index.json"
+_index_lock = threading.Lock()
+
+
+def parse_record_prefix(line: str) -> Optional[Tuple[str, str]]:
+    """(время, уровень) из начала строки лога или None для строк-продолжений"""
+    match = _JSON_RECORD_RE.match(line) or _RECORD_RE.match(line)
+    if not match:
+        return None
+    return match.group(1), match.group(2)
+
+
+class CompressingRotatingFileHandler(logging.handlers.BaseRotatingHandler):
+    """
+    Лог-файл с ротацией по размеру и по смене суток
+
+    Закрытый сегмент переименовывается в
+    <archive_dir>/<stem>-YYYYmmdd-HHMMSS-ffffff.log, а затем в фоновом потоке
+    сжимается в .log.gz и попадает в индекс (время начала/конца и
+    число записей каждого уровня). Старые сегменты сверх
+    backup_count удаляются.
+    """
+
+    def __init__(self, filename: str, archive_dir: str, max_bytes: int,
+                 backup_count: int, rotate_daily: bool = True, encoding: str = "utf-8"):
+        super().__init__(filename, "a", encoding=encoding, delay=False)
+        self.archive_dir = Path(archive_dir)
+        self.archive_dir.mkdir(parents=True, exist_ok=True)
+        self.max_bytes = max_bytes
+        self.backup_count = backup_count
+        self.rotate_daily = rotate_daily
+        self._opened_day = self._file_day()
+
+    def _file_day(self) -> str:
+        path = Path(self.baseFilename)
+        mtime = path.stat().st_mtime if path.exists() else time.time()
+        return time.strftime("%Y-%m-%d", time.localtime(mtime))
+
+    def shouldRollover(self, record: logging.LogRecord) -> bool:
+        if self.stream is None:
+            self.stream = self._open()
+
+        if self.rotate_daily and time.strftime("%Y-%m-%d", time.localtime(record.created)) != self._opened_day:
+            return self.stream.tell() > 0
+
+        if self.max_bytes > 0:
+            self.stream.seek(0, 2)
+            return self.stream.tell() >= self.max_bytes
+
+        return False
+
+    def doRollover(self):
+        if self.stream:
+            self.stream.close()
+            self.stream = None
+
+        source = Path(self.baseFilename)
+        if source.exists() and source.stat().st_size > 0:
+            stamp = datetime.now().strftime(_SEGMENT_TIME_FORMAT)
+            segment = self.archive_dir / f"{source.stem}-{stamp}.log"
+            os.replace(source, segment)
+            threading.Thread(
+                target=_compress_segment, args=(segment, self.backup_count), daemon=True
+            ).start()
+
+        self.stream = self._open()
+        self._opened_day = time.strftime("%Y-%m-%d")
+
+
+def _compress_segment(segment: Path, backup_count: int):
+    """Сжимает сегмент, считает по нему индекс и удаляет лишние архивы"""
+    try:
+        levels = Counter()
+        start = end = None
+
+        gz_path = segment.with_name(segment.name + ".gz")
+        with open(segment, "r", encoding="utf-8", errors="replace") as src, \
+                gzip.open(gz_path, "wt", encoding="utf-8") as dst:
+            for line in src:
+                dst.write(line)
+                prefix = parse_record_prefix(line)
+                if prefix:
+                    start = start or prefix[0]
+                    end = prefix[0]
+                    levels[prefix[1]] += 1
+
+        segment.unlink()
+        _update_index(segment.parent, gz_path.name, {"start": start, "end": end, "levels": dict(levels)})
+        _prune_segments(segment.parent, backup_count)
+    except Exception as e:
+        logging.getLogger(__name__).error(f"Не удалось сжать лог {segment}: {e}")
+
+
+def _load_index(archive_dir: Path) -> Dict[str, Dict]:
+    path = archive_dir / INDEX_NAME
+    if not path.exists():
+        return {}
+    try:
+        with open(path, "r", encoding="utf-8") as f:
+            return json.load(f)
+    except Exception:
+        return {}
+
+
+def _update_index(archive_dir: Path, name: str, entry: Optional[Dict]):
+    with _index_lock:
+        index = _load_index(archive_dir)
+        if entry is None:
+            index.pop(name, None)
+        else:
+            index[name] = entry
+
+        tmp_path = archive_dir / (INDEX_NAME + ".tmp")
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            json.dump(index, f, ensure_ascii=False)
+        os.replace(tmp_path, archive_dir / INDEX_NAME)
+
+
+def _list_segments(archive_dir: Path) -> List[Path]:
+    """Сегменты от старых к новым (имя содержит время ротации)"""
+    if not archive_dir.exists():
+        return []
+    return sorted(p for p in archive_dir.iterdir() if p.name.endswith((".log", ".log.gz")))
+
+
+def _prune_segments(archive_dir: Path, backup_count: int):
+    segments = [p for p in _list_segments(archive_dir) if p.name.endswith(".gz")]
+    for old in segments[:max(0, len(segments) - backup_count)]:
+        old.unlink()
+        _update_index(archive_dir, old.name, None)
+
+
+def format_line(line: str) -> str:
+    """JSON-строку лога - в короткий читаемый вид для Telegram"""
+    if not line.startswith("{"):
+        return line
+    try:
+        data = json.loads(line)
+    except ValueError:
+        return line
+
+    text = f"{data.get('ts', '')} {data.get('level', '')} {data.get('logger', '')}: {data.get('msg', '')}"
+    fields = [f"{key}={value}" for key, value in data.items()
+              if key not in ("ts", "level", "logger", "msg", "exc")]
+    if fields:
+        text += " [" + " ".join(fields) + "]"
+    if data.get("exc"):
+        text += "\n" + data["exc"]
+    return text
+
+
+def tail_lines(path: Path, count: int, block_size: int = 8192) -> List[str]:
+    """
+    Последние count строк файла
+
+    Файл читается блоками с конца, так что стоимость зависит
+    от числа запрошенных строк, а не от размера файла.
+    """
+    if count <= 0 or not path.exists():
+        return []
+
+    with open(path, "rb") as f:
+        f.seek(0, os.SEEK_END)
+        position = f.tell()
+        data = b""
+
+        while position > 0 and data.count(b"\n") <= count:
+            read_size = min(block_size, position)
+            position -= read_size
+            f.seek(position)
+            data = f.read(read_size) + data
+
+    lines = data.decode("utf-8", errors="replace").splitlines()
+    return lines[-count:]
+
+
+def parse_since(value: str, now: Optional[datetime] = None) -> Optional[datetime]:
+    """'30m', '6h', '7d' или дата '2026-01-28' -> datetime"""
+    now = now or datetime.now()
+    match = re.fullmatch(r"(\d+)([mhd])", value)
+    if match:
+        amount, unit = int(match.group(1)), match.group(2)
+        delta = {"m": timedelta(minutes=amount), "h": timedelta(hours=amount), "d": timedelta(days=amount)}[unit]
+        return now - delta
+    try:
+        return datetime.fromisoformat(value)
+    except ValueError:
+        return None
+
+
+def _iter_records(lines: Iterator[str]) -> Iterator[Tuple[Optional[str], Optional[str], str]]:
+    """(время, уровень, строка); строки-продолжения наследуют запись выше"""
+    timestamp = level = None
+    for line in lines:
+        line = line.rstrip("\n")
+        prefix = parse_record_prefix(line)
+        if prefix:
+            timestamp, level = prefix
+        yield timestamp, level, line
+
+
+def _open_segment(path: Path):
+    if path.name.endswith(".gz"):
+        return gzip.open(path, "rt", encoding="utf-8", errors="replace")
+    return open(path, "r", encoding="utf-8", errors="replace")
+
+
+def search_logs(log_file: Path, archive_dir: Path, pattern: str, level: Optional[str] = None,
+                since: Optional[datetime] = None, limit: int = 30) -> List[str]:
+    """
+    Ищет строки лога (подстрока без учёта регистра)
+
+    Файлы просматриваются от новых к старым; сегменты, которые по
+    индексу не пересекаются с since или не содержат записей нужного
+    уровня, пропускаются без чтения. Каждый файл читается потоком.
+
+    Returns:
+        до limit последних совпадений в хронологическом порядке
+    """
+    needle = pattern.lower()
+    since_str = since.strftime(_TIMESTAMP_FORMAT) if since else None
+    index = _load_index(archive_dir)
+
+    files = [log_file] + list(reversed(_list_segments(archive_dir)))
+    found: List[str] = []
+
+    for path in files:
+        if not path.exists():
+            continue
+
+        entry = index.get(path.name)
+        if entry:
+            if since_str and entry.get("end") and entry["end"] < since_str:
+                continue
+            if level and not entry.get("levels", {}).get(level):
+                continue
+
+        matches = []
+        with _open_segment(path) as f:
+            for timestamp, line_level, line in _iter_records(f):
+                if since_str and (timestamp is None or timestamp < since_str):
+                    continue
+                if level and line_level != level:
+                    continue
+                if needle in line.lower():
+                    matches.append(line)
+
+        found = matches[-(limit - len(found)):] + found if matches else found
+        if len(found) >= limit:
+            break
+
+        # Сегменты идут от новых к старым: всё дальше - ещё раньше since
+        if since_str and entry and entry.get("start") and entry["start"] < since_str:
+            break
+
+    return found[-limit:]
+
@@ -0,0 +1,152 @@
+"""
+Неблокирующее логирование
+
+Обработчики сообщений только кладут запись в очередь (QueueHandler),
+а форматирование и запись в файл/консоль делает QueueListener в
+отдельном потоке. В файл пишутся JSON-строки: время, уровень,
+логгер, текст и структурные поля из extra (user_id, stage,
+latency_ms). Частые INFO/DEBUG-записи из модулей, которые логируют
+каждое сообщение, сэмплируются.
+"""
+import json
+import logging
+import logging.handlers
+import queue
+import random
+import sys
+from typing import Dict, Optional
+
+from config import (
+    LOG_FILE, LOG_ARCHIVE_DIR, LOG_MAX_BYTES, LOG_BACKUP_COUNT, LOG_ROTATE_DAILY,
+    LOG_QUEUE_SIZE, LOG_SAMPLE_RATES,
+)
+from utils.log_files import CompressingRotatingFileHandler
+from utils.metrics import metrics
+
+TEXT_FORMAT = '%(asctime)s - %(name)s - %(levelname)s - %(message)s'
+
+# Поля extra, которые попадают в JSON-строку
+STRUCTURED_FIELDS = ("user_id", "stage", "latency_ms", "model", "tokens")
+
+_dropped = metrics.counter("mahiro_log_records_dropped_total", "Записи лога, не влезшие в очередь")
+_sampled_out = metrics.counter("mahiro_log_records_sampled_out_total", "Записи лога, отброшенные сэмплированием")
+
+
+class JsonLineFormatter(logging.Formatter):
+    """Одна запись - одна JSON-строка; первые поля ts и level, чтобы индекс логов читал их без json.loads"""
+
+    def format(self, record: logging.LogRecord) -> str:
+        data = {
+            "ts": self.formatTime(record),
+            "level": record.levelname,
+            "logger": record.name,
+            "msg": record.getMessage(),
+        }
+        for field in STRUCTURED_FIELDS:
+            value = getattr(record, field, None)
+            if value is not None:
+                data[field] = value
+
+        sample_rate = getattr(record, "sample_rate", None)
+        if sample_rate is not None:
+            data["sample_rate"] = sample_rate
+
+        if record.exc_text:
+            data["exc"] = record.exc_text
+        elif record.exc_info:
+            data["exc"] = self.formatException(record.exc_info)
+
+        return json.dumps(data, ensure_ascii=False, default=str)
+
+
+class SamplingFilter(logging.Filter):
+    """
+    Пропускает долю записей ниже WARNING от выбранных логгеров
+
+    Предупреждения и ошибки не сэмплируются никогда. У пропущенной
+    записи выставляется sample_rate, чтобы при анализе логов можно
+    было восстановить исходное число событий.
+    """
+
+    def __init__(self, rates: Dict[str, float]):
+        super().__init__()
+        self.rates = rates
+
+    def filter(self, record: logging.LogRecord) -> bool:
+        if record.levelno >= logging.WARNING:
+            return True
+
+        rate = self.rates.get(record.name)
+        if rate is None or rate >= 1:
+            return True
+
+        if random.random() < rate:
+            record.sample_rate = rate
+            return True
+
+        _sampled_out.inc()
+        return False
+
+
+class NonBlockingQueueHandler(logging.handlers.QueueHandler):
+    """QueueHandler, который при переполненной очереди теряет запись, а не ждёт"""
+
+    def prepare(self, record: logging.LogRecord) -> logging.LogRecord:
+        # Текст и traceback считаем здесь: в другом потоке аргументы могут уже измениться
+        record = logging.makeLogRecord(record.__dict__)
+        record.message = record.getMessage()
+        record.msg = record.message
+        record.args = None
+        if record.exc_info:
+            record.exc_text = logging.Formatter().formatException(record.exc_info)
+            record.exc_info = None
+        return record
+
+    def enqueue(self, record: logging.LogRecord):
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            _dropped.inc()
+
+
+_listener: Optional[logging.handlers.QueueListener] = None
+
+
+def setup_logging(level: int = logging.INFO) -> logging.handlers.QueueListener:
+    """
+    Настраивает корневой логгер и запускает поток записи логов
+
+    Returns:
+        QueueListener; при остановке бота нужно вызвать stop_logging()
+    """
+    global _listener
+
+    console = logging.StreamHandler(sys.stdout)
+    console.setFormatter(logging.Formatter(TEXT_FORMAT))
+
+    log_file = CompressingRotatingFileHandler(
+        LOG_FILE, LOG_ARCHIVE_DIR, LOG_MAX_BYTES, LOG_BACKUP_COUNT, rotate_daily=LOG_ROTATE_DAILY
+    )
+    log_file.setFormatter(JsonLineFormatter())
+
+    records = queue.Queue(maxsize=LOG_QUEUE_SIZE)
+    queue_handler = NonBlockingQueueHandler(records)
+    queue_handler.addFilter(SamplingFilter(LOG_SAMPLE_RATES))
+
+    root = logging.getLogger()
+    for handler in list(root.handlers):
+        root.removeHandler(handler)
+    root.addHandler(queue_handler)
+    root.setLevel(level)
+
+    _listener = logging.handlers.QueueListener(records, console, log_file, respect_handler_level=True)
+    _listener.start()
+    return _listener
+
+
+def stop_logging():
+    """Дописывает оставшиеся в очереди записи и останавливает поток"""
+    global _listener
+    if _listener is not None:
+        _listener.stop()
+        _listener = None
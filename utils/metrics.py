@@ -0,0 +1,308 @@
+import time
+from bisect import bisect_left
+from collections import deque
+from typing import Dict, List, Optional, Tuple
+
+# Границы корзин гистограмм по умолчанию (секунды)
+DEFAULT_BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+
+
+class Counter:
+    """Монотонный счётчик"""
+
+    __slots__ = ("value",)
+
+    def __init__(self):
+        self.value = 0
+
+    def inc(self, amount: float = 1):
+        self.value += amount
+
+
+class Gauge:
+    """Текущее значение (глубина очереди, число запросов в работе и т.п.)"""
+
+    __slots__ = ("value",)
+
+    def __init__(self):
+        self.value = 0
+
+    def set(self, value: float):
+        self.value = value
+
+    def inc(self, amount: float = 1):
+        self.value += amount
+
+    def dec(self, amount: float = 1):
+        self.value -= amount
+
+
+class Histogram:
+    """
+    Распределение значений (латентность)
+
+    Считает попадания в фиксированные корзины для Prometheus и
+    хранит последние WINDOW_SIZE замеров для живых перцентилей.
+    """
+
+    WINDOW_SIZE = 1024
+
+    __slots__ = ("count", "sum", "buckets", "bucket_counts", "_window")
+
+    def __init__(self, buckets: Tuple[float, ...] = DEFAULT_BUCKETS):
+        self.count = 0
+        self.sum = 0.0
+        self.buckets = buckets
+        # Последний элемент - корзина +Inf
+        self.bucket_counts = [0] * (len(buckets) + 1)
+        self._window = deque(maxlen=self.WINDOW_SIZE)
+
+    def observe(self, value: float):
+        self.count += 1
+        self.sum += value
+        self.bucket_counts[bisect_left(self.buckets, value)] += 1
+        self._window.append(value)
+
+    def percentiles(self, *quantiles: float) -> List[Optional[float]]:
+        """Перцентили по окну последних замеров"""
+        if not self._window:
+            return [None for _ in quantiles]
+
+        ordered = sorted(self._window)
+        last = len(ordered) - 1
+        return [ordered[min(last, int(q * len(ordered)))] for q in quantiles]
+
+
+class MetricFamily:
+    """Метрика с именем, описанием и набором меток"""
+
+    def __init__(self, name: str, kind: str, help_text: str, labelnames: Tuple[str, ...] = (),
+                 buckets: Tuple[float, ...] = DEFAULT_BUCKETS):
+        self.name = name
+        self.kind = kind
+        self.help = help_text
+        self.labelnames = labelnames
+        self.buckets = buckets
+        self._children: Dict[Tuple[str, ...], object] = {}
+        # Значения меток как их передали (не только str) -> метрика: повторный labels() - один поиск
+        self._bound: Dict[Tuple, object] = {}
+
+    def _new_child(self):
+        if self.kind == "counter":
+            return Counter()
+        if self.kind == "gauge":
+            return Gauge()
+        return Histogram(self.buckets)
+
+    def labels(self, *values: str):
+        """Возвращает (создаёт) метрику для конкретных значений меток"""
+        child = self._bound.get(values)
+        if child is not None:
+            return child
+
+        if len(values) != len(self.labelnames):
+            raise ValueError(f"{self.name}: ожидались метки {self.labelnames}, получено {values}")
+
+        key = tuple(str(v) for v in values)
+        child = self._children.get(key)
+        if child is None:
+            child = self._new_child()
+            self._children[key] = child
+        self._bound[values] = child
+        return child
+
+    def children(self) -> Dict[Tuple[str, ...], object]:
+        return self._children
+
+
+class MetricsRegistry:
+    """
+    Реестр метрик в памяти процесса
+
+    Запись замера - одно сложение без блокировок и I/O, поэтому
+    её можно делать прямо в обработчике сообщений. Метрики
+    без меток возвращаются сразу как Counter/Gauge/Histogram,
+    с метками - как MetricFamily (значения берутся через .labels()).
+    """
+
+    def __init__(self):
+        self._families: Dict[str, MetricFamily] = {}
+        self.start_time = time.time()
+
+    def _get_or_create(self, name: str, kind: str, help_text: str, labels: Tuple[str, ...],
+                       buckets: Tuple[float, ...] = DEFAULT_BUCKETS):
+        family = self._families.get(name)
+        if family is None:
+            family = MetricFamily(name, kind, help_text, tuple(labels), tuple(buckets))
+            self._families[name] = family
+        elif family.kind != kind:
+            raise ValueError(f"Метрика {name} уже зарегистрирована как {family.kind}")
+
+        if not family.labelnames:
+            return family.labels()
+        return family
+
+    def counter(self, name: str, help_text: str, labels: Tuple[str, ...] = ()):
+        return self._get_or_create(name, "counter", help_text, labels)
+
+    def gauge(self, name: str, help_text: str, labels: Tuple[str, ...] = ()):
+        return self._get_or_create(name, "gauge", help_text, labels)
+
+    def histogram(self, name: str, help_text: str, labels: Tuple[str, ...] = (),
+                  buckets: Tuple[float, ...] = DEFAULT_BUCKETS):
+        return self._get_or_create(name, "histogram", help_text, labels, buckets)
+
+    def get(self, name: str) -> Optional[MetricFamily]:
+        return self._families.get(name)
+
+    def families(self) -> List[MetricFamily]:
+        return list(self._families.values())
+
+    def render_prometheus(self) -> str:
+        """Все метрики в текстовом формате Prometheus (exposition format 0.0.4)"""
+        lines = []
+
+        for family in self.families():
+            lines.append(f"# HELP {family.name} {_escape_help(family.help)}")
+            lines.append(f"# TYPE {family.name} {family.kind}")
+
+            for values, child in list(family.children().items()):
+                labels = list(zip(family.labelnames, values))
+
+                if family.kind != "histogram":
+                    lines.append(f"{family.name}{_format_labels(labels)} {child.value}")
+                    continue
+
+                cumulative = 0
+                for bound, count in zip(child.buckets, child.bucket_counts):
+                    cumulative += count
+                    bucket_labels = _format_labels(labels + [("le", str(bound))])
+                    lines.append(f"{family.name}_bucket{bucket_labels} {cumulative}")
+                inf_labels = _format_labels(labels + [("le", "+Inf")])
+                lines.append(f"{family.name}_bucket{inf_labels} {child.count}")
+                lines.append(f"{family.name}_sum{_format_labels(labels)} {child.sum}")
+                lines.append(f"{family.name}_count{_format_labels(labels)} {child.count}")
+
+        return "\n".join(lines) + "\n"
+
+
+def _escape_help(text: str) -> str:
+    return text.replace("\\", "\\\\").replace("\n", "\\n")
+
+
+def _escape_label(value: str) -> str:
+    return value.replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def _format_labels(labels: List[Tuple[str, str]]) -> str:
+    if not labels:
+        return ""
+    inner = ",".join(f'{name}="{_escape_label(value)}"' for name, value in labels)
+    return "{" + inner + "}"
+
+
+class LiveSampler:
+    """
+    Компактный снимок метрик для живой панели
+
+    Каждый вызов sample() считает скорости относительно
+    предыдущего вызова, поэтому на каждое подключение
+    к дашборду создаётся свой экземпляр.
+    """
+
+    def __init__(self, registry: "MetricsRegistry"):
+        self.registry = registry
+        self._last_time = time.monotonic()
+        self._last_messages = self._total("mahiro_messages_total")
+        self._last_errors = self._total("mahiro_errors_total")
+
+    def _total(self, name: str) -> float:
+        family = self.registry.get(name)
+        if family is None:
+            return 0
+        return sum(child.value for child in family.children().values())
+
+    def _queues(self) -> Dict[str, float]:
+        family = self.registry.get("mahiro_queue_depth")
+        if family is None:
+            return {}
+        return {key[0]: child.value for key, child in family.children().items()}
+
+    def _cache_hit_rates(self) -> Dict[str, Optional[float]]:
+        family = self.registry.get("mahiro_cache_requests_total")
+        if family is None:
+            return {}
+
+        totals: Dict[str, List[float]] = {}
+        for (cache, result), child in family.children().items():
+            hits_total = totals.setdefault(cache, [0, 0])
+            if result == "hit":
+                hits_total[0] += child.value
+            hits_total[1] += child.value
+
+        return {
+            cache: round(hits / total, 3) if total else None
+            for cache, (hits, total) in totals.items()
+        }
+
+    def sample(self) -> Dict:
+        now = time.monotonic()
+        elapsed = max(now - self._last_time, 1e-6)
+
+        messages = self._total("mahiro_messages_total")
+        errors = self._total("mahiro_errors_total")
+
+        latency = self.registry.get("mahiro_llm_latency_seconds")
+        p50 = p95 = p99 = None
+        llm_count = 0
+        if latency is not None:
+            histogram = latency.labels()
+            llm_count = histogram.count
+            p50, p95, p99 = histogram.percentiles(0.5, 0.95, 0.99)
+
+        snapshot = {
+            "ts": round(time.time(), 3),
+            "uptime": int(time.time() - self.registry.start_time),
+            "messages_per_sec": round((messages - self._last_messages) / elapsed, 2),
+            "messages_total": messages,
+            "llm": {
+                "count": llm_count,
+                "p50_ms": round(p50 * 1000) if p50 is not None else None,
+                "p95_ms": round(p95 * 1000) if p95 is not None else None,
+                "p99_ms": round(p99 * 1000) if p99 is not None else None,
+            },
+            "queues": self._queues(),
+            "cache_hit_rate": self._cache_hit_rates(),
+            "errors_total": errors,
+            "errors_per_sec": round((errors - self._last_errors) / elapsed, 2),
+        }
+
+        self._last_time = now
+        self._last_messages = messages
+        self._last_errors = errors
+        return snapshot
+
+
+# Глобальный реестр
+metrics = MetricsRegistry()
+
+# ========== Общие метрики бота ==========
+messages_total = metrics.counter("mahiro_messages_total", "Обработано входящих сообщений")
+errors_total = metrics.counter("mahiro_errors_total", "Ошибки обработки", labels=("source",))
+llm_latency = metrics.histogram("mahiro_llm_latency_seconds", "Латентность запросов к Mistral")
+queue_depth = metrics.gauge("mahiro_queue_depth", "Глубина очередей", labels=("queue",))
+cache_requests = metrics.counter(
+    "mahiro_cache_requests_total", "Обращения к кэшам в памяти", labels=("cache", "result")
+)
+handler_stage_seconds = metrics.histogram(
+    "mahiro_handler_stage_seconds", "Длительность этапов handle_message", labels=("stage",)
+)
+llm_requests = metrics.counter("mahiro_llm_requests_total", "Запросы к Mistral", labels=("status",))
+llm_tokens = metrics.counter("mahiro_llm_tokens_total", "Токены Mistral", labels=("kind",))
+storage_seconds = metrics.histogram(
+    "mahiro_storage_op_seconds", "Чтения и записи JSON-хранилищ", labels=("store", "op")
+)
+images_sent = metrics.counter("mahiro_images_sent_total", "Отправка картинок", labels=("status",))
+rate_limit_rejections = metrics.counter(
+    "mahiro_rate_limit_rejections_total", "Отказы RateLimiter", labels=("reason",)
+)
@@ -1,11 +1,19 @@
 from datetime import datetime, timedelta
-from typing import Dict
+from typing import Dict, Tuple
 import logging
 
-from config import MAX_MESSAGES_PER_MINUTE, MAX_MESSAGES_PER_DAY, COOLDOWN_SECONDS
+from config import (
+    MAX_MESSAGES_PER_MINUTE, MAX_MESSAGES_PER_DAY, COOLDOWN_SECONDS, SPAM_SCORE_LIMIT, SPAM_SCORE_HALF_LIFE,
+)
+from utils.metrics import rate_limit_rejections
 
 logger = logging.getLogger(__name__)
 
+_rejected_cooldown = rate_limit_rejections.labels("cooldown")
+_rejected_minute = rate_limit_rejections.labels("minute")
+_rejected_day = rate_limit_rejections.labels("day")
+_rejected_spam = rate_limit_rejections.labels("spam")
+
 
 class RateLimiter:
     """Защита от спама - ограничение частоты сообщений"""
@@ -13,6 +21,23 @@ class RateLimiter:
     def __init__(self):
         self._user_timestamps: Dict[int, list] = {}
         self._last_message_time: Dict[int, datetime] = {}
+        # Очки спама от SpamFilter: (очки, когда посчитаны) - затухают со временем
+        self._spam_scores: Dict[int, Tuple[float, datetime]] = {}
+
+    def _spam_score(self, user_id: int, now: datetime) -> float:
+        if user_id not in self._spam_scores:
+            return 0.0
+        score, updated = self._spam_scores[user_id]
+        score *= 0.5 ** ((now - updated).total_seconds() / SPAM_SCORE_HALF_LIFE)
+        if score < 0.1:
+            del self._spam_scores[user_id]
+            return 0.0
+        return score
+
+    def add_spam_penalty(self, user_id: int, penalty: float):
+        """Добавляет очки спама (повторы и флуд из SpamFilter)"""
+        now = datetime.now()
+        self._spam_scores[user_id] = (self._spam_score(user_id, now) + penalty, now)
 
     def is_allowed(self, user_id: int) -> tuple[bool, str]:
         """
@@ -28,28 +53,36 @@ class RateLimiter:
             time_since_last = (now - self._last_message_time[user_id]).total_seconds()
             if time_since_last < COOLDOWN_SECONDS:
                 remaining = COOLDOWN_SECONDS - time_since_last
+                _rejected_cooldown.inc()
                 return False, f"Подожди {remaining:.1f} секунд перед следующим сообщением"
 
-        # 2. Получаем историю сообщений пользователя
+        # 2. Проверка очков спама (повторы одного и того же)
+        if self._spam_score(user_id, now) >= SPAM_SCORE_LIMIT:
+            _rejected_spam.inc()
+            return False, "Хватит одно и то же! Отдохни немного от повторов"
+
+        # 3. Получаем историю сообщений пользователя
         if user_id not in self._user_timestamps:
             self._user_timestamps[user_id] = []
 
         timestamps = self._user_timestamps[user_id]
 
-        # 3. Очищаем старые timestamps
+        # 4. Очищаем старые timestamps
         one_minute_ago = now - timedelta(minutes=1)
         one_day_ago = now - timedelta(days=1)
 
         timestamps = [ts for ts in timestamps if ts > one_day_ago]
         self._user_timestamps[user_id] = timestamps
 
-        # 4. Проверка лимита в минуту
+        # 5. Проверка лимита в минуту
         recent_messages = [ts for ts in timestamps if ts > one_minute_ago]
         if len(recent_messages) >= MAX_MESSAGES_PER_MINUTE:
+            _rejected_minute.inc()
             return False, f"Слишком много сообщений! Максимум {MAX_MESSAGES_PER_MINUTE} в минуту"
 
-        # 5. Проверка лимита в день
+        # 6. Проверка лимита в день
         if len(timestamps) >= MAX_MESSAGES_PER_DAY:
+            _rejected_day.inc()
             return False, f"Достигнут дневной лимит ({MAX_MESSAGES_PER_DAY} сообщений)"
 
         return True, ""
@@ -72,5 +105,7 @@ class RateLimiter:
             del self._user_timestamps[user_id]
         if user_id in self._last_message_time:
             del self._last_message_time[user_id]
+        if user_id in self._spam_scores:
+            del self._spam_scores[user_id]
 
         logger.info(f"Reset rate limits for user {user_id}")
\ No newline at end of file
@@ -3,21 +3,39 @@ from memory.storage import MemoryStorage
 from memory.trust_system import TrustSystem
 from memory.mood_system import MoodSystem, MessageCounter
 from memory.long_term_memory import LongTermMemory
+from memory.fact_extractor import FactExtractor
+from memory.archive import ConversationArchive
 from media.image_manager import ImageManager
 from utils.statistics import Statistics
 from utils.rate_limiter import RateLimiter
 from utils.user_tracker import UserTracker
+from utils.activity_rollup import ActivityRollup
+from utils.acl import AccessControl
+from utils.token_budget import TokenBudget
+from utils.spam_filter import SpamFilter
 from ai.triggers import TriggerSystem
+from ai.resilience import DegradedReplies
+from ai.router import ModelRouter
+from ai.degradation import DegradationController
 
 # Глобальные синглтоны сервисов
 mistral_client = MistralClient()
+model_router = ModelRouter(mistral_client.scheduler)
+degradation = DegradationController(mistral_client.scheduler)
 memory = MemoryStorage()
 trust_system = TrustSystem()
 mood_system = MoodSystem()
 message_counter = MessageCounter()
 long_term_memory = LongTermMemory()
+conversation_archive = ConversationArchive()
 image_manager = ImageManager()
 statistics = Statistics()
 rate_limiter = RateLimiter()
 trigger_system = TriggerSystem()
+degraded_replies = DegradedReplies()
 user_tracker = UserTracker()
+activity_rollup = ActivityRollup()
+acl = AccessControl()
+token_budget = TokenBudget()
+fact_extractor = FactExtractor(long_term_memory, mistral_client, token_budget)
+spam_filter = SpamFilter()
@@ -0,0 +1,163 @@
+"""
+Фильтр повторов и флуда перед Mistral
+
+Скопированное или слегка изменённое сообщение («привет!!» после
+«привет») стоит полного вызова Mistral, хотя ответ на него уже был.
+У каждого пользователя хранятся SimHash-отпечатки последних сообщений:
+64-битный хэш по символьным триграммам нормализованного текста, у
+похожих текстов отличается мало бит. Поиск - расстояние Хэмминга до
+нескольких последних отпечатков, то есть почти бесплатно. Отпечаток
+считается один раз на сообщение, по первым SPAM_MAX_CHARS символам
+и без повторяющихся триграмм, так что длинный флуд не держит цикл событий.
+
+    duplicate - повтор недавнего сообщения, на которое Mistral уже
+                ответил: тот же ответ с лёгкой вариацией
+    flood     - SPAM_FLOOD_REPEATS повторов в окне: реплика в характере
+
+Если на прошлое сообщение настоящего ответа не было (ошибка Mistral,
+«можешь повторить?», исчерпанный бюджет, разгрузка), повтор - это
+законная попытка ещё раз и проходит без штрафа.
+
+Каждый повтор добавляет очки спама в RateLimiter, так что флудер
+упирается в лимит, а обычный разговор не затрагивается: короткие
+сообщения («да», «ага») не проверяются вовсе.
+"""
+import hashlib
+import random
+import re
+import time
+from collections import OrderedDict, deque
+from typing import Deque, NamedTuple, Optional
+
+import numpy as np
+
+from ai.coalescing import vary_reply
+from config import (
+    ENABLE_SPAM_FILTER, SPAM_SIMHASH_DISTANCE, SPAM_MIN_LENGTH, SPAM_WINDOW_SECONDS,
+    SPAM_HISTORY_SIZE, SPAM_FLOOD_REPEATS, SPAM_MAX_CHARS,
+)
+from utils.metrics import metrics
+
+_spam_messages = metrics.counter("mahiro_spam_messages_total", "Повторы и флуд, отвеченные без Mistral", labels=("kind",))
+
+OK = "ok"
+DUPLICATE = "duplicate"
+FLOOD = "flood"
+
+_kind_messages = {kind: _spam_messages.labels(kind) for kind in (DUPLICATE, FLOOD)}
+
+# Очки спама в RateLimiter за повтор и за флуд
+PENALTIES = {DUPLICATE: 1.0, FLOOD: 2.0}
+
+SHINGLE = 3
+
+
+def _normalize(text: str) -> str:
+    return " ".join(re.sub(r"[^\w\s]", " ", text.lower()).split())
+
+
+def simhash(text: str) -> int:
+    """64-битный SimHash по различным символьным триграммам первых SPAM_MAX_CHARS символов"""
+    text = _normalize(text)[:SPAM_MAX_CHARS]
+    shingles = {text[i:i + SHINGLE] for i in range(max(1, len(text) - SHINGLE + 1))}
+    digests = b"".join(
+        hashlib.blake2b(shingle.encode("utf-8"), digest_size=8).digest() for shingle in shingles
+    )
+    # Голосование по битам: бит отпечатка стоит, если он есть у большинства триграмм
+    bits = np.unpackbits(np.frombuffer(digests, dtype=np.uint8)).reshape(-1, 64)
+    votes = bits.sum(axis=0) * 2 > len(shingles)
+    return int.from_bytes(np.packbits(votes).tobytes(), "big")
+
+
+def hamming(a: int, b: int) -> int:
+    return (a ^ b).bit_count()
+
+
+class SpamVerdict(NamedTuple):
+    kind: str
+    # Готовый ответ для duplicate/flood, None - идти в Mistral
+    reply: Optional[str]
+    penalty: float
+    # Отпечаток сообщения для remember (None - сообщение не проверялось)
+    fingerprint: Optional[int] = None
+
+
+class _Seen:
+    __slots__ = ("at", "fingerprint", "reply", "repeats")
+
+    def __init__(self, at: float, fingerprint: int):
+        self.at = at
+        self.fingerprint = fingerprint
+        self.reply: Optional[str] = None
+        self.repeats = 0
+
+
+class SpamFilter:
+    """Отпечатки недавних сообщений пользователей"""
+
+    # Сколько пользователей помнить (самые давние забываются)
+    MAX_USERS = 5000
+
+    FLOOD_LINES = [
+        "Хватит повторять одно и то же! 😤",
+        "Ты меня засыпал одинаковыми сообщениями… я обиделась 💢",
+        "Не буду отвечать на одно и то же по кругу! 😤",
+    ]
+
+    def __init__(self, enabled: bool = ENABLE_SPAM_FILTER):
+        self.enabled = enabled
+        self._recent: "OrderedDict[int, Deque[_Seen]]" = OrderedDict()
+
+    def _history(self, user_id: int, now: float) -> Deque[_Seen]:
+        history = self._recent.get(user_id)
+        if history is None:
+            history = self._recent[user_id] = deque(maxlen=SPAM_HISTORY_SIZE)
+            if len(self._recent) > self.MAX_USERS:
+                self._recent.popitem(last=False)
+        else:
+            self._recent.move_to_end(user_id)
+        while history and now - history[0].at > SPAM_WINDOW_SECONDS:
+            history.popleft()
+        return history
+
+    def check(self, user_id: int, text: str) -> SpamVerdict:
+        """Проверяет сообщение и запоминает его отпечаток"""
+        if not self.enabled or len(_normalize(text)) < SPAM_MIN_LENGTH:
+            return SpamVerdict(OK, None, 0.0)
+
+        now = time.monotonic()
+        fingerprint = simhash(text)
+        history = self._history(user_id, now)
+
+        seen = next(
+            (item for item in reversed(history) if hamming(item.fingerprint, fingerprint) <= SPAM_SIMHASH_DISTANCE),
+            None
+        )
+        if seen is None:
+            history.append(_Seen(now, fingerprint))
+            return SpamVerdict(OK, None, 0.0, fingerprint)
+
+        seen.at = now
+        if seen.reply is None:
+            # Ответа на прошлое такое же сообщение не было - пусть попробует ещё раз
+            return SpamVerdict(OK, None, 0.0, fingerprint)
+
+        seen.repeats += 1
+        if seen.repeats >= SPAM_FLOOD_REPEATS:
+            kind, reply = FLOOD, random.choice(self.FLOOD_LINES)
+        else:
+            kind, reply = DUPLICATE, vary_reply(seen.reply)
+
+        _kind_messages[kind].inc()
+        return SpamVerdict(kind, reply, PENALTIES[kind], fingerprint)
+
+    def remember(self, user_id: int, verdict: SpamVerdict, reply: str):
+        """Запоминает ответ Mistral, чтобы повтор получил его же (отпечаток - из check)"""
+        history = self._recent.get(user_id)
+        fingerprint = verdict.fingerprint
+        if not history or fingerprint is None:
+            return
+        for item in reversed(history):
+            if hamming(item.fingerprint, fingerprint) <= SPAM_SIMHASH_DISTANCE:
+                item.reply = reply
+                return
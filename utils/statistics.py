@@ -4,11 +4,16 @@ import aiofiles
 from datetime import datetime
 from typing import Dict
 import logging
+import time
 
 from config import ENABLE_STATISTICS
+from utils.metrics import storage_seconds
 
 logger = logging.getLogger(__name__)
 
+_read_seconds = storage_seconds.labels("statistics", "read")
+_write_seconds = storage_seconds.labels("statistics", "write")
+
 
 class Statistics:
     """Сбор и хранение статистики работы бота"""
@@ -25,6 +30,7 @@ class Statistics:
         if not self.stats_file.exists():
             return self._get_default_stats()
 
+        started = time.perf_counter()
         try:
             async with aiofiles.open(self.stats_file, 'r', encoding='utf-8') as f:
                 content = await f.read()
@@ -32,14 +38,19 @@ class Statistics:
         except Exception as e:
             logger.error(f"Ошибка загрузки статистики: {e}")
             return self._get_default_stats()
+        finally:
+            _read_seconds.observe(time.perf_counter() - started)
 
     async def _save_stats(self, stats: Dict):
         """Сохраняет статистику"""
+        started = time.perf_counter()
         try:
             async with aiofiles.open(self.stats_file, 'w', encoding='utf-8') as f:
                 await f.write(json.dumps(stats, ensure_ascii=False, indent=2))
         except Exception as e:
             logger.error(f"Ошибка сохранения статистики: {e}")
+        finally:
+            _write_seconds.observe(time.perf_counter() - started)
 
     def _get_default_stats(self) -> Dict:
         """Возвращает дефолтную структуру статистики"""
@@ -0,0 +1,190 @@
+"""
+Учёт токенов Mistral и бюджеты пользователей
+
+RateLimiter считает сообщения, а платим мы за токены: сто длинных
+сообщений стоят намного дороже ста приветствий. Здесь по полям usage
+ответов Mistral копятся токены пользователя за день и за месяц.
+Запись пользователя - одна компактная запись в UserRecordStore
+("token_usage"), поэтому обновление - O(1) и не трогает других.
+Общий счётчик бота лежит там же под ключом 0 и сбрасывается на диск
+не чаще раза в GLOBAL_FLUSH_SECONDS; в него же идут служебные запросы
+(извлечение фактов), не привязанные к пользователю. В памяти держатся
+записи TOKEN_BUDGET_CACHE_USERS недавних пользователей. Лимит 0 -
+без ограничения.
+
+Уровни:
+    ok   - обычная генерация
+    soft - израсходована доля TOKEN_BUDGET_SOFT_RATIO: быстрая модель и короче
+    hard - лимит исчерпан (у пользователя или у всего бота): без Mistral
+"""
+import asyncio
+import logging
+import time
+from collections import OrderedDict
+from datetime import datetime
+from typing import Dict, NamedTuple, Tuple
+
+from config import (
+    TOKEN_BUDGET_DAILY, TOKEN_BUDGET_MONTHLY, TOKEN_BUDGET_SOFT_RATIO,
+    DONOR_BUDGET_MULTIPLIER, GLOBAL_TOKEN_BUDGET_DAILY, TOKEN_BUDGET_CACHE_USERS,
+)
+from memory.storage import UserRecordStore
+from utils.donations import donation_system
+from utils.metrics import metrics
+
+logger = logging.getLogger(__name__)
+
+_tokens_by_level = metrics.counter("mahiro_budget_tokens_total", "Токены Mistral по уровню бюджета", labels=("level",))
+_budget_checks = metrics.counter("mahiro_budget_checks_total", "Проверки бюджета токенов", labels=("level",))
+_global_tokens_today = metrics.gauge("mahiro_budget_global_tokens_today", "Токены Mistral за сегодня (весь бот)")
+
+OK = "ok"
+SOFT = "soft"
+HARD = "hard"
+
+_level_tokens = {level: _tokens_by_level.labels(level) for level in (OK, SOFT, HARD)}
+_level_checks = {level: _budget_checks.labels(level) for level in (OK, SOFT, HARD)}
+
+# Ключ общего счётчика в хранилище (ID пользователей Telegram положительные)
+GLOBAL_KEY = 0
+
+
+class BudgetStatus(NamedTuple):
+    level: str
+    used_day: int
+    used_month: int
+    limit_day: int
+    limit_month: int
+
+
+def _periods() -> Tuple[str, str]:
+    now = datetime.now()
+    return now.strftime("%Y-%m-%d"), now.strftime("%Y-%m")
+
+
+def _fresh(record: Dict, day: str, month: str) -> Dict:
+    """Обнуляет счётчики прошедших дня и месяца"""
+    if record.get("d") != day:
+        record["d"], record["dt"] = day, 0
+    if record.get("m") != month:
+        record["m"], record["mt"] = month, 0
+    return record
+
+
+def _reached(used: int, limit: int, ratio: float = 1.0) -> bool:
+    """Достигнута ли доля ratio лимита (0 - без ограничения)"""
+    return bool(limit) and used >= limit * ratio
+
+
+class TokenBudget:
+    """Токены по пользователям и бюджеты с мягким и жёстким пределом"""
+
+    GLOBAL_FLUSH_SECONDS = 10
+    # Сколько помнить, донатер ли пользователь (donations.json читается целиком)
+    DONOR_CACHE_SECONDS = 600
+
+    def __init__(self, storage_dir: str = "data"):
+        self.store = UserRecordStore("token_usage", storage_dir)
+        self._cache: "OrderedDict[int, Dict]" = OrderedDict()
+        self._global: Dict = {}
+        self._global_loaded = False
+        self._global_flushed = 0.0
+        self._global_lock = asyncio.Lock()
+        self._donors: "OrderedDict[int, Tuple[bool, float]]" = OrderedDict()
+
+    @staticmethod
+    def _cache_put(cache: OrderedDict, user_id: int, value):
+        cache[user_id] = value
+        cache.move_to_end(user_id)
+        if len(cache) > TOKEN_BUDGET_CACHE_USERS:
+            cache.popitem(last=False)
+
+    async def _get(self, user_id: int) -> Dict:
+        record = self._cache.get(user_id)
+        if record is None:
+            record = await self.store.get(user_id) or {}
+            self._cache_put(self._cache, user_id, record)
+        else:
+            self._cache.move_to_end(user_id)
+        return _fresh(record, *_periods())
+
+    async def _get_global(self) -> Dict:
+        if not self._global_loaded:
+            async with self._global_lock:
+                if not self._global_loaded:
+                    self._global = await self.store.get(GLOBAL_KEY) or {}
+                    self._global_loaded = True
+        return _fresh(self._global, *_periods())
+
+    async def is_donor(self, user_id: int) -> bool:
+        cached = self._donors.get(user_id)
+        if cached and cached[1] > time.monotonic():
+            return cached[0]
+        donor = await donation_system.get_total_donated(user_id) > 0
+        self._cache_put(self._donors, user_id, (donor, time.monotonic() + self.DONOR_CACHE_SECONDS))
+        return donor
+
+    async def limits(self, user_id: int) -> Tuple[int, int]:
+        """(дневной, месячный) лимит пользователя с учётом донатов"""
+        multiplier = DONOR_BUDGET_MULTIPLIER if await self.is_donor(user_id) else 1
+        return TOKEN_BUDGET_DAILY * multiplier, TOKEN_BUDGET_MONTHLY * multiplier
+
+    async def check(self, user_id: int) -> BudgetStatus:
+        """Уровень бюджета перед запросом к Mistral"""
+        record = await self._get(user_id)
+        limit_day, limit_month = await self.limits(user_id)
+        used_day, used_month = record["dt"], record["mt"]
+        global_day = (await self._get_global())["dt"]
+
+        if (_reached(used_day, limit_day) or _reached(used_month, limit_month)
+                or _reached(global_day, GLOBAL_TOKEN_BUDGET_DAILY)):
+            level = HARD
+        elif (_reached(used_day, limit_day, TOKEN_BUDGET_SOFT_RATIO)
+              or _reached(used_month, limit_month, TOKEN_BUDGET_SOFT_RATIO)):
+            level = SOFT
+        else:
+            level = OK
+
+        _level_checks[level].inc()
+        return BudgetStatus(level, used_day, used_month, limit_day, limit_month)
+
+    async def record(self, user_id: int, tokens: int, level: str = OK):
+        """Добавляет потраченные токены пользователю и в общий счётчик"""
+        if tokens <= 0:
+            return
+
+        async with self.store.lock(user_id):
+            record = await self._get(user_id)
+            record["dt"] += tokens
+            record["mt"] += tokens
+            await self.store.put(user_id, record)
+            # Запись могли вытеснить из кэша и перечитать до сохранения
+            self._cache_put(self._cache, user_id, record)
+        _level_tokens[level].inc(tokens)
+        await self.record_global(tokens)
+
+    async def record_global(self, tokens: int):
+        """Добавляет токены только в общий счётчик (служебные запросы без пользователя)"""
+        if tokens <= 0:
+            return
+
+        glob = await self._get_global()
+        glob["dt"] += tokens
+        glob["mt"] += tokens
+        _global_tokens_today.set(glob["dt"])
+
+        if time.monotonic() - self._global_flushed >= self.GLOBAL_FLUSH_SECONDS:
+            await self.flush()
+
+    async def flush(self):
+        """Сохраняет общий счётчик (периодически и при остановке бота)"""
+        if not self._global_loaded:
+            return
+        self._global_flushed = time.monotonic()
+        async with self.store.lock(GLOBAL_KEY):
+            await self.store.put(GLOBAL_KEY, dict(self._global))
+
+    async def get_global_usage(self) -> Dict[str, int]:
+        """Токены всего бота за сегодня и за месяц"""
+        glob = await self._get_global()
+        return {"day": glob["dt"], "month": glob["mt"]}
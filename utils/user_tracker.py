@@ -4,9 +4,18 @@ import aiofiles
 from datetime import datetime
 from typing import Dict, List, Optional
 import logging
+import time
+
+from utils.metrics import cache_requests, storage_seconds
 
 logger = logging.getLogger(__name__)
 
+_read_seconds = storage_seconds.labels("users", "read")
+_write_seconds = storage_seconds.labels("users", "write")
+
+_cache_hit = cache_requests.labels("user_tracker", "hit")
+_cache_miss = cache_requests.labels("user_tracker", "miss")
+
 
 class UserTracker:
     """
@@ -24,6 +33,7 @@ class UserTracker:
         if not self.users_file.exists():
             return {}
 
+        started = time.perf_counter()
         try:
             async with aiofiles.open(self.users_file, 'r', encoding='utf-8') as f:
                 content = await f.read()
@@ -31,14 +41,19 @@ class UserTracker:
         except Exception as e:
             logger.error(f"Ошибка загрузки user tracker: {e}")
             return {}
+        finally:
+            _read_seconds.observe(time.perf_counter() - started)
 
     async def _save_users(self, data: Dict[str, Dict]):
         """Сохраняет всех пользователей"""
+        started = time.perf_counter()
         try:
             async with aiofiles.open(self.users_file, 'w', encoding='utf-8') as f:
                 await f.write(json.dumps(data, ensure_ascii=False, indent=2))
         except Exception as e:
             logger.error(f"Ошибка сохранения user tracker: {e}")
+        finally:
+            _write_seconds.observe(time.perf_counter() - started)
 
     async def track_user(self, user_id: int, username: str = None, first_name: str = None,
                          last_name: str = None, had_access: bool = True):
@@ -94,8 +109,10 @@ class UserTracker:
     async def get_user_info(self, user_id: int) -> Optional[Dict]:
         """Получает информацию о пользователе"""
         if user_id in self._cache:
+            _cache_hit.inc()
             return self._cache[user_id]
 
+        _cache_miss.inc()
         users = await self._load_users()
         return users.get(str(user_id))
 